@@ -0,0 +1,252 @@
+"""
+Micro-benchmarks for the shared codec.
+
+Measures the time and peak memory taken to encode and decode objects of
+various shapes with `BaseEncodingSession` and `BaseDecodingSession`.  Run from
+the project's base directory with either Python 2 or 3::
+
+    PYTHONPATH=. python benchmarks/codec.py
+
+With ``--json``, the results are written to standard output as a JSON
+document, so that runs can be saved and compared.  Peak memory is measured
+with `tracemalloc`, and reported as ``encode_peak_bytes`` and
+``decode_peak_bytes``.  On Python 2, where it is not available, each
+operation is run in a forked child process instead, and the growth of the
+child's maximum resident set size is reported as ``encode_rss_growth_bytes``
+and ``decode_rss_growth_bytes``.  This includes interpreter and allocator
+overhead, so it is only comparable between runs on Python 2.
+"""
+
+from __future__ import print_function
+
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import json
+import os
+import platform
+import sys
+import timeit
+
+from python2.shared.codec import BaseDecodingSession, BaseEncodingSession
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class EncodingSession(BaseEncodingSession):
+    def _enc_ref(self, obj):
+        raise TypeError("Unsupported type: {}".format(type(obj).__name__))
+
+
+class DecodingSession(BaseDecodingSession):
+    def _dec_ref(self, data):
+        raise TypeError("Unexpected reference")
+
+
+def nested_dicts(n):
+    return [{u'id': i, u'name': u'item', u'tags': {u'a': [i], u'b': None}}
+            for i in range(n)]
+
+
+def records(n):
+    return [{u'id': i, u'name': u'item {}'.format(i % 100), u'score': i / 4.0}
+            for i in range(n)]
+
+
+def big_strings(n):
+    return [u'x' * (n * 10), b'y' * (n * 10)]
+
+
+def cyclic(n):
+    nodes = [[i] for i in range(n)]
+    for node, next_node in zip(nodes, nodes[1:] + nodes[:1]):
+        node.append(next_node)
+    return nodes
+
+
+def mixed_depth(n):
+    items = []
+    for i in range(n):
+        item = i
+        for level in range(i % 8):
+            item = [item] if level % 2 else {u'k': item}
+        items.append(item)
+    return items
+
+
+# Shapes of objects to benchmark.  Each is a function of the size, and a dict
+# of options for the encoding session.
+SHAPES = {
+    'ints': (lambda n: list(range(n)), {}),
+    'strs': (lambda n: [u'item {}'.format(i) for i in range(n)], {}),
+    'dicts': (nested_dicts, {}),
+    'records': (records, {'records': True}),
+    'bigstrs': (big_strings, {}),
+    'cyclic': (cyclic, {}),
+    'mixed': (mixed_depth, {}),
+}
+
+# Shapes which can only be encoded with cycles enabled
+CYCLIC_SHAPES = frozenset({'cyclic'})
+
+
+# Units of ru_maxrss in bytes
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Name of the memory measurement in results: peak traced memory, or growth of
+# a forked child's maximum resident set size
+MEMORY_METRIC = 'peak_bytes' if tracemalloc is not None else 'rss_growth_bytes'
+
+
+def peak_memory(func):
+    """
+    Return the peak memory in bytes allocated while calling `func`, or None
+    if it cannot be measured.  See `MEMORY_METRIC`.
+    """
+    if tracemalloc is None:
+        if resource is None or not hasattr(os, 'fork'):
+            return None
+        return peak_rss_growth(func)
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _trim_heap():
+    """
+    Return free heap memory to the system where possible, so that a child
+    process cannot reuse memory freed by its parent without raising its
+    resident set size.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+    except (AttributeError, OSError):  # Not glibc
+        pass
+
+
+def peak_rss_growth(func):
+    """
+    Return how much calling `func` in a forked child process raises the
+    child's maximum resident set size, in bytes.
+    """
+    _trim_heap()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            func()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(wfd, str(after - before).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return int(data) * _RSS_UNIT if data else None
+
+
+def bench(shape, size, repeat, binary, cycles):
+    """ Return a dict of results for a shape. """
+    make, options = SHAPES[shape]
+    obj = make(size)
+    encoded = EncodingSession(binary, cycles, **options).encode(obj)
+
+    def encode():
+        EncodingSession(binary, cycles, **options).encode(obj)
+
+    def decode():
+        DecodingSession(binary, cycles).decode(encoded)
+
+    return {
+        'shape': shape,
+        'mode': 'binary' if binary else 'json',
+        'cycles': cycles,
+        'size': size,
+        'encode_seconds': min(timeit.repeat(encode, number=1, repeat=repeat)),
+        'decode_seconds': min(timeit.repeat(decode, number=1, repeat=repeat)),
+        'encode_' + MEMORY_METRIC: peak_memory(encode),
+        'decode_' + MEMORY_METRIC: peak_memory(decode),
+    }
+
+
+def format_table(results):
+    memory = 'peak' if tracemalloc is not None else 'RSS+'
+    lines = ["{:<9}{:<8}{:>12}{:>12}{:>14}{:>14}".format(
+        'shape', 'mode', 'encode ms', 'decode ms',
+        'encode ' + memory, 'decode ' + memory)]
+    for result in results:
+        lines.append("{:<9}{:<8}{:>12.1f}{:>12.1f}{:>14}{:>14}".format(
+            result['shape'], result['mode'],
+            result['encode_seconds'] * 1e3, result['decode_seconds'] * 1e3,
+            format_size(result['encode_' + MEMORY_METRIC]),
+            format_size(result['decode_' + MEMORY_METRIC])))
+    return '\n'.join(lines)
+
+
+def format_size(size):
+    return '-' if size is None else '{:.1f} MB'.format(size / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=100000,
+                        help="Number of elements per object")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of repetitions (best time is reported)")
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help="Shape to benchmark (default all); may be "
+                             "repeated")
+    parser.add_argument('--acyclic', action='store_true',
+                        help="Disable cycle tracking (skips cyclic shapes)")
+    parser.add_argument('--json', action='store_true',
+                        help="Write results as JSON")
+    conf = parser.parse_args()
+
+    cycles = not conf.acyclic
+    results = []
+    for shape in conf.shape or sorted(SHAPES):
+        if shape in CYCLIC_SHAPES and not cycles:
+            continue
+        for binary in (False, True):
+            results.append(
+                bench(shape, conf.size, conf.repeat, binary, cycles))
+
+    if conf.json:
+        json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': sys.platform,
+            'size': conf.size,
+            'repeat': conf.repeat,
+            # How memory was measured: tracemalloc's peak, in this process,
+            # or the growth of a forked child's maximum resident set size
+            'memory': ('tracemalloc_peak' if tracemalloc is not None
+                       else 'forked_rss_growth'),
+            # Maximum resident set size of the process, in platform units
+            'max_rss': (None if resource is None else
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+            'results': results,
+        }, sys.stdout, indent=2, separators=(',', ': '), sort_keys=True)
+        print()
+    else:
+        print(format_table(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Round-trip latency benchmark.
+
+Measures the time taken by small requests to a Python 2 process, where the
+cost is dominated by message framing and I/O rather than by encoding, with
+each protocol and transport.  The ``bulk`` and ``view`` operations lift a
+1 MiB byte string and memoryview, to measure throughput.  Run from the
+project's base directory with Python 3::
+
+    PYTHONPATH=. python benchmarks/roundtrip.py --python2 python2
+
+With ``--json``, the results are written to standard output as a JSON
+document, so that runs can be saved and compared.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+from python2.client import Python2
+from python2.shared import shm
+
+
+# Operations to benchmark.  Each is a function of a Python2 instance which
+# returns a function making one request.
+OPERATIONS = {
+    'ping': lambda py2: py2.ping,
+    'call': lambda py2: lambda f=py2.len, x=py2.list((1, 2, 3)): f(x),
+    'lift': lambda py2: lambda x=py2.list((1, 2, 3)): py2.lift(x),
+    'bulk': lambda py2: lambda x=py2.project(b'x' * (1 << 20)): py2.lift(x),
+    'view': lambda py2: (
+        lambda x=py2.memoryview(b'x' * (1 << 20)): py2.lift(x)),
+}
+
+_BULK_OPERATIONS = ('bulk', 'view')
+
+
+def bench(py2, protocol, transport, operation, number, repeat):
+    """ Return a dict of results for an operation. """
+    func = OPERATIONS[operation](py2)
+    func()  # Warm up
+    seconds = min(timeit.repeat(func, number=number, repeat=repeat))
+    return {
+        'protocol': protocol,
+        'transport': transport,
+        'operation': operation,
+        'number': number,
+        'seconds_per_request': seconds / number,
+    }
+
+
+def format_table(results):
+    lines = ["{:<8}{:<11}{:<11}{:>14}".format(
+        'mode', 'transport', 'operation', 'us/request')]
+    for result in results:
+        lines.append("{:<8}{:<11}{:<11}{:>14.1f}".format(
+            result['protocol'], result['transport'], result['operation'],
+            result['seconds_per_request'] * 1e6))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--python2', default='python2',
+                        help="Python 2 executable to use")
+    parser.add_argument('--number', type=int, default=10000,
+                        help="Number of requests per repetition")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of repetitions (best time is reported)")
+    parser.add_argument('--operation', action='append',
+                        choices=sorted(OPERATIONS),
+                        help="Operation to benchmark (default all); may be "
+                             "repeated")
+    parser.add_argument('--transport', action='append',
+                        choices=('pipe', 'shm'),
+                        help="Transport to benchmark (default all); may be "
+                             "repeated")
+    parser.add_argument('--blob-threshold', type=int,
+                        default=shm.DEFAULT_BLOB_THRESHOLD,
+                        help="Minimum size of shared-memory blobs with the "
+                             "binary protocol (0 to disable)")
+    parser.add_argument('--json', action='store_true',
+                        help="Write results as JSON")
+    conf = parser.parse_args()
+
+    results = []
+    for protocol in ('json', 'binary'):
+        for transport in conf.transport or ('pipe', 'shm'):
+            options = {}
+            if protocol == 'binary':
+                options.update(blob_threshold=conf.blob_threshold)
+            with Python2(conf.python2, protocol=protocol,
+                         transport=transport, **options) as py2:
+                for operation in conf.operation or sorted(OPERATIONS):
+                    number = conf.number
+                    if operation in _BULK_OPERATIONS:
+                        number = max(1, number // 100)
+                    results.append(bench(py2, protocol, transport, operation,
+                                         number, conf.repeat))
+
+    if conf.json:
+        json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': sys.platform,
+            'blob_threshold': conf.blob_threshold,
+            'results': results,
+        }, sys.stdout, indent=2, separators=(',', ': '), sort_keys=True)
+        print()
+    else:
+        print(format_table(results))
+
+
+if __name__ == '__main__':
+    main()
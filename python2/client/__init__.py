@@ -1,5 +1,7 @@
 # Convenience imports
 
 from python2.client.exceptions import Py2Error  # noqa
+from python2.client.lazy import LazyDict, LazyList  # noqa
 from python2.client.object import Py2Object  # noqa
+from python2.client.pipeline import Pipeline, Py2Future  # noqa
 from python2.client.session import Python2  # noqa
@@ -1,17 +1,34 @@
 # TODO: Logging
 
+import collections
 import contextlib
-import json
+import importlib.util
 import logging
+import time
 import weakref
 
-from python2.client.codec import ClientCodec
+from python2.client.codec import ClientArgumentCache, ClientCodec
 from python2.client.exceptions import Py2Error
 from python2.client.object import Py2Object
+from python2.client.pipeline import Py2Future
+from python2.shared.protocol import (DEFAULT_COMPRESS_THRESHOLD,
+                                     JsonProtocol, get_protocol)
 
 
 SPECIAL_EXCEPTION_TYPES = {t.__name__: t for t in (StopIteration, TypeError)}
 
+# Maximum total size in bytes of pipelined commands whose responses have not
+# been read.  This is no larger than the buffer of a pipe or socket, so that
+# writing a command never blocks while the server is itself blocked writing a
+# response that we have not read.
+PIPELINE_BYTES = 65536
+
+# Number of released objects, and time in seconds since the first was
+# released, after which an idle client sends the released objects' ids on
+# their own rather than with the next command
+RELEASE_BATCH_SIZE = 1000
+RELEASE_DELAY = 1.0
+
 logger = logging.getLogger(__name__)
 
 
@@ -28,6 +45,12 @@ class Py2Client:
         self.outfile = outfile
         self.objects = weakref.WeakValueDictionary()
         self.codec = ClientCodec(self)
+        self.protocol = JsonProtocol()
+        self.pending = collections.deque()  # Pipelined commands and sizes
+        self.pending_bytes = 0
+        self.released = set()  # Ids of objects whose proxies were deleted
+        self.released_time = None  # When the first of them was released
+        self.busy = 0  # Nesting depth of commands in progress
 
     def get_object(self, oid):
         """ Get the Py2Object with the given object id, or None. """
@@ -35,31 +58,97 @@ class Py2Client:
 
     def create_object(self, oid):
         """ Create a Py2Object with the given object id. """
+        # The server still holds the object if it was released since
+        self.released.discard(oid)
         obj = Py2Object(self, oid)
         self.objects[oid] = obj
         return obj
 
+    def release_object(self, obj):
+        """
+        Release the server's reference to the object of a deleted proxy.
+
+        The ids of released objects are sent with the next command (see
+        `_flush_released`).  Called from `Py2Object.__del__`, which may run
+        in the middle of another command.
+        """
+        oid = obj.__oid__
+        current = self.objects.get(oid)
+        if current is not None and current is not obj:
+            return  # Another proxy for the object was created since
+        if not self.released:
+            self.released_time = time.monotonic()
+        self.released.add(oid)
+        self._flush_released()
+
+    def _flush_released(self):
+        """
+        Send the ids of released objects on their own if no command is in
+        progress, and `RELEASE_BATCH_SIZE` have been released or the first
+        was released `RELEASE_DELAY` or more seconds ago.
+
+        This is checked on each release, after each command, and once the
+        responses to all pipelined commands have been read.  There is no
+        timer, so ids released while the client is idle wait for the next
+        release or command.
+        """
+        released = self.released
+        if released and not self.busy and not self.pending and (
+                len(released) >= RELEASE_BATCH_SIZE
+                or time.monotonic() - self.released_time >= RELEASE_DELAY):
+            self.do_command('ping')
+
+    def _add_released(self, data):
+        """
+        Add the ids of released objects to a command, and return them.
+
+        Nothing is added while responses to pipelined commands are pending,
+        since the responses could refer to the objects again.  The server
+        releases the objects before running the command.
+        """
+        if not self.released or self.pending:
+            return ()
+        release = data['release'] = list(self.released)
+        self.released.clear()
+        return release
+
     def _send(self, data):
+        release = self._add_released(data)
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Sending: {!r}".format(data))
-        self.outfile.write(json.dumps(data).encode())
-        self.outfile.write(b'\n')
-        self.outfile.flush()
+        try:
+            self.protocol.write(self.outfile, data)
+        except Exception:
+            self.released.update(release)  # The server discards the message
+            raise
 
     def _receive(self):
-        data = json.loads(self.infile.readline().decode())
+        data = self.protocol.read(self.infile)
+        if data is None:
+            raise EOFError("Python 2 server closed the connection")
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Received: {!r}".format(data))
         return data
 
-    def encode_command(self, command, *args):
-        session = self.codec.encoding_session()
+    def encode_command(self, command, *args, **options):
+        """
+        Encode a command.
+
+        Keyword arguments are passed to the encoding session for the
+        arguments.
+        """
+        session = self.codec.encoding_session(**options)
         return dict(command=command,
                     args=[session.encode(arg) for arg in args])
 
-    def decode_result(self, data):
+    def decode_result(self, data, **options):
+        """
+        Decode a command result, or raise an exception if the command failed.
+
+        Keyword arguments are passed to the decoding session for the result.
+        """
         if data['result'] == 'return':
-            return self.codec.decode(data['value'])
+            return self.codec.decode(data['value'], **options)
         elif data['result'] == 'raise':
             exception_type = Py2Error
             if data['types']:
@@ -78,11 +167,196 @@ class Py2Client:
             raise Exception("Invalid server response: result={!r}".format(
                 data['result']))
 
-    def do_command(self, command, *args):
-        self._send(self.encode_command(command, *args))
-        return self.decode_result(self._receive())
+    def do_command(self, command, *args, encode_options=None, **options):
+        """
+        Send a command to the server and return its decoded result.
+
+        `encode_options` are passed to the encoding session for the arguments,
+        and other keyword arguments to the decoding session for the result.
+        """
+        encode_options = encode_options or {}
+        self.busy += 1
+        try:
+            if self.pending:
+                self.resolve_pending()
+            try:
+                self._send(self.encode_command(command, *args,
+                                               **encode_options))
+                data = self._receive()
+                while data['result'] == 'cache_miss':
+                    # Our argument cache was out of sync with the server's
+                    self.codec.arg_cache.discard(data['digest'])
+                    self._send(self.encode_command(command, *args,
+                                                   **encode_options))
+                    data = self._receive()
+            finally:
+                # The server has read the command, or never will
+                self.protocol.release_blobs()
+            result = self.decode_result(data, **options)
+        finally:
+            self.busy -= 1
+        # Objects may have been released while the command ran
+        self._flush_released()
+        return result
+
+    def send_command(self, command, *args, **options):
+        """
+        Send a command without waiting for its response, and return a
+        `Py2Future` for its result.
+
+        Keyword arguments are passed to the decoding session for the result.
+        Pipelined commands do not use the argument cache, since a cache miss
+        would make the server skip a command and run the ones after it.
+        """
+        self.busy += 1
+        try:
+            data = self.encode_command(command, *args, arg_cache=False)
+            if self.pending:
+                # Tell the server that we may not have read all of its
+                # responses, so that it keeps their blobs
+                data['pipelined'] = True
+            release = self._add_released(data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sending: {!r}".format(data))
+            # The command is pending while it is written, so that the blobs
+            # written for it are not released when the earlier commands'
+            # responses are read to make room for it
+            future = Py2Future(self)
+            self.pending.append((future, 0, options))
+            writer = _PipelineWriter(self)
+            try:
+                self.protocol.write(writer, data)
+            except Exception:
+                self.pending.pop()
+                self.released.update(release)
+                raise
+            self.pending[-1] = (future, writer.size, options)
+            self.pending_bytes += writer.size
+            return future
+        finally:
+            self.busy -= 1
+
+    def in_flight(self):
+        """ Return the number of pipelined commands awaiting responses. """
+        return len(self.pending)
+
+    def resolve_next(self):
+        """ Read the response to the oldest pipelined command. """
+        future, size, options = self.pending.popleft()
+        self.pending_bytes -= size
+        self.busy += 1
+        try:
+            try:
+                data = self._receive()
+            except Exception as e:
+                future._set_exception(e)
+                raise
+            finally:
+                if not self.pending:
+                    # The server has read all the commands
+                    self.protocol.release_blobs()
+            try:
+                future._set_result(self.decode_result(data, **options))
+            except Exception as e:
+                future._set_exception(e)
+        finally:
+            self.busy -= 1
+        self._flush_released()
+
+    def resolve_pending(self):
+        """ Read the responses to all pipelined commands. """
+        while self.pending:
+            self.resolve_next()
+
+    @property
+    def bytes_saved(self):
+        """ Number of bytes saved by compressing messages. """
+        return self.protocol.bytes_saved
+
+    def negotiate(self, protocols, cycles=True, compress_level=None,
+                  compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                  string_table_size=0, arg_cache_size=0, ndarrays=False,
+                  blob_threshold=0):
+        """
+        Negotiate session options with the server.
+
+        :param protocols: Names of acceptable protocols, in order of
+            preference.  If the server supports none of them, the current
+            protocol is kept.
+        :param cycles: Whether to support shared and circular references when
+            encoding values.
+        :param compress_level: If not None, compress messages with zlib at
+            this level (binary protocol only).
+        :param compress_threshold: Minimum size in bytes of messages to
+            compress.
+        :param string_table_size: If nonzero, intern strings in string tables
+            of this size (binary protocol only).
+        :param arg_cache_size: If nonzero, cache large immutable arguments on
+            the server, up to this many bytes.
+        :param ndarrays: Whether to encode NumPy arrays as values, if NumPy is
+            installed on both sides.
+        :param blob_threshold: If nonzero, send strings of at least this many
+            bytes as shared-memory blobs (binary protocol only).
+        """
+        options = dict(protocols=protocols, cycles=cycles)
+        if compress_level is not None:
+            options.update(compress_level=compress_level,
+                           compress_threshold=compress_threshold)
+        if string_table_size:
+            options.update(string_table=string_table_size)
+        if arg_cache_size:
+            options.update(arg_cache=arg_cache_size)
+        if blob_threshold:
+            options.update(blob_threshold=blob_threshold)
+        if ndarrays and importlib.util.find_spec('numpy') is not None:
+            options.update(ndarrays=True)
+        settings = self.do_command('negotiate', options)
+        if settings.get('protocol') is not None:
+            self.protocol = get_protocol(settings['protocol'],
+                                         settings.get('compression'),
+                                         settings.get('string_table'),
+                                         settings.get('blob_threshold'))
+            self.codec.binary = self.protocol.binary
+        self.codec.cycles = settings.get('cycles', True)
+        self.codec.ndarrays = settings.get('ndarrays', False)
+        if settings.get('arg_cache'):
+            self.codec.arg_cache = ClientArgumentCache(
+                settings['arg_cache'], self.codec.client,
+                binary=self.codec.binary)
 
     def close(self):
         with contextlib.ExitStack() as stack:
             stack.callback(self.infile.close)
             stack.callback(self.outfile.close)
+
+
+class _PipelineWriter:
+    """
+    File which writes a pipelined command to the client's output as it is
+    serialized.
+
+    Before each write, responses to earlier commands are read until the
+    commands in flight fit in `PIPELINE_BYTES`.  Serializing a command
+    updates the protocol's string tables and writes its blobs, so an error
+    reading a response does not stop the command from being sent; the error
+    is raised by the earlier command's future.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.size = 0  # Bytes written so far
+
+    def write(self, data):
+        client = self.client
+        # The last pending command is the one being written
+        while (len(client.pending) > 1 and client.pending_bytes + self.size
+               + len(data) > PIPELINE_BYTES):
+            try:
+                client.resolve_next()
+            except Exception:
+                pass  # Set on the command's future
+        client.outfile.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.client.outfile.flush()
@@ -1,30 +1,164 @@
+import collections
+import hashlib
 import weakref
 
+from python2.client.lazy import LazyDict, LazyList
 from python2.client.object import Py2Object
-from python2.shared.codec import BaseDecodingSession, BaseEncodingSession
+from python2.shared import binary as binary_format
+from python2.shared.argcache import ArgumentCache
+from python2.shared.codec import (BaseDecodingSession, BaseEncodingSession,
+                                  CacheIndexer, EncodingDepth, Placeholder)
 
 
 class ClientCodec():
     def __init__(self, client):
         self.client = weakref.proxy(client)
+        self.binary = False
+        self.cycles = True
+        self.arg_cache = None
+        self.ndarrays = False
 
-    def encoding_session(self):
-        return ClientEncodingSession(self.client)
+    def encoding_session(self, arg_cache=True, **options):
+        return ClientEncodingSession(self.client, binary=self.binary,
+                                     cycles=self.cycles,
+                                     arg_cache=(self.arg_cache if arg_cache
+                                                else None),
+                                     ndarrays=self.ndarrays, **options)
 
-    def encode(self, obj):
-        return self.encoding_session().encode(obj)
+    def encode(self, obj, **options):
+        return self.encoding_session(**options).encode(obj)
+
+    def decoding_session(self, lazy=False, **options):
+        session_type = LazyDecodingSession if lazy else ClientDecodingSession
+        return session_type(self.client, binary=self.binary,
+                            cycles=self.cycles, **options)
+
+    def decode(self, obj, **options):
+        return self.decoding_session(**options).decode(obj)
+
+
+_immutable_scalar_types = frozenset({
+    type(None), bool, int, float, complex, bytes, str
+})
+
+
+def _is_immutable(obj):
+    """
+    Return whether a tuple or frozenset contains only immutable scalars and
+    other such tuples and frozensets.
+    """
+    stack = [obj]
+    while stack:
+        for item in stack.pop():
+            t = type(item)
+            if t is tuple or t is frozenset:
+                stack.append(item)
+            elif t not in _immutable_scalar_types:
+                return False
+    return True
+
+
+class ClientArgumentCache(ArgumentCache):
+    """
+    Client mirror of the server's argument cache (see
+    `python2.shared.argcache`).
+
+    Tuples and frozensets of at least `min_length` items, containing only
+    immutable values, are fingerprinted by hashing their serialized encoding.
+    Values whose encoding is smaller than `min_size` bytes are not cached.
+    The fingerprints of the last `memo_size` values are remembered by object
+    identity, which keeps those objects alive.
+    """
+
+    min_length = 16
+    min_size = 4096
+    memo_size = 32
 
-    def decoding_session(self):
-        return ClientDecodingSession(self.client)
+    def __init__(self, budget, client, binary=False):
+        super(ClientArgumentCache, self).__init__(budget)
+        self.client = client
+        self.binary = binary
+        self._memo = collections.OrderedDict()  # id -> (obj, fingerprint)
+        self._last = None  # Last value encoded, and its encoding
+
+    def fingerprint(self, obj):
+        """
+        Return the digest and size of a value, or None if it should not be
+        cached.
+        """
+        key = id(obj)
+        entry = self._memo.pop(key, None)
+        if entry is not None and entry[0] is obj:
+            fingerprint = entry[1]
+        else:
+            fingerprint = None
+            if len(obj) >= self.min_length and _is_immutable(obj):
+                node = self.encode(obj)
+                data = binary_format.dumps(node)
+                if self.min_size <= len(data) <= self.budget:
+                    fingerprint = hashlib.sha256(data).hexdigest(), len(data)
+                    self._last = obj, node
+            if len(self._memo) >= self.memo_size:
+                self._memo.popitem(last=False)
+        self._memo[key] = obj, fingerprint
+        return fingerprint
 
-    def decode(self, obj):
-        return self.decoding_session().decode(obj)
+    def encode(self, obj):
+        """ Encode a value independently of any other session. """
+        last, self._last = self._last, None
+        if last is not None and last[0] is obj:
+            return last[1]
+        return ClientEncodingSession(self.client, binary=self.binary,
+                                     cycles=False).encode(obj)
 
 
 class ClientEncodingSession(BaseEncodingSession):
-    def __init__(self, client):
-        super(ClientEncodingSession, self).__init__()
+    def __init__(self, client, binary=False, cycles=True, arg_cache=None,
+                 pickle=False, ndarrays=False):
+        super(ClientEncodingSession, self).__init__(binary=binary,
+                                                    cycles=cycles,
+                                                    pickle=pickle,
+                                                    ndarrays=ndarrays)
         self.client = client
+        self.arg_cache = arg_cache
+        self._arguments = frozenset()  # Ids of values which may be cached
+        if arg_cache is not None:
+            cacheable = type(self)._enc_cacheable
+            self._encoders.update({tuple: cacheable, frozenset: cacheable})
+
+    def encode(self, obj, depth=EncodingDepth.DEEP):
+        if self.arg_cache is not None:
+            # Only arguments are cached: the value itself, and the items of
+            # a tuple or dict (such as a call's positional and keyword
+            # arguments), not the values nested in them
+            t = type(obj)
+            if t is tuple:
+                values = obj
+            elif t is dict:
+                values = obj.values()
+            else:
+                values = ()
+            self._arguments = frozenset(map(id, values)) | {id(obj)}
+        return super(ClientEncodingSession, self).encode(obj, depth)
+
+    def _enc_cacheable(self, obj, depth):
+        """
+        Encode a tuple or frozenset by digest, if it is in the argument cache,
+        or add it to the cache if it qualifies.
+        """
+        fingerprint = None
+        if depth < 0 and id(obj) in self._arguments:
+            # Only arguments encoded in full can be cached
+            fingerprint = self.arg_cache.fingerprint(obj)
+        if fingerprint is None:
+            return self.encoders[type(obj)](self, obj, depth)
+        digest, size = fingerprint
+        if digest in self.arg_cache:
+            self.arg_cache.get(digest)  # Mark as recently used
+            return dict(type='digest', digest=digest)
+        self.arg_cache.put(digest, size)
+        return dict(type='content', digest=digest, size=size,
+                    value=self.arg_cache.encode(obj))
 
     def _enc_ref(self, obj):
         """ Encode an object as a reference. """
@@ -39,8 +173,12 @@ class ClientEncodingSession(BaseEncodingSession):
 
 
 class ClientDecodingSession(BaseDecodingSession):
-    def __init__(self, client):
-        super(ClientDecodingSession, self).__init__()
+    def __init__(self, client, binary=False, cycles=True, arrays=False,
+                 columns=False):
+        super(ClientDecodingSession, self).__init__(binary=binary,
+                                                    cycles=cycles,
+                                                    arrays=arrays,
+                                                    columns=columns)
         self.client = client
 
     def _dec_ref(self, data):
@@ -50,3 +188,129 @@ class ClientDecodingSession(BaseDecodingSession):
         if obj is None:
             obj = self.client.create_object(oid)
         return obj
+
+
+class LazyDecodingSession(ClientDecodingSession):
+    """
+    Client decoder which decodes lists and dicts lazily.
+
+    Lists and dicts are decoded as `LazyList` and `LazyDict` views, which
+    decode their items on first access.  Other objects are decoded when
+    their parent is accessed.  The session is kept alive by the views.
+
+    Object references are decoded up front, and their proxies are kept by
+    the session, so that the server's references are released with the
+    views whether or not the items were accessed.
+
+    Cache pointers may be decoded in any order, so the session uses a
+    `CacheIndexer` to find the node for each cache index, and remembers the
+    decoded object for each node so that shared references are preserved.
+    """
+
+    def __init__(self, client, **options):
+        super(LazyDecodingSession, self).__init__(client, **options)
+        self.session = {}  # Decoded objects by node id
+        self.objects = {}  # Proxies of referenced objects by object id
+        self.data = None
+        self.indexer = None
+        self.materialized = None
+        self._current_key = None
+
+    def decode(self, data):
+        self.data = data
+        if self.cycles:
+            self.indexer = CacheIndexer(data, binary=self.binary)
+        self._decode_refs(data)
+        return self.decode_item(data)
+
+    def _decode_refs(self, data):
+        """ Create a proxy for every object reference in the data. """
+        binary = self.binary
+        objects = self.objects
+        dec_ref = super(LazyDecodingSession, self)._dec_ref
+        stack = [data]
+        while stack:
+            data = stack.pop()
+            if binary and type(data) is not dict:
+                continue
+            dtype = data['type']
+            if dtype == 'ref':
+                oid = data['id']
+                if oid not in objects:
+                    objects[oid] = dec_ref(data)
+            elif dtype in ('list', 'tuple', 'set', 'frozenset'):
+                stack.extend(data['items'])
+            elif dtype == 'dict':
+                for item in data['items']:
+                    stack.append(item['key'])
+                    stack.append(item['value'])
+            elif dtype == 'slice':
+                stack.extend((data['start'], data['stop'], data['step']))
+
+    def decode_item(self, data):
+        """ Decode an encoded object within the session's data. """
+        return super(LazyDecodingSession, self).decode(data)
+
+    def materialize(self, node):
+        """ Return the fully decoded object for a node. """
+        if not self.cycles:
+            # Without cache pointers, the node can be decoded on its own
+            return self._eager_session().decode(node)
+        if self.materialized is None:
+            session = self._eager_session()
+            session.decode(self.data)
+            self.materialized = session.session
+        return self.materialized[self.indexer.index(node)]
+
+    def _eager_session(self):
+        return ClientDecodingSession(self.client, binary=self.binary,
+                                     cycles=self.cycles, arrays=self.arrays,
+                                     columns=self.columns)
+
+    def _dec(self, data):
+        if self.binary and type(data) is not dict:
+            return data
+
+        dtype = data['type']
+
+        if dtype == 'ref':
+            return self._dec_ref(data)
+
+        if dtype == 'cached':
+            if not self.cycles:
+                raise ValueError("Unexpected cache reference with cycles"
+                                 " disabled")
+            return self._dec(self.indexer.node(data['index']))
+
+        key = id(data)
+        obj = self.session.get(key, Placeholder)
+        if obj is not Placeholder:
+            return obj
+
+        try:
+            decoder = self.decoders[dtype]
+        except KeyError:
+            raise TypeError("Invalid data type: {}".format(dtype))
+
+        self._current_key = key
+        obj = decoder(self, data)
+        if obj is not Placeholder:
+            # Otherwise, the object is cached when created
+            self.session[key] = obj
+        return obj
+
+    def _cache_key(self):
+        return self._current_key
+
+    def _dec_ref(self, data):
+        return self.objects[data['id']]
+
+    def _dec_list(self, data):
+        return LazyList(self, data)
+
+    def _dec_dict(self, data):
+        return LazyDict(self, data)
+
+    decoders = dict(ClientDecodingSession.decoders,
+                    list=_dec_list,
+                    dict=_dec_dict)
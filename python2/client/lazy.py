@@ -0,0 +1,105 @@
+"""
+Lazily decoded container views.
+
+These are returned in place of lists and dicts when decoding with a
+`LazyDecodingSession` (see `python2.client.codec`).  Each view holds the
+encoded items of its container and decodes each item on first access.
+"""
+
+import collections.abc
+import reprlib
+
+
+_UNDECODED = object()
+
+
+class LazyList(collections.abc.Sequence):
+    """ Read-only view of a lazily decoded list. """
+
+    __slots__ = ('_session', '_node', '_values')
+    __hash__ = None
+
+    def __init__(self, session, node):
+        self._session = session
+        self._node = node
+        self._values = [_UNDECODED] * len(node['items'])
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        value = self._values[index]
+        if value is _UNDECODED:
+            value = self._session.decode_item(self._node['items'][index])
+            self._values[index] = value
+        return value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, LazyList)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            x == y for x, y in zip(self, other))
+
+    @reprlib.recursive_repr()
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self))
+
+    def materialize(self):
+        """ Return the fully decoded list. """
+        return self._session.materialize(self._node)
+
+
+class LazyDict(collections.abc.Mapping):
+    """
+    Read-only view of a lazily decoded dict.
+
+    All keys are decoded on first access to the view.  Values are decoded on
+    first access to each value.
+    """
+
+    __slots__ = ('_session', '_node', '_positions', '_values')
+    __hash__ = None
+
+    def __init__(self, session, node):
+        self._session = session
+        self._node = node
+        self._positions = None  # Position of each key's item in the node
+        self._values = {}
+
+    def _keys(self):
+        if self._positions is None:
+            decode = self._session.decode_item
+            self._positions = {decode(kv['key']): i
+                               for i, kv in enumerate(self._node['items'])}
+        return self._positions
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __contains__(self, key):
+        return key in self._keys()
+
+    def __getitem__(self, key):
+        i = self._keys()[key]
+        value = self._values.get(i, _UNDECODED)
+        if value is _UNDECODED:
+            value = self._session.decode_item(self._node['items'][i]['value'])
+            self._values[i] = value
+        return value
+
+    @reprlib.recursive_repr()
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def materialize(self):
+        """ Return the fully decoded dict. """
+        return self._session.materialize(self._node)
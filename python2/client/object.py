@@ -235,8 +235,8 @@ class Py2Object:
 
     def __del__(self):
         try:
-            logger.debug("Deleting object {}".format(self.__oid__))
-            self.__client__.do_command('del', self)
+            logger.debug("Releasing object {}".format(self.__oid__))
+            self.__client__.release_object(self)
         except Exception:
             logger.debug("Delete failed", exc_info=True)
             pass  # Session may have already ended
@@ -0,0 +1,94 @@
+class Py2Future:
+    """
+    Result of a pipelined command.
+
+    The result is available once the command's response has been read.
+    Responses are read in order, as results are requested or as the pipeline
+    needs room for more commands.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """ Return whether the command's response has been read. """
+        return self._done
+
+    def result(self):
+        """
+        Return the command's result, waiting for it if needed, or raise the
+        command's exception (usually a `Py2Error`).
+        """
+        self._wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """
+        Return the exception raised by the command, waiting for it if needed,
+        or None if the command succeeded.
+        """
+        self._wait()
+        return self._exception
+
+    def _wait(self):
+        while not self._done:
+            self._client.resolve_next()
+
+    def _set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+
+class Pipeline:
+    """
+    Sends commands to Python 2 without waiting for their results.
+
+    Each method sends a command and returns a `Py2Future` for its result.  At
+    most `max_in_flight` commands are sent before their responses are read.
+    Exiting the pipeline's context reads all remaining responses.  Any other
+    command sent in the meantime first waits for the pipelined commands.
+    """
+
+    def __init__(self, client, max_in_flight):
+        if max_in_flight < 1:
+            raise ValueError("Invalid maximum number of commands in flight:"
+                             " {!r}".format(max_in_flight))
+        self._client = client
+        self.max_in_flight = max_in_flight
+
+    def call(self, func, *args, **kwargs):
+        """ Call a Python 2 function. """
+        return self._send('call', func, args, kwargs)
+
+    def lift(self, obj):
+        """ Lift an object to Python 3 (see `Python2.lift`). """
+        return self._send('lift', obj)
+
+    def deeplift(self, obj):
+        """ Recursively lift an object (see `Python2.deeplift`). """
+        return self._send('deeplift', obj)
+
+    def _send(self, command, *args):
+        client = self._client
+        while client.in_flight() >= self.max_in_flight:
+            client.resolve_next()
+        return client.send_command(command, *args)
+
+    def wait(self):
+        """ Read the responses to all commands sent so far. """
+        self._client.resolve_pending()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wait()
@@ -0,0 +1,66 @@
+"""
+Streaming reader for large Python 2 byte strings.
+"""
+
+import io
+
+
+class Py2Reader(io.RawIOBase):
+    """
+    Seekable raw binary stream over a Python 2 `str`, `bytearray`, or
+    `buffer` object.
+
+    Each call to `readinto` fetches at most `chunk_size` bytes from the
+    Python 2 process, so only one chunk of the data is held in memory at a
+    time.
+    """
+
+    def __init__(self, client, obj, chunk_size):
+        self._client = client
+        self._obj = obj
+        self._chunk_size = chunk_size
+        self._pos = 0
+        self._size = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        self._checkClosed()
+        size = min(len(b), self._chunk_size)
+        if not size:
+            return 0
+        data = self._client.do_command('read_bytes', self._obj, self._pos,
+                                       size)
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+        return n
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            if self._size is None:
+                self._size = self._client.do_command('len', self._obj)
+            pos = self._size + offset
+        else:
+            raise ValueError("Invalid whence: {!r}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def close(self):
+        self._obj = None
+        super().close()
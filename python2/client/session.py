@@ -1,8 +1,15 @@
 import contextlib
+import io
 import os
+import socket
 import subprocess
 
 from python2.client.client import Py2Client
+from python2.client.pipeline import Pipeline
+from python2.client.reader import Py2Reader
+from python2.shared import shm
+from python2.shared.protocol import (DEFAULT_COMPRESS_THRESHOLD,
+                                     DEFAULT_STRING_TABLE_SIZE)
 
 
 class Python2:
@@ -16,7 +23,12 @@ class Python2:
     """
 
     def __init__(self, executable='python',
-                 logging_basic=None, logging_dict=None):
+                 logging_basic=None, logging_dict=None, protocol='json',
+                 cycles=True, compress_level=None,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 string_table_size=None,
+                 arg_cache_size=0, ndarrays=True, transport='pipe',
+                 blob_threshold=None):
         """
         Initialize a Python2 instance.
 
@@ -25,7 +37,68 @@ class Python2:
             in the Python 2 process.
         :param logging_dict: Dict to pass to `logging.dictConfig()` in the
             Python 2 process.
+        :param protocol: Protocol to use for communication with the Python 2
+            process, either `'json'` (default) or `'binary'`.  The binary
+            protocol is faster for large or string-heavy values, but slower
+            for small commands.  If the requested protocol is not supported,
+            JSON will be used instead.  With JSON, values nested more than
+            about 500 levels deep cannot be passed in either direction; use
+            the binary protocol for deeper values.  Passing `compress_level`,
+            `string_table_size` or `blob_threshold` with another protocol
+            raises `ValueError`, since they only apply to the binary
+            protocol.
+        :param cycles: If false, values passed between Python 2 and 3 are
+            assumed not to contain shared or circular references.  Shared
+            objects will be copied, and circular references will raise an
+            exception.  This makes encoding and decoding values faster and
+            uses less memory.
+        :param compress_level: If not None, messages of at least
+            `compress_threshold` bytes are compressed with zlib at this level
+            (0-9, or -1 for the zlib default).  Requires the binary protocol.
+            See `Python2.bytes_saved`.
+        :param compress_threshold: Minimum size in bytes of messages to
+            compress (default 16 KiB).
+        :param string_table_size: Maximum number of short strings to
+            remember for the session (default 4096), in each direction.  A
+            remembered string is sent only once, and each later occurrence
+            refers to the same string object.  Once the table is full, the
+            oldest string is forgotten to make room for each new one.  Pass 0
+            to disable.  Requires the binary protocol.
+        :param arg_cache_size: If nonzero, large tuples and frozensets of
+            immutable values passed to Python 2 as arguments (not nested in
+            other values) are cached by the Python 2 process, up to this
+            many bytes of encoded data, so that passing an equal value again
+            sends only a digest of it.  The least recently used values are
+            evicted first.  Disabled by default.
+        :param ndarrays: If true (default) and NumPy is installed in both
+            Python 2 and 3, NumPy arrays of numeric, bool, string, and
+            datetime dtypes are lifted and projected as arrays, by copying
+            their raw data.  Decoded arrays are read-only; use their `copy()`
+            method to get a writable array.  Otherwise, arrays are always
+            passed by reference.
+        :param transport: How messages are passed to and from the Python 2
+            process, either `'pipe'` (default) or `'shm'`.  With `'shm'`,
+            messages are passed through ring buffers in shared memory, and
+            pipes are used only to wake a process waiting for the other.
+            This halves the number of system calls per command, and lets
+            each process briefly spin instead of sleeping when several CPUs
+            are available.  With a single CPU, pipes have lower latency for
+            small messages.
+        :param blob_threshold: Minimum size in bytes of strings and buffers
+            which are passed out of band in shared memory rather than in
+            messages (default 1 MiB), with either transport.  Each is written
+            to a file under ``/dev/shm``, which the receiving process maps
+            and removes.  The data of memoryviews and NumPy arrays received
+            this way is not copied again.  Pass 0 to disable.  Requires the
+            binary protocol.
         """
+        _check_compress_level(compress_level)
+        _check_binary_options(protocol, compress_level=compress_level,
+                              string_table_size=string_table_size,
+                              blob_threshold=blob_threshold)
+        if transport not in ('pipe', 'shm'):
+            raise ValueError("Invalid transport: {!r}".format(transport))
+
         if logging_dict is not None:
             logging_args = ['--logging-dict', repr(logging_dict)]
         elif logging_basic is not None:
@@ -51,32 +124,252 @@ class Python2:
             fcwrite = _try_fdopen(cwrite, 'wb')
             stack.push(_on_error(fcwrite.close))
 
+            server_args = ['--in', str(sread), '--out', str(swrite)]
+            pass_fds = [sread, swrite]
+            if transport == 'shm':
+                # The pipes are only used for wakeups
+                shm_fd = shm.create_file()
+                stack.callback(os.close, shm_fd)
+                fcread, fcwrite = shm.open_files(shm_fd, fcread, fcwrite)
+                server_args += ['--shm', str(shm_fd)]
+                pass_fds.append(shm_fd)
+
             self._proc = subprocess.Popen(
-                [executable, '-m', 'python2.server',
-                 '--in', str(sread), '--out', str(swrite)] + logging_args,
-                pass_fds=(sread, swrite),
+                [executable, '-m', 'python2.server'] + server_args
+                + logging_args,
+                pass_fds=pass_fds,
                 start_new_session=True,  # Avoid signal issues
                 universal_newlines=False)
 
             stack.push(_on_error(_kill, self._proc))
 
-            self._client = Py2Client(fcread, fcwrite)
+            self._start(fcread, fcwrite, protocol, cycles, compress_level,
+                        compress_threshold, string_table_size,
+                        arg_cache_size, ndarrays, blob_threshold)
+
+    @classmethod
+    def connect(cls, path, protocol='json', cycles=True,
+                compress_level=None,
+                compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                string_table_size=None,
+                arg_cache_size=0, ndarrays=True,
+                blob_threshold=None):
+        """
+        Connect to a Python 2 daemon listening on a Unix domain socket.
+
+        The daemon is started with ``python -m python2.server --listen
+        PATH``, and serves each connection in a new process forked from it,
+        with the modules it has already imported.  Shutting down the session
+        ends the connection, and leaves the daemon running.
+
+        :param path: Path of the daemon's socket.
+
+        The other parameters are the same as for `Python2()`.
+        """
+        _check_compress_level(compress_level)
+        _check_binary_options(protocol, compress_level=compress_level,
+                              string_table_size=string_table_size,
+                              blob_threshold=blob_threshold)
+        self = cls.__new__(cls)
+        self._proc = None
+        with contextlib.ExitStack() as stack:
+            # The socket stays open until both files are closed
+            sock = stack.enter_context(
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            sock.connect(path)
+            infile = sock.makefile('rb')
+            stack.push(_on_error(infile.close))
+            outfile = sock.makefile('wb')
+            stack.push(_on_error(outfile.close))
+            self._start(infile, outfile, protocol, cycles, compress_level,
+                        compress_threshold, string_table_size,
+                        arg_cache_size, ndarrays, blob_threshold)
+        return self
+
+    def _start(self, infile, outfile, protocol, cycles, compress_level,
+               compress_threshold, string_table_size, arg_cache_size,
+               ndarrays, blob_threshold):
+        """ Start a session with the server, and negotiate its options. """
+        self._client = Py2Client(infile, outfile)
+        if string_table_size is None:
+            string_table_size = DEFAULT_STRING_TABLE_SIZE
+        if blob_threshold is None:
+            blob_threshold = shm.DEFAULT_BLOB_THRESHOLD
+        if (protocol != 'json' or not cycles
+                or compress_level is not None or arg_cache_size
+                or ndarrays):
+            self._client.negotiate([protocol, 'json'], cycles=cycles,
+                                   compress_level=compress_level,
+                                   compress_threshold=compress_threshold,
+                                   string_table_size=string_table_size,
+                                   arg_cache_size=arg_cache_size,
+                                   ndarrays=ndarrays,
+                                   blob_threshold=blob_threshold)
+
+    @property
+    def bytes_saved(self):
+        """
+        Number of bytes saved by compressing messages sent to and received
+        from the Python 2 process.
+        """
+        return self._client.bytes_saved
+
+    def pipeline(self, max_in_flight=1000):
+        """
+        Return a `Pipeline` for sending many commands without waiting for
+        each result, to be used as a context manager::
+
+            with py2.pipeline() as p:
+                futures = [p.call(f, x) for x in xs]
+            results = [future.result() for future in futures]
+
+        Each pipelined command returns a `Py2Future`.  Results are read in
+        order, and a command's exception is raised by its future's
+        `result()` method.  At most `max_in_flight` commands are sent before
+        reading their results.
+        """
+        return Pipeline(self._client, max_in_flight)
 
     def ping(self):
         """ Send a test message to the Python 2 process. """
         return self._client.do_command('ping')
 
-    def project(self, obj):
-        """ Project an object into Python 2. """
+    def project(self, obj, pickle=False):
+        """
+        Project an object into Python 2.
+
+        If `pickle` is true and the object contains only plain builtin data
+        (None, bool, int, float, complex, bytes, str, bytearray, and lists,
+        tuples, dicts, sets, and frozensets of these), it is transferred as a
+        restricted pickle, which is faster for large values.  Other objects
+        are transferred as usual.
+        """
+        if pickle:
+            return self._client.do_command('project', obj,
+                                           encode_options=dict(pickle=True))
         return self._client.do_command('project', obj)
 
-    def lift(self, obj):
-        """ Lift an object from Python 2 to a native Python 3 object. """
-        return self._client.do_command('lift', obj)
+    def lift(self, obj, depth=None, spec=None):
+        """
+        Lift an object from Python 2 to a native Python 3 object.
+
+        By default, only the top-level object is converted, and its members
+        are returned as `Py2Object` references.
+
+        If `depth` is given, the object is converted to that depth instead,
+        where 0 means a reference and 1 is the default.
+
+        If `spec` is given, only the parts of the object that it selects are
+        returned, in a single round trip.  A spec is one of the following:
+
+        - `True`, to convert the object in full (like `deeplift`).
+        - `False` or an int, to convert the object to that depth, as above.
+        - A dict mapping keys to specs.  If the object is a dict, a dict of
+          the given keys is returned, with each value selected by its spec.
+          Otherwise, a dict of the object's attributes with the given names
+          is returned.  Missing keys or attributes are left out.
+        - A list holding a single spec.  If the object is a list or tuple,
+          each item is selected by the spec.  Otherwise, the object is
+          returned as a reference.
+
+        For example, ``py2.lift(obj, spec={'rows': [{'id': True, 'name':
+        True}]})`` returns ``{'rows': [{'id': ..., 'name': ...}, ...]}``.
+        """
+        if depth is not None:
+            if spec is not None:
+                raise ValueError("Cannot specify both depth and spec")
+            if type(depth) is not int or depth < 0:
+                raise ValueError("Invalid depth: {!r}".format(depth))
+            spec = depth
+        if spec is None:
+            return self._client.do_command('lift', obj)
+        return self._client.do_command('lift', obj, spec)
+
+    def deeplift(self, obj, arrays=False, columnar=False, lazy=False,
+                 pickle=False):
+        """
+        Recursively lift an object from Python 2 to 3.
+
+        With the JSON protocol, objects nested more than about 500 levels
+        deep raise `Py2Error`, since the Python 2 JSON encoder is recursive.
+        The binary protocol has no such limit.
+
+        Large lists and tuples whose elements are all ints, all floats, or all
+        bools are transferred as packed arrays.  If `arrays` is true, these
+        are returned as `array.array` objects rather than lists or tuples.
+
+        If `columnar` is true, large lists and tuples of records (dicts with
+        the same keys or tuples of the same length, containing only None,
+        bool, int, float, bytes, or unicode values) are transferred column by
+        column.  Records are returned as usual unless `columnar` is
+        `'columns'`, in which case each list of records is returned as a dict
+        mapping each key (or tuple index) to a list of values.  Records are
+        always copied, even if they occur more than once.
+
+        If `lazy` is true, lists and dicts are returned as read-only
+        `LazyList` and `LazyDict` views, which decode their items on first
+        access.  Use the views' `materialize()` method to get the fully
+        decoded list or dict.
+
+        If `pickle` is true and the object contains only plain builtin data
+        (None, bool, int, long, float, complex, str, unicode, bytearray, and
+        lists, tuples, dicts, sets, and frozensets of these), it is
+        transferred as a restricted pickle, which is faster for large values.
+        Shared and circular references are preserved, even if cycles are
+        disabled.  Other objects are transferred as usual.  This option
+        cannot be combined with the others.
+        """
+        if pickle:
+            if arrays or columnar or lazy:
+                raise ValueError("Cannot combine pickle with other options")
+            return self._client.do_command('deeplift', obj, False, True)
+        if not columnar:
+            return self._client.do_command('deeplift', obj, arrays=arrays,
+                                           lazy=lazy)
+        if columnar not in (True, 'columns'):
+            raise ValueError("Invalid columnar option: {!r}".format(columnar))
+        return self._client.do_command('deeplift', obj, True, arrays=arrays,
+                                       columns=(columnar == 'columns'),
+                                       lazy=lazy)
+
+    def lift_pages(self, obj, page_size=10000):
+        """
+        Recursively lift the items of a large Python 2 sequence or mapping,
+        one page at a time.
 
-    def deeplift(self, obj):
-        """ Recursively lift an object from Python 2 to 3. """
-        return self._client.do_command('deeplift', obj)
+        Returns an iterator over pages of at most `page_size` items, each
+        fetched from Python 2 as it is needed.  The pages of a mapping are
+        dicts, and the pages of other objects are lists.  Each page is lifted
+        as by `deeplift`.
+        """
+        if type(page_size) is not int or page_size < 1:
+            raise ValueError("Invalid page size: {!r}".format(page_size))
+        return self._pages(self._client.do_command('pages', obj), page_size)
+
+    def _pages(self, pager, page_size):
+        while True:
+            page = self._client.do_command('page', pager, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+
+    def open_reader(self, obj, chunk_size=1 << 20):
+        """
+        Open a Python 2 `str`, `bytearray`, or `buffer` object for reading as
+        a binary file.
+
+        Returns a seekable `io.BufferedReader`, which fetches the data from
+        Python 2 in chunks of at most `chunk_size` bytes as it is read, rather
+        than transferring the whole object at once.  With the JSON protocol,
+        each chunk is sent as base64 text, a third larger than the data and
+        encoded and decoded on each side; use the binary protocol to send
+        chunks as raw bytes.
+        """
+        if type(chunk_size) is not int or chunk_size < 1:
+            raise ValueError("Invalid chunk size: {!r}".format(chunk_size))
+        return io.BufferedReader(Py2Reader(self._client, obj, chunk_size),
+                                 buffer_size=chunk_size)
 
     def exec(self, code, scope={}):
         """ Execute code in Python 2 in the given scope. """
@@ -97,6 +390,8 @@ class Python2:
         except Exception:
             pass
 
+        if self._proc is None:
+            return  # Connected to a daemon
         try:
             self._proc.wait(timeout=1)
         except Exception:
@@ -111,6 +406,20 @@ class Python2:
         self.shutdown()
 
 
+def _check_compress_level(compress_level):
+    if compress_level is not None and not -1 <= compress_level <= 9:
+        raise ValueError("Invalid compression level: {!r}".format(
+            compress_level))
+
+
+def _check_binary_options(protocol, **options):
+    if protocol != 'binary':
+        for name, value in sorted(options.items()):
+            if value is not None:
+                raise ValueError("{} requires the binary protocol".format(
+                    name))
+
+
 def _on_error(fn, *args, **kwargs):
     """ Return a context exit function that invokes a callback on error. """
     def __exit__(exc_type, exc_value, traceback):
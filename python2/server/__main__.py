@@ -3,7 +3,9 @@ import ast
 import logging
 import os
 
+from python2.server import daemon
 from python2.server.server import Python2Server
+from python2.shared import shm
 
 
 logger = logging.getLogger(__name__)
@@ -15,12 +17,30 @@ def parse_args(args=None):
                         help="File descriptor for server input")
     parser.add_argument('--out', '-o', type=int, default=1,
                         help="File descriptor for server output")
+    parser.add_argument('--shm', type=int,
+                        help="File descriptor of shared memory to use for "
+                             "messages, with input and output used only for "
+                             "wakeups")
+    parser.add_argument('--listen', metavar='PATH',
+                        help="Run as a daemon, serving connections on a Unix "
+                             "domain socket at this path instead of input "
+                             "and output")
+    parser.add_argument('--preload', metavar='MODULE', action='append',
+                        default=[],
+                        help="Module for the daemon to import before serving "
+                             "connections; may be repeated")
+    parser.add_argument('--max-sessions', metavar='N', type=int,
+                        help="Maximum number of connections for the daemon "
+                             "to serve at once (default: no limit)")
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--logging-basic',
                        help="Keyword arguments for logging.basicConfig()")
     group.add_argument('--logging-dict',
                        help="Dict to pass to logging.config.dictConfig()")
-    return parser.parse_args(args=args)
+    conf = parser.parse_args(args=args)
+    if conf.max_sessions is not None and conf.max_sessions < 1:
+        parser.error("--max-sessions must be positive")
+    return conf
 
 
 def configure_logging(conf):
@@ -33,8 +53,13 @@ def configure_logging(conf):
 
 
 def run_server(conf):
-    server = Python2Server(os.fdopen(conf.in_, 'rb'),
-                           os.fdopen(conf.out, 'wb'))
+    infile = os.fdopen(conf.in_, 'rb')
+    outfile = os.fdopen(conf.out, 'wb')
+    if conf.shm is not None:
+        infile, outfile = shm.open_files(conf.shm, infile, outfile,
+                                         server=True)
+        os.close(conf.shm)
+    server = Python2Server(infile, outfile)
     logger.info('Python 2 server started')
     try:
         server.run()
@@ -48,7 +73,10 @@ def run_server(conf):
 def main(args=None):
     conf = parse_args(args)
     configure_logging(conf)
-    run_server(conf)
+    if conf.listen is not None:
+        daemon.serve(conf.listen, conf.preload, conf.max_sessions)
+    else:
+        run_server(conf)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,31 @@
+import itertools
 import weakref
 
-from python2.shared.codec import BaseDecodingSession, BaseEncodingSession
+from python2.shared.argcache import ArgumentCacheMiss
+from python2.shared.codec import (BaseDecodingSession, BaseEncodingSession,
+                                  EncodingDepth)
 
 
 class ServerCodec():
     def __init__(self, server):
         self.server = weakref.proxy(server)
+        self.binary = False
+        self.cycles = True
+        self.ndarrays = False
 
-    def encoding_session(self):
-        return ServerEncodingSession(self.server)
+    def encoding_session(self, projection=False, **options):
+        session_type = (ProjectionEncodingSession if projection
+                        else ServerEncodingSession)
+        return session_type(self.server, binary=self.binary,
+                            cycles=self.cycles, ndarrays=self.ndarrays,
+                            **options)
 
-    def encode(self, obj, depth):
-        return self.encoding_session().encode(obj, depth)
+    def encode(self, obj, depth, **options):
+        return self.encoding_session(**options).encode(obj, depth)
 
     def decoding_session(self):
-        return ServerDecodingSession(self.server)
+        return ServerDecodingSession(self.server, binary=self.binary,
+                                     cycles=self.cycles)
 
     def decode(self, obj):
         return self.decoding_session().decode(obj)
@@ -23,8 +34,13 @@ class ServerCodec():
 class ServerEncodingSession(BaseEncodingSession):
     """ Python 2 server object encoder. """
 
-    def __init__(self, server):
-        super(ServerEncodingSession, self).__init__()
+    def __init__(self, server, binary=False, cycles=True, records=False,
+                 pickle=False, ndarrays=False):
+        super(ServerEncodingSession, self).__init__(binary=binary,
+                                                    cycles=cycles,
+                                                    records=records,
+                                                    pickle=pickle,
+                                                    ndarrays=ndarrays)
         self.server = server
 
     def _enc_ref(self, obj):
@@ -33,11 +49,104 @@ class ServerEncodingSession(BaseEncodingSession):
         return dict(type='ref', id=id(obj))
 
 
+class Projected(object):
+    """ An object to be encoded to a given depth, within a projection. """
+
+    __slots__ = ('obj', 'depth')
+
+    def __init__(self, obj, depth):
+        self.obj = obj
+        self.depth = depth
+
+
+def project(obj, spec):
+    """
+    Select parts of an object according to a projection spec, for encoding
+    with a `ProjectionEncodingSession` at depth `EncodingDepth.DEEP`.
+
+    A spec is one of the following:
+
+    - True: The object is encoded in full.
+    - False, or a non-negative int: The object is encoded to the given
+      depth, where 0 means a reference.
+    - A dict mapping keys to specs: If the object is a dict, the result is a
+      dict of the object's keys equal to the given keys, with each value
+      projected by its spec.
+      Otherwise, the result is a dict of the object's attributes with the
+      given names.  Keys or attributes missing from the object are omitted.
+    - A list holding a single spec: If the object is a list or tuple, each
+      item is projected by the spec.  Otherwise, the object is encoded as a
+      reference.
+    """
+    if spec is True:
+        return obj
+    if spec is False:
+        return Projected(obj, EncodingDepth.REF)
+    if isinstance(spec, (int, long)) and spec >= 0:
+        return Projected(obj, spec)
+    if type(spec) is dict:
+        if isinstance(obj, dict):
+            # Use the object's own keys, which may differ in type from the
+            # spec's equal keys (such as str and unicode)
+            keys = dict(itertools.izip(obj, obj))
+            return {keys[key]: project(obj[key], subspec)
+                    for key, subspec in spec.iteritems() if key in keys}
+        result = {}
+        for name, subspec in spec.iteritems():
+            try:
+                value = getattr(obj, name)
+            except AttributeError:
+                continue
+            result[name] = project(value, subspec)
+        return result
+    if type(spec) is list and len(spec) == 1:
+        subspec, = spec
+        if not isinstance(obj, (list, tuple)):
+            return Projected(obj, EncodingDepth.REF)
+        if subspec is True:
+            return obj
+        items = [project(item, subspec) for item in obj]
+        return tuple(items) if isinstance(obj, tuple) else items
+    raise TypeError("Invalid projection spec: {!r}".format(spec))
+
+
+class ProjectionEncodingSession(ServerEncodingSession):
+    """
+    Encoder for objects returned by `project`, which encodes each
+    `Projected` object to its own depth.
+    """
+
+    def _enc(self, obj, depth):
+        if type(obj) is Projected:
+            obj, depth = obj.obj, obj.depth
+        return super(ProjectionEncodingSession, self)._enc(obj, depth)
+
+
 class ServerDecodingSession(BaseDecodingSession):
-    def __init__(self, server):
-        super(ServerDecodingSession, self).__init__()
+    def __init__(self, server, binary=False, cycles=True):
+        super(ServerDecodingSession, self).__init__(binary=binary,
+                                                    cycles=cycles)
         self.server = server
 
     def _dec_ref(self, data):
         """ Decode an object reference. """
         return self.server.cache_get(data['id'])
+
+    def _dec_content(self, data):
+        """ Decode an argument value and add it to the argument cache. """
+        value = ServerDecodingSession(self.server, binary=self.binary,
+                                      cycles=False).decode(data['value'])
+        self.server.arg_cache.put(data['digest'], data['size'], value)
+        return value
+
+    def _dec_digest(self, data):
+        """ Look up an argument value by digest in the argument cache. """
+        arg_cache = self.server.arg_cache
+        digest = data['digest']
+        if arg_cache is None or digest not in arg_cache:
+            raise ArgumentCacheMiss(digest)
+        return arg_cache.get(digest)
+
+    decoders = dict(BaseDecodingSession.decoders,
+                    content=_dec_content,
+                    digest=_dec_digest)
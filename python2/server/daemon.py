@@ -0,0 +1,90 @@
+"""
+Python 2 server daemon.
+
+The daemon listens on a Unix domain socket and serves each client connection
+in a child process forked from it, with its own `Python2Server` and object
+table.  Clients thus skip the cost of starting an interpreter, and share the
+modules imported by the daemon before it started listening, while staying
+isolated from each other.
+"""
+
+import importlib
+import logging
+import os
+import signal
+import SocketServer
+
+from python2.server.server import Python2Server
+
+
+logger = logging.getLogger(__name__)
+
+
+class Python2Daemon(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    """
+    Unix socket server which forks a Python 2 server per connection.
+
+    At most `max_children` sessions are served at once; while that many are
+    running, the daemon waits for one to end before accepting another
+    connection.  The default of infinity never waits.
+    """
+
+    max_children = float('inf')
+
+    def server_bind(self):
+        # Only the daemon's user may connect, since clients can run any code
+        umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    """ Serves a connection in a child process. """
+
+    def handle(self):
+        self.server.socket.close()  # Only the daemon accepts connections
+        fd = self.request.fileno()
+        infile = os.fdopen(os.dup(fd), 'rb')
+        outfile = os.fdopen(os.dup(fd), 'wb')
+        try:
+            logger.info('Python 2 server started for connection')
+            Python2Server(infile, outfile).run()
+        except Exception:
+            logger.error('Python 2 server aborting', exc_info=True)
+            raise
+        else:
+            logger.info('Python 2 server exited cleanly')
+        finally:
+            infile.close()
+            outfile.close()
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(path, preload=(), max_sessions=None):
+    """
+    Serve connections on a Unix domain socket at `path` until the process is
+    terminated, then remove the socket.  The modules named in `preload` are
+    imported first, so that each connection starts with them imported.  If
+    `max_sessions` is given, at most that many connections are served at
+    once, and further clients wait until a session ends.
+    """
+    for name in preload:
+        importlib.import_module(name)
+    daemon = Python2Daemon(path, _Handler)
+    if max_sessions is not None:
+        daemon.max_children = max_sessions
+    try:
+        signal.signal(signal.SIGTERM, _terminate)
+        logger.info('Python 2 daemon listening on {}'.format(path))
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Python 2 daemon exiting')
+        daemon.server_close()
+        os.unlink(path)
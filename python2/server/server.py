@@ -1,15 +1,22 @@
 # TODO: Logging
 
 import __builtin__
+import collections
 from functools import wraps
-import json
+import itertools
 import logging
 import operator
+import pkgutil
 import sys
 import traceback
 
-from python2.server.codec import ServerCodec
+from python2.server.codec import ServerCodec, project
+from python2.shared.argcache import ArgumentCache, ArgumentCacheMiss
 from python2.shared.codec import EncodingDepth
+from python2.shared.protocol import (DEFAULT_COMPRESS_THRESHOLD,
+                                     BinaryProtocol, JsonProtocol,
+                                     MessageAborted, get_protocol,
+                                     select_protocol)
 
 
 logger = logging.getLogger(__name__)
@@ -19,12 +26,12 @@ def _command(edepth=EncodingDepth.REF):
     def wrapper(func):
         @wraps(func)
         def wrapped(self, *args):
+            # Encoding the result may fail, e.g. if it contains a circular
+            # reference and cycles are disabled.
             try:
-                result = func(self, *args)
+                return self._return(func(self, *args), edepth=edepth)
             except Exception:
                 return self._raise(*sys.exc_info())
-            else:
-                return self._return(result, edepth=edepth)
 
         return wrapped
 
@@ -34,11 +41,9 @@ def _command(edepth=EncodingDepth.REF):
 def _commandfunc(func, edepth=EncodingDepth.REF, name=None):
     def wrapped(self, *args):
         try:
-            result = func(*args)
+            return self._return(func(*args), edepth=edepth)
         except Exception:
             return self._raise(*sys.exc_info())
-        else:
-            return self._return(result, edepth=edepth)
 
     if name is None:
         name = func.__name__
@@ -52,6 +57,21 @@ def _reflect(obj):
     return obj
 
 
+class _Pager(object):
+    """
+    Iterator over pages of a sequence or mapping.  Pages of a mapping are
+    dicts, and pages of other objects are lists.
+    """
+
+    def __init__(self, obj):
+        self.mapping = isinstance(obj, collections.Mapping)
+        self.iterator = obj.iteritems() if self.mapping else iter(obj)
+
+    def next_page(self, size):
+        items = itertools.islice(self.iterator, size)
+        return dict(items) if self.mapping else list(items)
+
+
 class Python2Server(object):
     """ Python 2 server. """
 
@@ -60,6 +80,9 @@ class Python2Server(object):
         self.outfile = outfile
         self.objects = {}
         self.codec = ServerCodec(self)
+        self.protocol = JsonProtocol()
+        self.pending_settings = None
+        self.arg_cache = None
 
     def cache_add(self, obj):
         """ Add an object to the server cache. """
@@ -76,37 +99,76 @@ class Python2Server(object):
         logger.debug("Removing object {} from cache".format(oid))
         del self.objects[oid]
 
+    def cache_del_many(self, oids):
+        """
+        Delete objects by id from the server cache, ignoring ids which are not
+        in the cache.
+        """
+        logger.debug("Removing {} objects from cache".format(len(oids)))
+        objects = self.objects
+        for oid in oids:
+            objects.pop(oid, None)
+
     def _send(self, data):
-        json.dump(data, self.outfile)
-        self.outfile.write('\n')
-        self.outfile.flush()
+        self.protocol.write(self.outfile, data)
 
     def _receive(self):
-        line = self.infile.readline()
-        if line:
-            return json.loads(line)
+        return self.protocol.read(self.infile)
+
+    def _send_result(self, data):
+        """
+        Send the result of a command.  If the result cannot be serialized,
+        e.g. because it is nested too deeply for the JSON protocol, send the
+        exception instead.
+        """
+        try:
+            self._send(data)
+        except MessageAborted:
+            # The client reads the aborted message as an error
+            logger.warning('Failed to send result', exc_info=True)
+        except EnvironmentError:
+            raise
+        except Exception:
+            logger.warning('Failed to send result', exc_info=True)
+            self._send(self._raise(*sys.exc_info()))
+
+    def _apply_settings(self):
+        """ Apply settings from a previous `negotiate` command. """
+        settings, self.pending_settings = self.pending_settings, None
+        if settings.get('protocol') is not None:
+            logger.info("Switching to {} protocol".format(
+                settings['protocol']))
+            self.protocol = get_protocol(settings['protocol'],
+                                         settings.get('compression'),
+                                         settings.get('string_table'),
+                                         settings.get('blob_threshold'))
+            self.codec.binary = self.protocol.binary
+        self.codec.cycles = settings['cycles']
+        self.codec.ndarrays = settings.get('ndarrays', False)
+        if settings.get('arg_cache'):
+            self.arg_cache = ArgumentCache(settings['arg_cache'])
 
     def _args(self, data):
         session = self.codec.decoding_session()
         return [session.decode(arg) for arg in data['args']]
 
-    def _return(self, result, edepth):
+    def _return(self, result, edepth, **options):
         return dict(
-            result='return',
-            value=self.codec.encode(result, depth=edepth),
+            result=u'return',
+            value=self.codec.encode(result, depth=edepth, **options),
         )
 
     def _raise(self, exc_type, exc_value, exc_traceback):
         exc_value.__traceback__ = exc_traceback  # XXX: ?
         message = ''.join(traceback.format_exception_only(exc_type, exc_value))
         dct = dict(
-            result='raise',
+            result=u'raise',
             message=self.codec.encode(
                 unicode(message.rstrip('\n'), errors='replace'),
                 depth=EncodingDepth.DEEP),
             exception=self.codec.encode(exc_value, depth=EncodingDepth.REF),
             # TODO: More elegant way to do this?
-            types=[t.__name__ for t in exc_type.__mro__
+            types=[unicode(t.__name__) for t in exc_type.__mro__
                    if t is StopIteration or t is TypeError]
         )
 
@@ -117,14 +179,99 @@ class Python2Server(object):
         """ No-op command used to test client-server communication. """
         pass
 
+    @_command(edepth=EncodingDepth.DEEP)
+    def _do_negotiate(self, options):
+        """
+        Negotiate session options with the client.
+
+        Returns the chosen settings.  The new settings take effect once the
+        response has been sent.
+        """
+        protocol = select_protocol(options.get(u'protocols', ()))
+        compression = None
+        string_table = None
+        blob_threshold = None
+        if protocol == BinaryProtocol.name:
+            compress_level = options.get(u'compress_level')
+            if compress_level is not None:
+                compression = {
+                    u'level': int(compress_level),
+                    u'threshold': int(options.get(
+                        u'compress_threshold', DEFAULT_COMPRESS_THRESHOLD)),
+                }
+            string_table = int(options.get(u'string_table', 0)) or None
+            blob_threshold = int(options.get(u'blob_threshold', 0)) or None
+        settings = {
+            u'protocol': protocol,
+            u'cycles': bool(options.get(u'cycles', True)),
+            u'compression': compression,
+            u'string_table': string_table,
+            u'blob_threshold': blob_threshold,
+            u'arg_cache': int(options.get(u'arg_cache', 0)) or None,
+            # NumPy arrays are transferred as values if both sides have NumPy
+            u'ndarrays': (bool(options.get(u'ndarrays'))
+                          and pkgutil.find_loader('numpy') is not None),
+        }
+        self.pending_settings = settings
+        return settings
+
     # The following three commands all return the object passed in, but differ
     # in how the return value is encoded.
     _do_project = _commandfunc(_reflect, edepth=EncodingDepth.REF,
                                name='project')
-    _do_lift = _commandfunc(_reflect, edepth=EncodingDepth.SHALLOW,
-                            name='lift')
-    _do_deeplift = _commandfunc(_reflect, edepth=EncodingDepth.DEEP,
-                                name='deeplift')
+
+    def _do_lift(self, obj, spec=None):
+        """
+        Return an object encoded as a value.
+
+        If given, `spec` selects the parts of the object to encode (see
+        `python2.server.codec.project`).  Otherwise, only the top-level
+        object is encoded as a value.
+        """
+        try:
+            if spec is None:
+                return self._return(obj, edepth=EncodingDepth.SHALLOW)
+            return self._return(project(obj, spec), edepth=EncodingDepth.DEEP,
+                                projection=True)
+        except Exception:
+            return self._raise(*sys.exc_info())
+
+    def _do_deeplift(self, obj, columnar=False, pickle=False):
+        """
+        Return an object encoded recursively as a value.
+
+        If `columnar` is true, uniform lists of records are encoded as record
+        batches.  If `pickle` is true, plain data is encoded as a pickle.
+        """
+        try:
+            return self._return(obj, edepth=EncodingDepth.DEEP,
+                                records=bool(columnar), pickle=bool(pickle))
+        except Exception:
+            return self._raise(*sys.exc_info())
+
+    @_command()
+    def _do_pages(self, obj):
+        """ Return a pager for lifting a sequence or mapping in pages. """
+        return _Pager(obj)
+
+    @_command(edepth=EncodingDepth.DEEP)
+    def _do_page(self, pager, size):
+        """ Return the next page of at most `size` items from a pager. """
+        return pager.next_page(size)
+
+    @_command(edepth=EncodingDepth.DEEP)
+    def _do_read_bytes(self, obj, offset, size):
+        """
+        Return `size` bytes of a byte string, bytearray, or buffer, starting
+        at `offset`, as a byte string.
+        """
+        end = offset + size
+        if isinstance(obj, (str, buffer)):
+            return obj[offset:end]
+        elif isinstance(obj, (bytearray, memoryview)):
+            return memoryview(obj)[offset:end].tobytes()
+        raise TypeError("Cannot read bytes from {} object".format(
+            type(obj).__name__))
 
     # Objects returned by reference are stored in the server cache.  This
     # command is used to drop an object from the server cache.
@@ -232,10 +379,27 @@ class Python2Server(object):
         Read and execute commands until the input stream is closed or an
         exception is raised.
         """
-        data = self._receive()
-        while data:
-            # TODO: Handle protocol errors (e.g. invalid command)?
-            cmethod = getattr(self, '_do_{}'.format(data['command']))
-            args = self._args(data)
-            self._send(cmethod(*args))
+        try:
             data = self._receive()
+            while data:
+                # TODO: Handle protocol errors (e.g. invalid command)?
+                if not data.get(u'pipelined'):
+                    # The client has read the responses to all earlier
+                    # commands, so remove any of their blobs left unread
+                    self.protocol.release_blobs()
+                if u'release' in data:
+                    # Objects whose proxies the client has deleted
+                    self.cache_del_many(data[u'release'])
+                cmethod = getattr(self, '_do_{}'.format(data['command']))
+                try:
+                    args = self._args(data)
+                except ArgumentCacheMiss as e:
+                    # The client will send the command again with the value
+                    self._send(dict(result=u'cache_miss', digest=e.digest))
+                else:
+                    self._send_result(cmethod(*args))
+                if self.pending_settings is not None:
+                    self._apply_settings()
+                data = self._receive()
+        finally:
+            self.protocol.release_blobs()
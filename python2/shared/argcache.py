@@ -0,0 +1,71 @@
+"""
+Content-addressed cache of argument values.
+
+Large immutable values passed as command arguments may be cached by the
+server, so that the client can send a short digest of a value in place of
+the value itself when it is passed again.  Each cached value is identified by
+a digest of its encoding and has a size, which is the length in bytes of its
+serialized encoding.
+
+The server stores the decoded values.  The client keeps a mirror of the
+server's cache, without the values, to know which digests it may send.  Both
+sides update their caches in the same order with the same eviction policy, so
+they normally agree.  If they do not (for example, if a message failed to
+send), the server reports the missing digest, and the client sends the
+command again with the full value.
+"""
+
+import collections
+
+
+class ArgumentCache(object):
+    """
+    Least-recently-used cache of values by digest, limited to a total size of
+    `budget` bytes.  Values larger than the budget are not cached.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()  # digest -> (size, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, digest):
+        return digest in self._entries
+
+    def get(self, digest):
+        """
+        Return a cached value and mark it as recently used.  Raises KeyError
+        if the value is not cached.
+        """
+        size, value = self._entries.pop(digest)
+        self._entries[digest] = size, value
+        return value
+
+    def put(self, digest, size, value=None):
+        """ Add a value to the cache, evicting the oldest values as needed. """
+        self.discard(digest)
+        if size > self.budget:
+            return
+        entries = self._entries
+        while self.nbytes + size > self.budget:
+            _, (old_size, _) = entries.popitem(last=False)
+            self.nbytes -= old_size
+        entries[digest] = size, value
+        self.nbytes += size
+
+    def discard(self, digest):
+        """ Remove a value from the cache, if present. """
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            self.nbytes -= entry[0]
+
+
+class ArgumentCacheMiss(KeyError):
+    """ Raised by the server when an argument's digest is not cached. """
+
+    def __init__(self, digest):
+        super(ArgumentCacheMiss, self).__init__(digest)
+        self.digest = digest
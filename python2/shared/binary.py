@@ -0,0 +1,702 @@
+"""
+Compact binary serialization for Python 2 client/server messages.
+
+This module provides an alternative to JSON for serializing the messages
+exchanged between the client and server.  It supports the same basic value
+types as JSON, as well as byte strings, which are stored as raw bytes rather
+than as base64 text.
+
+Codec nodes (dicts produced by `python2.shared.codec`) are recognized by their
+``type`` key and written as a one-byte type code followed by the node's fields
+in a fixed order, so that type and field names are not repeated on the wire.
+Keys of other dicts are written once per message and referenced by index
+thereafter.
+
+Short strings may also be interned in a `StringTable`, which lasts for the
+life of a connection.  An interned string is written once and referenced by
+index in later messages, and the reader returns the same string object for
+each reference.  The writer and reader for a direction of a connection must
+each have a table of the same size.
+
+Each serialized value begins with a one-byte tag:
+
+    N, T, F     None, True, False
+    i           Signed 64-bit integer
+    I           Arbitrary-precision integer, as a length-prefixed
+                two's-complement byte string (see `int_to_bytes`)
+    f           IEEE 754 double
+    b           Length-prefixed byte string
+    u           Length-prefixed UTF-8 string
+    l           List: item count followed by items
+    m           Dict: item count followed by key/value pairs
+    n           Codec node: type code followed by node fields
+    k           Dict key, length-prefixed UTF-8 (only valid as a dict key)
+    K           Reference to a previous dict key by index
+    s, y        Like u and b, and adds the string to the string table
+    S           Reference to an interned string by index
+    B, U        Like b and u, stored out of band in a blob: the blob's
+                length-prefixed UTF-8 name, followed by its size as an
+                unsigned 64-bit integer
+
+Lengths, counts, and key indices are unsigned 32-bit integers, and type codes
+are unsigned 8-bit integers.  All numbers are big-endian.
+
+Blobs are written and read by the objects passed to `dump` and `loads` (see
+`python2.shared.shm`).  A blob in the data field of a memoryview, NumPy array,
+or `array.array` node is read as a buffer of the blob, so that it can be
+decoded without copying; other blobs are read as strings.
+
+A message may also be written and read in chunks with `dump` and `loads`, so
+that neither side needs to hold the whole serialized message in memory.
+"""
+
+import binascii
+import codecs
+import itertools
+import struct
+import sys
+
+
+PYTHON_VERSION = sys.version_info[0]
+if PYTHON_VERSION == 2:
+    _long = long  # noqa
+    _bytes = str
+    _unicode = unicode  # noqa
+    _range = xrange  # noqa
+    _items = dict.iteritems
+    _map = itertools.imap
+elif PYTHON_VERSION == 3:
+    _long = int
+    _bytes = bytes
+    _unicode = str
+    _range = range
+    _items = dict.items
+    _map = map
+else:
+    raise Exception("Unsupported Python version: {}".format(PYTHON_VERSION))
+
+
+if PYTHON_VERSION == 2:
+    def int_to_bytes(n):
+        """
+        Convert an integer to a big-endian two's-complement byte string, in
+        time linear in its size.
+        """
+        length = n.bit_length() // 8 + 1
+        if n < 0:
+            n += 1 << (8 * length)
+        return binascii.unhexlify('%0*x' % (2 * length, n))
+
+    def int_from_bytes(data):
+        """ Convert a big-endian two's-complement byte string to an int. """
+        if not data:
+            return 0
+        # Conversion from a power-of-two base takes linear time
+        n = long(binascii.hexlify(data), 16)  # noqa
+        if ord(data[0]) & 0x80:
+            n -= 1 << (8 * len(data))
+        return n
+else:
+    def int_to_bytes(n):
+        """
+        Convert an integer to a big-endian two's-complement byte string, in
+        time linear in its size.
+        """
+        return n.to_bytes(n.bit_length() // 8 + 1, 'big', signed=True)
+
+    def int_from_bytes(data):
+        """ Convert a big-endian two's-complement byte string to an int. """
+        return int.from_bytes(data, 'big', signed=True)
+
+
+# Codec node types and their fields, in wire order.  The position of each
+# entry is used as the type code, so new types must be added at the end.
+NODE_TYPES = (
+    ('ref', ('id',)),
+    ('cached', ('index',)),
+    ('None', ()),
+    ('NotImplemented', ()),
+    ('Ellipsis', ()),
+    ('bool', ('value',)),
+    ('int', ('value',)),
+    ('float', ('value',)),
+    ('complex', ('real', 'imag')),
+    ('bytes', ('data',)),
+    ('unicode', ('data',)),
+    ('bytearray', ('data',)),
+    ('range', ('start', 'stop', 'step')),
+    ('slice', ('start', 'stop', 'step')),
+    ('list', ('items',)),
+    ('tuple', ('items',)),
+    ('set', ('items',)),
+    ('frozenset', ('items',)),
+    ('dict', ('items',)),
+    ('array', ('tuple', 'typecode', 'data')),
+    ('records', ('tuple', 'length', 'keys', 'columns')),
+    ('bigint', ('data',)),
+    ('content', ('digest', 'size', 'value')),
+    ('digest', ('digest',)),
+    ('pickle', ('data',)),
+    ('ndarray', ('dtype', 'shape', 'order', 'data')),
+    ('array.array', ('typecode', 'itemsize', 'data')),
+    ('memoryview', ('format', 'shape', 'data')),
+)
+
+_node_codes = {name: (code, fields)
+               for code, (name, fields) in enumerate(NODE_TYPES)}
+
+# Types of the nodes whose data is read from blobs as buffers
+_VIEW_NODES = frozenset(('memoryview', 'ndarray', 'array.array'))
+
+# Tags of the strings which may be written as blobs, and their blob tags
+_blob_tags = {b'b': b'B', b'u': b'U'}
+
+_U8 = struct.Struct('>B')
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_U64 = struct.Struct('>Q')
+_F64 = struct.Struct('>d')
+
+_I64_MIN = -2**63
+_I64_MAX = 2**63 - 1
+
+
+# Default size in bytes of the chunks written by `dump`
+DEFAULT_CHUNK_SIZE = 262144
+
+
+def dumps(obj, strings=None):
+    """
+    Serialize an object to a byte string.
+
+    If given, short strings are interned using the `StringTable` `strings`.
+    """
+    writer = _Writer(strings)
+    try:
+        writer.write(obj)
+    except Exception:
+        if strings is not None:
+            strings.rollback()
+        raise
+    if strings is not None:
+        strings.commit()
+    return bytes(writer.buf)
+
+
+def dump(obj, write, strings=None, chunk_size=DEFAULT_CHUNK_SIZE,
+         blobs=None):
+    """
+    Serialize an object in chunks as it is written.
+
+    Calls ``write(chunk, more)`` with each chunk of serialized data.  Every
+    chunk but the last is exactly `chunk_size` bytes long and is written with
+    `more` set to True.  The last chunk is shorter, possibly empty.
+
+    If given, strings of at least ``blobs.threshold`` bytes are passed to
+    ``blobs.put(data)``, which returns the name of a blob holding the data,
+    or None to write the string inline.
+    """
+    writer = _Writer(strings, write, chunk_size, blobs)
+    try:
+        writer.write(obj)
+    except Exception:
+        if strings is not None:
+            strings.rollback()
+        raise
+    if strings is not None:
+        strings.commit()
+    write(bytes(writer.buf), False)
+
+
+def loads(data, strings=None, more=None, blobs=None):
+    """
+    Deserialize an object from a byte string.
+
+    If the data contains interned strings, `strings` must be the
+    `StringTable` matching the one used for serialization.
+
+    If given, `more` is called with no arguments whenever the reader runs out
+    of data, and returns the next chunk of the message, or None at the end of
+    the message.
+
+    If the data contains blobs, ``blobs.get(name, size, view)`` is called to
+    read each one.
+    """
+    reader = _Reader(data, strings, more, blobs)
+    try:
+        obj = reader.read()
+        if reader.pos != len(reader.data) or (
+                more is not None and more() is not None):
+            raise ValueError(
+                "Trailing data after position {}".format(reader.pos))
+    except Exception:
+        if strings is not None:
+            strings.rollback()
+        raise
+    if strings is not None:
+        strings.commit()
+    return obj
+
+
+class StringTable(object):
+    """
+    Table of interned strings, shared by the messages of a connection.
+
+    The table holds at most `size` strings.  Once it is full, each new string
+    replaces the oldest one.  Only strings of at most `max_length` characters
+    (or bytes) are interned.
+
+    Changes made while serializing a message are undone if serialization
+    fails, so that the table stays in sync with the reader's table.
+    """
+
+    def __init__(self, size, max_length=64):
+        self.size = size
+        self.max_length = max_length
+        self.strings = []
+        self._next = 0  # Next slot to reuse once the table is full
+        self._indices = {_bytes: {}, _unicode: {}}
+        self._undo = []  # Changes for the current message
+
+    def __len__(self):
+        return len(self.strings)
+
+    def find(self, s):
+        """ Return the index of an interned string, or None. """
+        return self._indices[type(s)].get(s)
+
+    def add(self, s):
+        """ Add a string to the table and return its index. """
+        strings = self.strings
+        if len(strings) < self.size:
+            index = len(strings)
+            strings.append(s)
+            old = None
+        else:
+            index = self._next
+            self._next = (index + 1) % self.size
+            old = strings[index]
+            self._indices[type(old)].pop(old, None)
+            strings[index] = s
+        self._indices[type(s)][s] = index
+        self._undo.append((index, old))
+        return index
+
+    def get(self, index):
+        """ Return an interned string by index. """
+        return self.strings[index]
+
+    def commit(self):
+        """ Keep the changes for the current message. """
+        self._undo = []
+
+    def rollback(self):
+        """ Undo the changes for the current message. """
+        for index, old in reversed(self._undo):
+            s = self.strings[index]
+            del self._indices[type(s)][s]
+            if old is None:
+                self.strings.pop()
+            else:
+                self.strings[index] = old
+                self._indices[type(old)][old] = index
+                self._next = index
+        self._undo = []
+
+
+class _Writer(object):
+    """
+    Serializer state for a single message.
+
+    Containers are written using an explicit stack rather than recursion, so
+    objects may be nested to any depth.  Each stack entry is an iterator over
+    the container's remaining items, and a flag which is true if the items
+    are dict key/value pairs.
+
+    If `write_chunk` is given, full chunks of `chunk_size` bytes are passed to
+    it as they are produced (see `dump`), leaving the rest in `buf`.
+    """
+
+    def __init__(self, strings=None, write_chunk=None, chunk_size=None,
+                 blobs=None):
+        self.buf = bytearray()
+        self.keys = {}
+        self.stack = []
+        self.strings = strings
+        self.write_chunk = write_chunk
+        if write_chunk is None:
+            chunk_size = sys.maxsize
+        self.chunk_size = chunk_size
+        self.blobs = blobs
+        self.blob_threshold = (sys.maxsize if blobs is None
+                               else blobs.threshold)
+
+    def write(self, obj):
+        buf = self.buf
+        chunk_size = self.chunk_size
+        stack = self.stack
+        stack.append((iter((obj,)), False))
+        while stack:
+            frame = stack[-1]
+            itr, pairs = frame
+            for item in itr:
+                if pairs:
+                    key, item = item
+                    self._write_key(key)
+                self._write_value(item)
+                if len(buf) >= chunk_size:
+                    self._flush()
+                if stack[-1] is not frame:
+                    # Write the new container's items first
+                    break
+            else:
+                stack.pop()
+
+    def _flush(self):
+        """ Pass all full chunks in the buffer to `write_chunk`. """
+        buf = self.buf
+        size = self.chunk_size
+        end = len(buf) - len(buf) % size
+        for start in _range(0, end, size):
+            self.write_chunk(bytes(buf[start:start+size]), True)
+        del buf[:end]
+
+    def _write_value(self, obj):
+        try:
+            writer = self._writers[type(obj)]
+        except KeyError:
+            raise TypeError("Cannot serialize object of type {}".format(
+                type(obj).__name__))
+        writer(self, obj)
+
+    def _write_none(self, obj):
+        self.buf += b'N'
+
+    def _write_bool(self, obj):
+        self.buf += b'T' if obj else b'F'
+
+    def _write_int(self, obj):
+        if _I64_MIN <= obj <= _I64_MAX:
+            self.buf += b'i'
+            self.buf += _I64.pack(obj)
+        else:
+            self._write_data(b'I', int_to_bytes(obj))
+
+    def _write_float(self, obj):
+        self.buf += b'f'
+        self.buf += _F64.pack(obj)
+
+    def _write_bytes(self, obj):
+        tag = self._intern(obj, b'b', b'y')
+        if tag is not None:
+            self._write_data(tag, obj)
+
+    def _write_bytearray(self, obj):
+        self._write_data(b'b', obj)
+
+    def _write_unicode(self, obj):
+        tag = self._intern(obj, b'u', b's')
+        if tag is not None:
+            self._write_data(tag, obj.encode('utf8'))
+
+    def _write_data(self, tag, data):
+        if len(data) >= self.blob_threshold and self._write_blob(tag, data):
+            return
+        self.buf += tag
+        self.buf += _U32.pack(len(data))
+        self.buf += data
+
+    def _write_blob(self, tag, data):
+        """ Write a string as a blob if possible, and return true if so. """
+        blob_tag = _blob_tags.get(tag)
+        if blob_tag is None:
+            return False
+        name = self.blobs.put(data)
+        if name is None:
+            return False
+        name = name.encode('utf8')
+        self.buf += blob_tag
+        self.buf += _U32.pack(len(name))
+        self.buf += name
+        self.buf += _U64.pack(len(data))
+        return True
+
+    def _intern(self, obj, tag, intern_tag):
+        """
+        Intern a string, if there is a string table.  If the string is already
+        interned, write a reference to it and return None.  Otherwise, return
+        the tag with which to write the string.
+        """
+        strings = self.strings
+        if strings is None or len(obj) > strings.max_length:
+            return tag
+        index = strings.find(obj)
+        if index is None:
+            strings.add(obj)
+            return intern_tag
+        self.buf += b'S'
+        self.buf += _U32.pack(index)
+        return None
+
+    def _write_list(self, obj):
+        self.buf += b'l'
+        self.buf += _U32.pack(len(obj))
+        self.stack.append((iter(obj), False))
+
+    def _write_dict(self, obj):
+        node_type = _node_codes.get(obj.get('type'))
+        if node_type is not None:
+            code, fields = node_type
+            self.buf += b'n'
+            self.buf += _U8.pack(code)
+            self.stack.append((_map(obj.__getitem__, fields), False))
+        else:
+            self.buf += b'm'
+            self.buf += _U32.pack(len(obj))
+            self.stack.append((iter(_items(obj)), True))
+
+    def _write_key(self, key):
+        index = self.keys.get(key)
+        if index is None:
+            self.keys[key] = len(self.keys)
+            data = key if type(key) is _bytes else key.encode('utf8')
+            self.buf += b'k'
+            self.buf += _U32.pack(len(data))
+            self.buf += data
+        else:
+            self.buf += b'K'
+            self.buf += _U32.pack(index)
+
+    _writers = {
+        type(None): _write_none,
+        bool: _write_bool,
+        int: _write_int,
+        _long: _write_int,
+        float: _write_float,
+        _bytes: _write_bytes,
+        bytearray: _write_bytearray,
+        _unicode: _write_unicode,
+        list: _write_list,
+        tuple: _write_list,
+        dict: _write_dict,
+    }
+
+
+class _Reader(object):
+    """
+    Deserializer state for a single message.
+
+    Like the writer, the reader uses an explicit stack.  Each stack entry is a
+    container and an iterator over the keys or indices of its items.  List
+    items have no index and are appended, so that the size of a list is only
+    trusted as far as its items are actually read.
+
+    If `more` is given, it is called for more data whenever the reader runs
+    out (see `loads`).  The data already read is then discarded.
+    """
+
+    def __init__(self, data, strings=None, more=None, blobs=None):
+        self.data = data
+        self.pos = 0
+        self.keys = []
+        self.stack = []
+        self.strings = strings
+        self.more = more
+        self.blobs = blobs
+
+    def read(self):
+        result = [None]
+        stack = self.stack
+        stack.append((result, iter((0,))))
+        while stack:
+            frame = stack[-1]
+            container, slots = frame
+            for slot in slots:
+                if slot is None:
+                    container.append(self._read_value())
+                else:
+                    container[slot] = self._read_value()
+                if stack[-1] is not frame:
+                    # Read the new container's items first
+                    break
+            else:
+                stack.pop()
+        return result[0]
+
+    def _fill(self, size):
+        """
+        Read more data until at least `size` bytes are available at the
+        current position.
+        """
+        chunks = [self.data[self.pos:]]
+        available = len(chunks[0])
+        while available < size:
+            chunk = self.more() if self.more is not None else None
+            if chunk is None:
+                raise ValueError("Unexpected end of data")
+            chunks.append(chunk)
+            available += len(chunk)
+        self.data = b''.join(chunks)
+        self.pos = 0
+
+    def _read_tag(self):
+        tag = self.data[self.pos:self.pos+1]
+        if not tag:
+            self._fill(1)
+            tag = self.data[0:1]
+        self.pos += 1
+        return tag
+
+    def _read_value(self):
+        # Same as `_read_tag`, inlined
+        tag = self.data[self.pos:self.pos+1]
+        if not tag:
+            self._fill(1)
+            tag = self.data[0:1]
+        self.pos += 1
+        try:
+            reader = self._readers[tag]
+        except KeyError:
+            raise ValueError("Invalid tag {!r} at position {}".format(
+                tag, self.pos - 1))
+        return reader(self)
+
+    def _read_struct(self, st):
+        try:
+            value, = st.unpack_from(self.data, self.pos)
+        except struct.error:
+            self._fill(st.size)
+            value, = st.unpack_from(self.data, self.pos)
+        self.pos += st.size
+        return value
+
+    def _read_data(self):
+        size = self._read_struct(_U32)
+        if self.pos + size > len(self.data):
+            self._fill(size)
+        start = self.pos
+        self.pos += size
+        return self.data[start:self.pos]
+
+    def _read_none(self):
+        return None
+
+    def _read_true(self):
+        return True
+
+    def _read_false(self):
+        return False
+
+    def _read_int(self):
+        return self._read_struct(_I64)
+
+    def _read_bigint(self):
+        return int_from_bytes(self._read_data())
+
+    def _read_float(self):
+        return self._read_struct(_F64)
+
+    def _read_bytes(self):
+        return self._read_data()
+
+    def _read_unicode(self):
+        return self._read_data().decode('utf8')
+
+    def _read_interned_bytes(self):
+        s = self._read_bytes()
+        self._table().add(s)
+        return s
+
+    def _read_interned_unicode(self):
+        s = self._read_unicode()
+        self._table().add(s)
+        return s
+
+    def _read_interned(self):
+        index = self._read_struct(_U32)
+        try:
+            return self._table().get(index)
+        except IndexError:
+            raise ValueError("Invalid string index {}".format(index))
+
+    def _read_blob_data(self, view):
+        name = self._read_data().decode('utf8')
+        size = self._read_struct(_U64)
+        if self.blobs is None:
+            raise ValueError("Blob without a blob reader")
+        return self.blobs.get(name, size, view)
+
+    def _read_blob(self):
+        container = self.stack[-1][0]
+        return self._read_blob_data(type(container) is dict
+                                    and container.get('type') in _VIEW_NODES)
+
+    def _read_unicode_blob(self):
+        # Decode directly from the mapped blob
+        return codecs.utf_8_decode(self._read_blob_data(True), 'strict',
+                                   True)[0]
+
+    def _table(self):
+        if self.strings is None:
+            raise ValueError("Interned string without a string table")
+        return self.strings
+
+    def _read_list(self):
+        count = self._read_struct(_U32)
+        lst = []
+        self.stack.append((lst, itertools.repeat(None, count)))
+        return lst
+
+    def _read_dict(self):
+        count = self._read_struct(_U32)
+        dct = {}
+        # Each key is read just before its value
+        self.stack.append(
+            (dct, _map(_Reader._read_key, itertools.repeat(self, count))))
+        return dct
+
+    def _read_node(self):
+        code = self._read_struct(_U8)
+        try:
+            name, fields = NODE_TYPES[code]
+        except IndexError:
+            raise ValueError("Invalid node type {} at position {}".format(
+                code, self.pos - 1))
+        node = {'type': name}
+        self.stack.append((node, iter(fields)))
+        return node
+
+    def _read_key(self):
+        tag = self._read_tag()
+        if tag == b'k':
+            key = self._read_data().decode('utf8')
+            self.keys.append(key)
+            return key
+        elif tag == b'K':
+            index = self._read_struct(_U32)
+            try:
+                return self.keys[index]
+            except IndexError:
+                raise ValueError("Invalid key index {}".format(index))
+        else:
+            raise ValueError("Invalid key tag {!r} at position {}".format(
+                tag, self.pos - 1))
+
+    _readers = {
+        b'N': _read_none,
+        b'T': _read_true,
+        b'F': _read_false,
+        b'i': _read_int,
+        b'I': _read_bigint,
+        b'f': _read_float,
+        b'b': _read_bytes,
+        b'u': _read_unicode,
+        b'y': _read_interned_bytes,
+        b's': _read_interned_unicode,
+        b'S': _read_interned,
+        b'l': _read_list,
+        b'm': _read_dict,
+        b'n': _read_node,
+        b'B': _read_blob,
+        b'U': _read_unicode_blob,
+    }
@@ -45,6 +45,11 @@ cache with no problems since it has already been initialized.
 *It is not necessary to do the placeholder procedure for sets, even though they
 are mutable, because any circularly-referential data structure must contain a
 mutable object, which makes it unhashable.
+
+The traversal is implemented with an explicit stack rather than recursion, so
+objects may be nested deeper than the interpreter's recursion limit.  Items of
+immutable containers are encoded depth-first from the stack, while items of
+lists and dicts are queued as described above.
 """
 
 
@@ -60,12 +65,22 @@ mutable object, which makes it unhashable.
 #
 # - Is there a way to avoid incurring the costs of caching when not needed?
 #   maybe a two-pass algorithm that checks before encoding?
+#
+#     - Caching can be disabled for a session (see `cycles` parameter), but
+#       the caller must know that the data has no shared references.
 
 
+import array
 import base64
 import collections
+import itertools
+import operator
+import struct
 import sys
 
+from python2.shared import pickling
+from python2.shared.binary import int_from_bytes, int_to_bytes
+
 
 PYTHON_VERSION = sys.version_info[0]
 if PYTHON_VERSION == 2:
@@ -74,22 +89,118 @@ if PYTHON_VERSION == 2:
     _unicode = unicode  # noqa
     _range = xrange  # noqa
     _items = dict.iteritems
+    _map = itertools.imap
+    _zip = itertools.izip
+    _array_frombytes = array.array.fromstring
+    _array_tobytes = array.array.tostring
 elif PYTHON_VERSION == 3:
     _long = int
     _bytes = bytes
     _unicode = str
     _range = range
     _items = dict.items
+    _map = map
+    _zip = zip
+    _array_frombytes = array.array.frombytes
+    _array_tobytes = array.array.tobytes
 else:
     raise Exception("Unsupported Python version: {}".format(PYTHON_VERSION))
 
 
-_value_types = frozenset({
-    type(None), type(NotImplemented), type(Ellipsis), bool, int, _long, float,
-    complex, _bytes, _unicode, bytearray, _range
-})
 _container_types = frozenset({slice, list, tuple, set, frozenset, dict})
-_supported_types = _value_types | _container_types
+
+# Types which are represented natively by the binary encoding
+_native_types = frozenset({
+    type(None), bool, int, _long, float, _bytes, _unicode
+})
+
+
+# Range of ints encoded as JSON numbers; larger ints are encoded as bytes
+_I64_MIN = -2**63
+_I64_MAX = 2**63 - 1
+
+
+def _find_typecode(candidates, itemsize):
+    """ Return the first array typecode with the given item size, or None. """
+    for typecode in candidates:
+        try:
+            if array.array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            pass  # Typecode not supported
+    return None
+
+
+# Element formats for packed arrays.  Each format is a struct format character
+# describing the little-endian layout of elements on the wire, and is mapped
+# to an array typecode with the same layout on this platform, if one exists.
+_array_typecodes = {
+    'q': _find_typecode('ql', 8),  # 64-bit signed integers
+    'd': _find_typecode('d', 8),  # 64-bit floats
+    '?': _find_typecode('b', 1),  # Booleans, as signed chars
+}
+
+# Element types which may be packed, with their wire formats.  Note that bool
+# is a subclass of int, so it must be handled separately.
+_array_formats = {
+    fmt_type: fmt for fmt_type, fmt in ((int, 'q'), (float, 'd'), (bool, '?'))
+    if _array_typecodes[fmt] is not None
+}
+
+_swap_bytes = sys.byteorder != 'little'
+
+# Typecodes of `array.array` objects, by kind.  Arrays are transferred with
+# their typecode and item size, and decoded with a typecode of the same kind
+# and size, since the available typecodes differ between Python versions.
+# Python 2 char arrays ('c') are decoded as unsigned bytes in Python 3.
+_array_kinds = {typecode: kind for kind in ('bhilq', 'cBHILQ', 'fd', 'uw')
+                for typecode in kind}
+
+# Element formats and numbers of dimensions of memoryviews which can be
+# encoded as values.  Python 2 can only create 1-D memoryviews of bytes.
+if PYTHON_VERSION == 2:
+    _memoryview_formats = frozenset('bBhHiIlLqQfd?c')
+    _memoryview_max_ndim = 64  # PyBUF_MAX_NDIM
+else:
+    _memoryview_formats = frozenset('B')
+    _memoryview_max_ndim = 1
+
+_chain = itertools.chain.from_iterable
+_key_value = operator.itemgetter('key', 'value')
+
+
+def _finish_slice(node, fields):
+    """ Store the encoded fields of a slice. """
+    node['start'], node['stop'], node['step'] = fields
+
+
+def _finish_dict(node, keys_values):
+    """ Store the encoded items of a dict, given alternating keys/values. """
+    itr = iter(keys_values)
+    node['items'] = [dict(key=key, value=value)
+                     for key, value in _zip(itr, itr)]
+
+
+def _make_slice(placeholder, items):
+    return slice(*items)
+
+
+def _make_tuple(placeholder, items):
+    return tuple(items)
+
+
+def _make_set(placeholder, items):
+    return set(items)
+
+
+def _make_frozenset(placeholder, items):
+    return frozenset(items)
+
+
+def _fill_dict(dct, keys_values):
+    """ Fill a decoded dict, given alternating keys and values. """
+    itr = iter(keys_values)
+    dct.update(_zip(itr, itr))
 
 
 class EncodingDepth(object):
@@ -100,226 +211,841 @@ class EncodingDepth(object):
 
 
 class BaseEncodingSession(object):
-    """ Base encoder for Python 2 client and server. """
+    """
+    Base encoder for Python 2 client and server.
+
+    Objects are encoded by looking up an encoder function for the object's
+    type in the `encoders` table.  Objects of types not in the table are
+    encoded as references.  Subclasses may extend the table with additional
+    types.  Encoder functions are called with the session, the object, and
+    the encoding depth.  Types in `container_types` are cached separately at
+    each encoding depth.
+
+    If `binary` is true, the encoding is intended for the binary protocol (see
+    `python2.shared.binary`).  Objects of native types are encoded as
+    themselves rather than as dicts, and binary data is not base64-encoded.
+
+    If `cycles` is false, the session cache is not used.  Objects which occur
+    more than once are encoded separately each time, and circular references
+    raise a `ValueError`.  This saves time and memory for data structures
+    without shared or circular references.  The decoding session must also
+    have cycles disabled.
+
+    Lists and tuples of at least `array_min_length` elements which are all
+    ints, all floats, or all bools are encoded as packed arrays, as long as
+    the elements are encoded as values.  Elements of a packed array do not
+    participate in the session cache.
+
+    If `records` is true, lists and tuples of at least `records_min_length`
+    records are encoded as record batches.  A record batch sends the dict keys
+    (the schema) once, followed by the values one column at a time; columns
+    of ints, floats, or bools are packed as arrays.  Records must be all dicts
+    with the same keys or all tuples of the same length, and keys and values
+    must be of native types (None, bool, int, float, bytes, or unicode).
+    Records and their values do not participate in the session cache, so a
+    record which occurs elsewhere in the encoded object is encoded separately.
+
+    If `pickle` is true, objects encoded in full which contain only plain
+    builtin data are encoded as pickles (see `python2.shared.pickling`).
+    Other objects are encoded as usual.
+
+    If `ndarrays` is true and NumPy has been imported, NumPy arrays with
+    numeric, bool, string, or datetime dtypes are encoded as their raw data,
+    with the dtype, shape, and memory order needed to rebuild them.  Other
+    arrays are encoded as references.
 
-    def __init__(self):
+    Container encoders do not encode their items directly.  Instead they
+    schedule the items with `_push`, and `encode` processes scheduled items
+    using an explicit stack, so objects may be nested to any depth.
+    """
+
+    container_types = _container_types
+    array_min_length = 8
+    records_min_length = 8
+
+    def __init__(self, binary=False, cycles=True, records=False,
+                 pickle=False, ndarrays=False):
         self.session = {}
+        self.stack = []
         self.deferred = collections.deque()
+        self.binary = binary
+        self.cycles = cycles
+        self.records = records
+        self.pickle = pickle
+        self.active = set()  # Containers being encoded, if cycles disabled
+        self._encoders = dict(self.encoders)
+        if binary:
+            native = type(self)._enc_native
+            self._encoders.update((t, native) for t in _native_types)
+        if ndarrays:
+            # If NumPy has not been imported, there are no arrays to encode
+            numpy = sys.modules.get('numpy')
+            if numpy is not None:
+                self._encoders[numpy.ndarray] = type(self)._enc_ndarray
 
     def encode(self, obj, depth=EncodingDepth.DEEP):
         """ Encode an object. """
 
-        data = self._enc(obj, depth)
-        while self.deferred:
-            self.deferred.popleft()()
+        if self.pickle and depth < 0:
+            data = pickling.dumps(obj)
+            if data is not None:
+                return self._enc_pickle(obj, data)
 
+        data = self._enc(obj, depth)
+        self._enc_scheduled()
         return data
 
+    def _enc_scheduled(self):
+        """ Encode the items of scheduled containers. """
+        enc = self._enc
+        stack = self.stack
+        deferred = self.deferred
+        while True:
+            while stack:
+                frame = stack[-1]
+                node, out, itr, depth, finish, oid = frame
+                for item in itr:
+                    out.append(enc(item, depth))
+                    if stack[-1] is not frame:
+                        # Encode the new container's items first
+                        break
+                else:
+                    stack.pop()
+                    if finish is not None:
+                        finish(node, out)
+                    if oid is not None:
+                        self.active.remove(oid)
+            if not deferred:
+                break
+            stack.append(deferred.popleft())
+
+    def _push(self, obj, node, out, items, depth, finish=None, defer=False):
+        """
+        Schedule the items of a container to be encoded.
+
+        Each item is encoded at the given depth and appended to `out`.  Once
+        all items are encoded, `finish(node, out)` is called if given.  If
+        `defer` is true and cycles are enabled, the items are encoded after
+        all other reachable objects, as described in the module docstring.
+        """
+        if self.cycles:
+            frame = (node, out, iter(items), depth, finish, None)
+            if defer:
+                self.deferred.append(frame)
+                return
+        else:
+            oid = id(obj)
+            self.active.add(oid)
+            frame = (node, out, iter(items), depth, finish, oid)
+        self.stack.append(frame)
+
     def _enc(self, obj, depth):
         t = type(obj)
-        if depth and any(t is s for s in _supported_types):
-            if t in _container_types:
-                # For container types, we include the depth in the cache key.
-                # This means that if encoding to a finite depth, a given
-                # container object will be encoded separately at each depth
-                # where it occurs.
-                key = id(obj), max(depth, -1)
-            else:
-                key = id(obj)
-            if key in self.session:
-                return dict(type='cached', index=self.session[key][0])
-            # Store cached objects to prevent garbage collection
-            # This ensures that ids uniquely map to objects over the life of
-            # the session. We can't use a WeakKeyDictionary to avoid this
-            # because most builtin types do not support weak references.
-            self.session[key] = len(self.session), obj
-
-            # Singleton objects
-            if obj is None:
-                return dict(type='None')
-            elif obj is NotImplemented:
-                return dict(type='NotImplemented')
-            elif obj is Ellipsis:
-                return dict(type='Ellipsis')
-
-            # Numerical types
-            elif t is bool:
-                return dict(type='bool', value=obj)
-            elif t is int or t is _long:
-                return dict(type='int', value=obj)
-            elif t is float:
-                return dict(type='float', value=obj)
-            elif t is complex:
-                return dict(type='complex', real=obj.real, imag=obj.imag)
-
-            # String types
-            elif t is _bytes:
-                return self._enc_bdata('bytes', obj)
-            elif t is _unicode:
-                return self._enc_bdata('unicode', obj.encode('utf8'))
-            elif t is bytearray:
-                return self._enc_bdata('bytearray', obj)
-
-            # Range and slice
-            elif t is _range:
-                return self._enc_range(obj)
-            elif t is slice:
-                return dict(type='slice',
-                            start=self._enc(obj.start, depth-1),
-                            stop=self._enc(obj.stop, depth-1),
-                            step=self._enc(obj.step, depth-1))
-
-            # Container types
-            elif t is list:
-                d = dict(type='list', items=Placeholder)
-                self.deferred.append(
-                    lambda: d.update(items=self._enc_items(obj, depth-1)))
-                return d
-            elif t is tuple:
-                return dict(type='tuple', items=self._enc_items(obj, depth-1))
-            elif t is set:
-                return dict(type='set', items=self._enc_items(obj, depth-1))
-            elif t is frozenset:
-                return dict(type='frozenset',
-                            items=self._enc_items(obj, depth-1))
-            elif t is dict:
-                d = dict(type='dict', items=Placeholder)
-                self.deferred.append(
-                    lambda: d.update(items=[self._enc_kv(key, value, depth-1)
-                                     for key, value in _items(obj)]))
-                return d
-            else:
-                # Should never happen
-                raise AssertionError("Unexpected type: {}".format(t.__name__))
+        encoder = self._encoders.get(t) if depth else None
+        if encoder is None:
+            # Encode as reference
+            return self._enc_ref(obj)
 
-        # Encode as reference
-        return self._enc_ref(obj)
+        if not self.cycles:
+            if t in self.container_types and id(obj) in self.active:
+                raise ValueError("Cannot encode circular reference to {}"
+                                 " object with cycles disabled".format(
+                                     t.__name__))
+            return encoder(self, obj, depth)
+
+        if t in self.container_types:
+            # For container types, we include the depth in the cache key.
+            # This means that if encoding to a finite depth, a given
+            # container object will be encoded separately at each depth
+            # where it occurs.
+            key = id(obj), max(depth, -1)
+        else:
+            key = id(obj)
+        if key in self.session:
+            return dict(type='cached', index=self.session[key][0])
+        # Store cached objects to prevent garbage collection
+        # This ensures that ids uniquely map to objects over the life of
+        # the session. We can't use a WeakKeyDictionary to avoid this
+        # because most builtin types do not support weak references.
+        self.session[key] = len(self.session), obj
+
+        return encoder(self, obj, depth)
+
+    def _enc_native(self, obj, depth):
+        """ Encode an object natively (binary mode only). """
+        return obj
+
+    # Singleton objects
+
+    def _enc_none(self, obj, depth):
+        return dict(type='None')
+
+    def _enc_notimplemented(self, obj, depth):
+        return dict(type='NotImplemented')
+
+    def _enc_ellipsis(self, obj, depth):
+        return dict(type='Ellipsis')
+
+    # Numeric types
+
+    def _enc_bool(self, obj, depth):
+        return dict(type='bool', value=obj)
+
+    def _enc_int(self, obj, depth):
+        if _I64_MIN <= obj <= _I64_MAX:
+            return dict(type='int', value=obj)
+        # Decimal conversion of large ints takes quadratic time
+        return dict(type='bigint', data=self._bdata(int_to_bytes(obj)))
+
+    def _enc_float(self, obj, depth):
+        return dict(type='float', value=obj)
+
+    def _enc_complex(self, obj, depth):
+        return dict(type='complex', real=obj.real, imag=obj.imag)
+
+    # String types
+
+    def _enc_bytes(self, obj, depth):
+        return self._enc_bdata('bytes', obj)
+
+    def _enc_unicode(self, obj, depth):
+        return self._enc_bdata('unicode', obj.encode('utf8'))
+
+    def _enc_bytearray(self, obj, depth):
+        return self._enc_bdata('bytearray', obj)
+
+    # Buffer types
+
+    def _enc_pyarray(self, obj, depth):
+        """ Encode an `array.array` object. """
+        if _swap_bytes:
+            obj = array.array(obj.typecode, obj)
+            obj.byteswap()
+        return dict(type='array.array', typecode=_unicode(obj.typecode),
+                    itemsize=obj.itemsize,
+                    data=self._bdata(_array_tobytes(obj)))
+
+    def _enc_memoryview(self, obj, depth):
+        """ Encode a memoryview of elements of a simple format. """
+        if (obj.format not in _memoryview_formats
+                or obj.ndim > _memoryview_max_ndim):
+            return self._enc_ref_uncached(obj)
+        return dict(type='memoryview', format=_unicode(obj.format),
+                    shape=list(obj.shape), data=self._bdata(obj.tobytes()))
+
+    if PYTHON_VERSION == 2:
+        def _enc_buffer(self, obj, depth):
+            """ Encode a buffer as a memoryview of bytes. """
+            return dict(type='memoryview', format=u'B', shape=[len(obj)],
+                        data=self._bdata(obj[:]))
 
     def _enc_bdata(self, type_, data):
         """ Encode binary data. """
-        return dict(type=type_, data=base64.b64encode(data).decode('ascii'))
+        return dict(type=type_, data=self._bdata(data))
 
-    def _enc_items(self, itr, depth):
-        """ Encode a collection of items. """
-        return [self._enc(item, depth) for item in itr]
+    def _bdata(self, data):
+        """ Convert binary data to a form suitable for the encoding. """
+        if self.binary:
+            return data
+        return base64.b64encode(data).decode('ascii')
+
+    # Range and slice
 
     if PYTHON_VERSION == 2:
-        def _enc_range(self, range_):
-            """ Encode a range object. """
-            start, stop, step = range_.__reduce__()[1]
+        def _enc_range(self, obj, depth):
+            start, stop, step = obj.__reduce__()[1]
             return dict(type='range', start=start, stop=stop, step=step)
     else:
-        def _enc_range(self, range_):
-            """ Encode a range object. """
-            return dict(type='range', start=range_.start, stop=range_.stop,
-                        step=range_.step)
+        def _enc_range(self, obj, depth):
+            return dict(type='range', start=obj.start, stop=obj.stop,
+                        step=obj.step)
+
+    def _enc_slice(self, obj, depth):
+        node = dict(type='slice')
+        self._push(obj, node, [], (obj.start, obj.stop, obj.step), depth-1,
+                   finish=_finish_slice)
+        return node
+
+    # Container types
+
+    def _enc_list(self, obj, depth):
+        packed = self._enc_array(obj, depth)
+        if packed is None and self.records:
+            packed = self._enc_records(obj, depth)
+        if packed is not None:
+            return packed
+        return self._enc_items('list', obj, depth, defer=True)
+
+    def _enc_tuple(self, obj, depth):
+        packed = self._enc_array(obj, depth)
+        if packed is None and self.records:
+            packed = self._enc_records(obj, depth)
+        if packed is not None:
+            return packed
+        return self._enc_items('tuple', obj, depth)
 
-    def _enc_kv(self, key, value, depth):
-        """ Encode a dict key-value pair. """
-        return dict(key=self._enc(key, depth), value=self._enc(value, depth))
+    def _enc_set(self, obj, depth):
+        return self._enc_items('set', obj, depth)
+
+    def _enc_frozenset(self, obj, depth):
+        return self._enc_items('frozenset', obj, depth)
+
+    def _enc_dict(self, obj, depth):
+        node = dict(type='dict')
+        # Keys and values are encoded alternately, then paired up
+        self._push(obj, node, [], _chain(_items(obj)), depth-1,
+                   finish=_finish_dict, defer=True)
+        return node
+
+    def _enc_array(self, seq, depth):
+        """
+        Encode a list or tuple as a packed array, if possible.  Returns None
+        if the sequence cannot be packed.
+        """
+        if depth == 1 or len(seq) < self.array_min_length:
+            return None
+        types = set(map(type, seq))
+        fmt = _array_formats.get(types.pop()) if len(types) == 1 else None
+        if fmt is None:
+            return None
+        try:
+            arr = array.array(_array_typecodes[fmt], seq)
+        except OverflowError:
+            return None
+        if _swap_bytes:
+            arr.byteswap()
+        return dict(type='array', tuple=type(seq) is tuple,
+                    typecode=_unicode(fmt),
+                    data=self._bdata(_array_tobytes(arr)))
+
+    def _enc_ndarray(self, obj, depth):
+        """ Encode a NumPy array as its raw data. """
+        dtype = obj.dtype
+        if dtype.hasobject or dtype.fields is not None or not dtype.itemsize:
+            return self._enc_ref_uncached(obj)
+        flags = obj.flags
+        order = 'F' if flags.f_contiguous and not flags.c_contiguous else 'C'
+        return dict(type='ndarray', dtype=_unicode(dtype.str),
+                    shape=list(obj.shape), order=_unicode(order),
+                    data=self._bdata(obj.tobytes(order)))
+
+    def _enc_records(self, seq, depth):
+        """
+        Encode a list or tuple of records as a record batch, if possible.
+        Returns None if the sequence is not a uniform batch of records.
+        """
+        if 0 <= depth <= 2 or len(seq) < self.records_min_length:
+            return None
+        row_type = type(seq[0])
+        if row_type is dict:
+            keys = list(seq[0])
+            width = len(keys)
+            if any(type(row) is not dict or len(row) != width for row in seq):
+                return None
+            try:
+                columns = [[row[key] for row in seq] for key in keys]
+            except KeyError:
+                return None
+            if not set(map(type, keys)) <= _native_types:
+                return None
+        elif row_type is tuple:
+            keys = None
+            width = len(seq[0])
+            if any(type(row) is not tuple or len(row) != width for row in seq):
+                return None
+            columns = [list(column) for column in zip(*seq)]
+        else:
+            return None
+        for column in columns:
+            if not set(map(type, column)) <= _native_types:
+                return None
+
+        enc = self._enc_uncached
+        return dict(type='records', tuple=type(seq) is tuple, length=len(seq),
+                    keys=None if keys is None else [enc(key) for key in keys],
+                    columns=[self._enc_column(column) for column in columns])
+
+    def _enc_column(self, column):
+        """ Encode a column of a record batch. """
+        packed = self._enc_array(column, EncodingDepth.DEEP)
+        if packed is not None:
+            return packed
+        enc = self._enc_uncached
+        return dict(type='list', items=[enc(value) for value in column])
+
+    def _enc_pickle(self, obj, data):
+        """ Encode an object as pickled data. """
+        if self.cycles:
+            # The pickle takes a single slot in the decoder's session cache
+            self.session[id(obj), 'pickle'] = len(self.session), obj
+        return self._enc_bdata('pickle', data)
+
+    def _enc_uncached(self, obj):
+        """ Encode a value of a native type without using the cache. """
+        return self._encoders[type(obj)](self, obj, EncodingDepth.DEEP)
+
+    def _enc_items(self, type_, obj, depth, defer=False):
+        """ Encode a collection of items. """
+        items = []
+        node = dict(type=type_, items=items)
+        self._push(obj, node, items, obj, depth-1, defer=defer)
+        return node
 
     def _enc_ref(self, obj):
         """ Encode an object as a reference. """
         # Implemented by client/server subclasses
-        raise NotImplemented()
+        raise NotImplementedError()
+
+    def _enc_ref_uncached(self, obj):
+        """
+        Encode an object of a non-container type as a reference from its
+        encoder, for objects which cannot be encoded as values.
+        """
+        if self.cycles:
+            # Release the cache slot allocated by `_enc`, since references
+            # are not cached by the decoder
+            del self.session[id(obj)]
+        return self._enc_ref(obj)
+
+    encoders = {
+        type(None): _enc_none,
+        type(NotImplemented): _enc_notimplemented,
+        type(Ellipsis): _enc_ellipsis,
+        bool: _enc_bool,
+        int: _enc_int,
+        _long: _enc_int,
+        float: _enc_float,
+        complex: _enc_complex,
+        _bytes: _enc_bytes,
+        _unicode: _enc_unicode,
+        bytearray: _enc_bytearray,
+        array.array: _enc_pyarray,
+        memoryview: _enc_memoryview,
+        _range: _enc_range,
+        slice: _enc_slice,
+        list: _enc_list,
+        tuple: _enc_tuple,
+        set: _enc_set,
+        frozenset: _enc_frozenset,
+        dict: _enc_dict,
+    }
+
+    if PYTHON_VERSION == 2:
+        encoders[buffer] = _enc_buffer  # noqa
 
 
 class BaseDecodingSession(object):
-    """ Base decoder for Python 2 client and server. """
+    """
+    Base decoder for Python 2 client and server.
+
+    Encoded values are decoded by looking up a decoder function for the
+    value's type name in the `decoders` table.  Subclasses may extend the
+    table with additional types.  Decoder functions are called with the
+    session and the encoded value.
+
+    If `binary` is true, the decoder accepts encodings produced by an encoding
+    session in binary mode.  If `cycles` is false, the decoder accepts
+    encodings produced by an encoding session with cycles disabled.
+
+    If `arrays` is true, packed arrays are decoded as `array.array` objects
+    rather than lists or tuples.
 
-    def __init__(self):
+    If `columns` is true, record batches are decoded as a dict mapping each
+    key (or tuple index) to a list of column values, rather than as a list or
+    tuple of records.  Packed columns are decoded as `array.array` objects if
+    `arrays` is also true.
+
+    Like encoders, container decoders schedule their items with `_push`
+    rather than decoding them directly.
+    """
+
+    def __init__(self, binary=False, cycles=True, arrays=False,
+                 columns=False):
         self.session = []
+        self.stack = []
         self.deferred = collections.deque()
+        self.binary = binary
+        self.cycles = cycles
+        self.arrays = arrays
+        self.columns = columns
 
     def decode(self, data):
-        obj = self._dec(data)
-        while self.deferred:
-            self.deferred.popleft()()
+        # Decode the top-level object as the sole item of a dummy container,
+        # in case it is created by a finish function.
+        result = []
+        self.stack.append((None, result, iter((data,)), None, None))
+        self._dec_scheduled()
+        return result[0]
 
-        return obj
+    def _dec_scheduled(self):
+        """ Decode the items of scheduled containers. """
+        dec = self._dec
+        stack = self.stack
+        deferred = self.deferred
+        session = self.session
+        while True:
+            while stack:
+                frame = stack[-1]
+                obj, out, itr, finish, cache_index = frame
+                for item in itr:
+                    out.append(dec(item))
+                    if stack[-1] is not frame:
+                        # Decode the new container's items first
+                        break
+                else:
+                    stack.pop()
+                    if finish is None:
+                        continue
+                    if obj is not Placeholder:
+                        finish(obj, out)
+                        continue
+                    # The object is created from its items.  Replace the
+                    # placeholder in the parent container.
+                    obj = finish(obj, out)
+                    stack[-1][1][-1] = obj
+                    if cache_index is not None:
+                        session[cache_index] = obj
+            if not deferred:
+                break
+            stack.append(deferred.popleft())
+
+    def _push(self, obj, out, items, finish=None, defer=False):
+        """
+        Schedule the items of a container to be decoded.
+
+        Each item is decoded and appended to `out`.  Once all items are
+        decoded, `finish(obj, out)` is called if given.  If `obj` is
+        `Placeholder`, the container is created by the finish function, and
+        the decoder should return `Placeholder`; the result of the finish
+        function replaces it.  If `defer` is true and cycles are enabled, the
+        items are decoded after all other reachable objects.
+        """
+        cache_index = self._cache_key() if obj is Placeholder else None
+        frame = (obj, out, iter(items), finish, cache_index)
+        if defer and self.cycles:
+            self.deferred.append(frame)
+        else:
+            self.stack.append(frame)
+
+    def _cache_key(self):
+        """
+        Return the session cache key for the object being decoded by `_dec`,
+        or None if the object is not cached.
+        """
+        # Slot allocated by `_dec` for the object being decoded
+        return len(self.session) - 1 if self.cycles else None
 
     def _dec(self, data):
         """ Decode an encoded object. """
 
+        if self.binary and type(data) is not dict:
+            # Native value
+            if self.cycles:
+                self.session.append(data)
+            return data
+
         dtype = data['type']
 
         if dtype == 'ref':
             return self._dec_ref(data)
 
         if dtype == 'cached':
+            if not self.cycles:
+                raise ValueError("Unexpected cache reference with cycles"
+                                 " disabled")
             assert self.session[data['index']] is not Placeholder
             return self.session[data['index']]
 
+        try:
+            decoder = self.decoders[dtype]
+        except KeyError:
+            raise TypeError("Invalid data type: {}".format(dtype))
+
+        if not self.cycles:
+            return decoder(self, data)
+
         cache_index = len(self.session)
         self.session.append(Placeholder)
+        obj = decoder(self, data)
+        self.session[cache_index] = obj
+        return obj
 
-        def _cache(obj):
-            self.session[cache_index] = obj
-            return obj
-
-        # Singleton objects
-        if dtype == 'None':
-            return _cache(None)
-        elif dtype == 'NotImplemented':
-            return _cache(NotImplemented)
-        elif dtype == 'Ellipsis':
-            return _cache(Ellipsis)
-
-        # Numeric types
-        elif dtype in ('bool', 'int', 'float'):
-            return _cache(data['value'])
-        elif dtype == 'complex':
-            return _cache(complex(real=data['real'], imag=data['imag']))
-
-        # String types
-        elif dtype == 'bytes':
-            return _cache(self._dec_bdata(data))
-        elif dtype == 'unicode':
-            return _cache(self._dec_bdata(data).decode('utf8'))
-        elif dtype == 'bytearray':
-            return _cache(bytearray(self._dec_bdata(data)))
-
-        # Range and slice
-        elif dtype == 'range':
-            return _cache(_range(data['start'], data['stop'], data['step']))
-        elif dtype == 'slice':
-            return _cache(slice(self._dec(data['start']),
-                                self._dec(data['stop']),
-                                self._dec(data['step'])))
-
-        # Container types
-        elif dtype == 'list':
-            lst = _cache([])
-            self.deferred.append(lambda: lst.extend(self._dec_items(data)))
-            return lst
-        elif dtype == 'tuple':
-            return _cache(tuple(self._dec_items(data)))
-        elif dtype == 'set':
-            return _cache(set(self._dec_items(data)))
-        elif dtype == 'frozenset':
-            return _cache(frozenset(self._dec_items(data)))
-        elif dtype == 'dict':
-            dct = _cache({})
-            self.deferred.append(
-                lambda: dct.update(self._dec_dict_items(data)))
-            return dct
-        else:
-            raise TypeError("Invalid data type: {}".format(dtype.__name__))
+    # Singleton objects
+
+    def _dec_none(self, data):
+        return None
+
+    def _dec_notimplemented(self, data):
+        return NotImplemented
+
+    def _dec_ellipsis(self, data):
+        return Ellipsis
+
+    # Numeric types
+
+    def _dec_number(self, data):
+        return data['value']
+
+    def _dec_bigint(self, data):
+        return int_from_bytes(self._dec_bdata(data))
+
+    def _dec_complex(self, data):
+        return complex(real=data['real'], imag=data['imag'])
+
+    # String types
+
+    def _dec_bytes(self, data):
+        return self._dec_bdata(data)
+
+    def _dec_unicode(self, data):
+        return self._dec_bdata(data).decode('utf8')
+
+    def _dec_bytearray(self, data):
+        return bytearray(self._dec_bdata(data))
+
+    # Buffer types
+
+    def _dec_pyarray(self, data):
+        typecode = data['typecode']
+        itemsize = data['itemsize']
+        try:
+            valid = array.array(typecode).itemsize == itemsize
+        except ValueError:
+            valid = False  # Typecode not supported
+        if not valid:
+            typecode = _find_typecode(_array_kinds.get(typecode, ''),
+                                      itemsize)
+            if typecode is None:
+                raise ValueError("Unsupported array typecode {!r} with item"
+                                 " size {}".format(data['typecode'],
+                                                   itemsize))
+        arr = array.array(typecode)
+        _array_frombytes(arr, self._dec_bdata(data))
+        if _swap_bytes:
+            arr.byteswap()
+        return arr
+
+    if PYTHON_VERSION == 2:
+        def _dec_memoryview(self, data):
+            """ Decode a memoryview of the received data, as bytes. """
+            return memoryview(self._dec_bdata(data))
+    else:
+        def _dec_memoryview(self, data):
+            """ Decode a memoryview of the received data. """
+            view = memoryview(self._dec_bdata(data))
+            if not view:
+                # Views cannot be cast to shapes with zeros
+                return view.cast(data['format'])
+            return view.cast(data['format'], data['shape'])
 
     def _dec_bdata(self, data):
+        if self.binary:
+            return data['data']
         return base64.b64decode(data['data'].encode('ascii'))
 
-    def _dec_items(self, data):
-        return (self._dec(item) for item in data['items'])
+    # Range and slice
+
+    def _dec_range(self, data):
+        return _range(data['start'], data['stop'], data['step'])
+
+    def _dec_slice(self, data):
+        self._push(Placeholder, [],
+                   (data['start'], data['stop'], data['step']),
+                   finish=_make_slice)
+        return Placeholder
+
+    # Container types
+
+    def _dec_list(self, data):
+        lst = []
+        self._push(lst, lst, data['items'], defer=True)
+        return lst
+
+    def _dec_tuple(self, data):
+        self._push(Placeholder, [], data['items'], finish=_make_tuple)
+        return Placeholder
+
+    def _dec_set(self, data):
+        self._push(Placeholder, [], data['items'], finish=_make_set)
+        return Placeholder
+
+    def _dec_frozenset(self, data):
+        self._push(Placeholder, [], data['items'], finish=_make_frozenset)
+        return Placeholder
+
+    def _dec_dict(self, data):
+        dct = {}
+        # Keys and values are decoded alternately, then paired up
+        self._push(dct, [], _chain(_map(_key_value, data['items'])),
+                   finish=_fill_dict, defer=True)
+        return dct
+
+    def _dec_array(self, data):
+        items = self._unpack_array(data, self.arrays)
+        if type(items) is list and data['tuple']:
+            return tuple(items)
+        return items
+
+    def _unpack_array(self, data, as_array):
+        """ Unpack a packed array as an `array.array` object or a list. """
+        fmt = data['typecode']
+        typecode = _array_typecodes.get(fmt)
+        bdata = self._dec_bdata(data)
+        if typecode is None:
+            # No array type with a matching layout on this platform
+            count = len(bdata) // struct.calcsize(fmt)
+            items = list(struct.unpack('<{}{}'.format(count, fmt), bdata))
+        else:
+            arr = array.array(typecode)
+            _array_frombytes(arr, bdata)
+            if _swap_bytes:
+                arr.byteswap()
+            if as_array:
+                return arr
+            items = arr.tolist()
+
+        if fmt == '?':
+            items = [bool(x) for x in items]
+        return items
+
+    def _dec_ndarray(self, data):
+        """
+        Decode a NumPy array.  The array is a read-only view of the received
+        data.
+        """
+        import numpy
+        arr = numpy.frombuffer(self._dec_bdata(data), dtype=data['dtype'])
+        return arr.reshape(data['shape'], order=data['order'])
+
+    def _dec_records(self, data):
+        as_array = self.arrays and self.columns
+        columns = [self._unpack_array(column, as_array)
+                   if column['type'] == 'array'
+                   else [self._dec_uncached(item) for item in column['items']]
+                   for column in data['columns']]
+        keys = data['keys']
+        if keys is not None:
+            keys = [self._dec_uncached(key) for key in keys]
+
+        if self.columns:
+            return dict(zip(_range(len(columns)) if keys is None else keys,
+                            columns))
+
+        length = data['length']
+        if keys is None:
+            rows = list(zip(*columns)) if columns else [()] * length
+        else:
+            rows = ([dict(zip(keys, values)) for values in zip(*columns)]
+                    if columns else [{} for _ in _range(length)])
+        return tuple(rows) if data['tuple'] else rows
+
+    def _dec_pickle(self, data):
+        return pickling.loads(self._dec_bdata(data))
 
-    def _dec_dict_items(self, data):
-        return ((self._dec(kv['key']), self._dec(kv['value']))
-                for kv in data['items'])
+    def _dec_uncached(self, data):
+        """ Decode a value of a native type without using the cache. """
+        if self.binary and type(data) is not dict:
+            return data
+        return self.decoders[data['type']](self, data)
 
     def _dec_ref(self, data):
         """ Decode an object reference. """
         # Implemented by client/server subclasses
-        raise NotImplemented()
+        raise NotImplementedError()
+
+    decoders = {
+        'None': _dec_none,
+        'NotImplemented': _dec_notimplemented,
+        'Ellipsis': _dec_ellipsis,
+        'bool': _dec_number,
+        'int': _dec_number,
+        'bigint': _dec_bigint,
+        'float': _dec_number,
+        'complex': _dec_complex,
+        'bytes': _dec_bytes,
+        'unicode': _dec_unicode,
+        'bytearray': _dec_bytearray,
+        'array.array': _dec_pyarray,
+        'memoryview': _dec_memoryview,
+        'range': _dec_range,
+        'slice': _dec_slice,
+        'list': _dec_list,
+        'tuple': _dec_tuple,
+        'set': _dec_set,
+        'frozenset': _dec_frozenset,
+        'dict': _dec_dict,
+        'array': _dec_array,
+        'records': _dec_records,
+        'pickle': _dec_pickle,
+        'ndarray': _dec_ndarray,
+    }
+
+
+class CacheIndexer(object):
+    """
+    Assign session cache indices to the nodes of an encoded object.
+
+    Nodes are visited in the same order as by `BaseDecodingSession` (with
+    cycles enabled), but without decoding them, so that cache pointers can be
+    resolved out of order.  Nodes are only visited as far as needed to find a
+    requested index.  Nodes of types other than the built-in container types
+    are assumed to have no children.
+    """
+
+    def __init__(self, data, binary=False):
+        self.binary = binary
+        self.nodes = []  # Nodes by cache index
+        self.indices = {}  # Cache index by node id, for dict nodes
+        self.stack = [iter((data,))]
+        self.deferred = collections.deque()
+
+    def node(self, index):
+        """ Return the node with the given cache index. """
+        while len(self.nodes) <= index:
+            if not self._advance():
+                raise ValueError("Invalid cache index: {}".format(index))
+        return self.nodes[index]
+
+    def index(self, node):
+        """ Return the cache index of a dict node. """
+        key = id(node)
+        while key not in self.indices:
+            if not self._advance():
+                raise ValueError("Node not found")
+        return self.indices[key]
+
+    def _advance(self):
+        """ Visit the next node.  Returns false if there are no more. """
+        stack = self.stack
+        while True:
+            if not stack:
+                if not self.deferred:
+                    return False
+                stack.append(self.deferred.popleft())
+            for data in stack[-1]:
+                break
+            else:
+                stack.pop()
+                continue
+
+            if self.binary and type(data) is not dict:
+                self.nodes.append(data)
+                return True
+            dtype = data['type']
+            if dtype == 'ref' or dtype == 'cached':
+                continue
+            self.indices[id(data)] = len(self.nodes)
+            self.nodes.append(data)
+            if dtype == 'list':
+                self.deferred.append(iter(data['items']))
+            elif dtype == 'dict':
+                self.deferred.append(_chain(_map(_key_value, data['items'])))
+            elif dtype in ('tuple', 'set', 'frozenset'):
+                stack.append(iter(data['items']))
+            elif dtype == 'slice':
+                stack.append(iter((data['start'], data['stop'],
+                                   data['step'])))
+            return True
 
 
 class PlaceholderType(object):
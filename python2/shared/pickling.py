@@ -0,0 +1,155 @@
+"""
+Restricted pickling of plain data.
+
+Values made up only of None, bool, int, long, float, complex, byte strings,
+unicode strings, bytearrays, lists, tuples, dicts, sets, and frozensets can be
+transferred as pickles with protocol 2, which both Python 2 and Python 3 can
+read and write with their C-accelerated picklers.  Subclasses of these types
+are not supported.
+
+`dumps` refuses values containing any other objects, and `loads` refuses
+pickles which refer to any globals other than those needed to rebuild the
+supported types.  Python 2 byte strings are unpickled as `bytes` in Python 3.
+"""
+
+import codecs
+import io
+import sys
+
+if sys.version_info[0] == 2:
+    import cPickle as pickle
+    _bytes = str
+    _unicode = unicode  # noqa
+    _memo_items = dict.itervalues
+else:
+    import pickle
+    _bytes = bytes
+    _unicode = str
+
+    def _memo_items(memo):
+        return memo.copy().values()
+
+
+PROTOCOL = 2
+
+
+class _Unsupported(Exception):
+    """ Raised while pickling an object of an unsupported type. """
+
+
+def _bytearray(source=b'', encoding=None):
+    """
+    Create a bytearray from its pickled arguments.  The encoding is a byte
+    string when unpickling a Python 2 bytearray in Python 3.
+    """
+    if encoding is None:
+        return bytearray(source)
+    if isinstance(encoding, _bytes):
+        encoding = encoding.decode('ascii')
+    return bytearray(source, encoding)
+
+
+# Globals referred to by pickles of the supported types, by module and name as
+# written by Python 2 and by Python 3 with `fix_imports`
+_globals = {
+    ('__builtin__', 'set'): set,
+    ('__builtin__', 'frozenset'): frozenset,
+    ('__builtin__', 'complex'): complex,
+    ('__builtin__', 'bytearray'): _bytearray,
+    ('__builtin__', 'bytes'): _bytes,
+    ('_codecs', 'encode'): codecs.encode,
+}
+
+# Types which the picklers handle by reduction rather than natively
+_reduced_types = frozenset({set, frozenset, complex, bytearray})
+
+# Types of objects which may be stored in a pickler's memo
+_memo_types = frozenset({
+    _bytes, _unicode, bytearray, complex, list, tuple, dict, set, frozenset,
+})
+
+# Ids of globals which may be stored in a pickler's memo
+_memo_globals = frozenset(map(id, [
+    set, frozenset, complex, bytearray, _bytes, codecs.encode,
+]))
+
+
+def _find_global(module, name):
+    try:
+        return _globals[module, name]
+    except KeyError:
+        raise pickle.UnpicklingError(
+            "Global {}.{} is not allowed".format(module, name))
+
+
+def _check_memo(memo):
+    """ Raise _Unsupported if a pickler's memo has an unsupported object. """
+    objs = [item[1] for item in _memo_items(memo)]
+    if set(map(type, objs)) <= _memo_types:
+        return
+    for obj in objs:
+        if type(obj) not in _memo_types and id(obj) not in _memo_globals:
+            raise _Unsupported()
+
+
+if sys.version_info[0] == 2:
+    def _reject(obj):
+        # Called by cPickle for objects which it does not handle natively
+        if type(obj) not in _reduced_types:
+            raise _Unsupported()
+
+    def _pickler(file):
+        pickler = pickle.Pickler(file, PROTOCOL)
+        pickler.inst_persistent_id = _reject
+        return pickler
+
+    def _unpickler(file):
+        unpickler = pickle.Unpickler(file)
+        unpickler.find_global = _find_global
+        return unpickler
+else:
+    # Byte strings are reduced to calls to `codecs.encode` with protocol 2
+    _dispatched_types = _reduced_types | {type(codecs.encode)}
+
+    class _DispatchTable(object):
+        # Consulted by the pickler for objects which it does not handle
+        # natively.  A KeyError lets the object be pickled as usual.
+        def __getitem__(self, cls):
+            if cls in _dispatched_types:
+                raise KeyError(cls)
+            raise _Unsupported()
+
+    def _pickler(file):
+        pickler = pickle.Pickler(file, PROTOCOL)
+        pickler.dispatch_table = _DispatchTable()
+        return pickler
+
+    class _Unpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            return _find_global(module, name)
+
+    def _unpickler(file):
+        return _Unpickler(file, encoding='bytes')
+
+
+def dumps(obj):
+    """
+    Pickle a value with protocol 2.  Returns None if the value contains any
+    objects of unsupported types, or is nested too deeply to pickle.
+    """
+    file = io.BytesIO()
+    pickler = _pickler(file)
+    try:
+        pickler.dump(obj)
+        # Classes, functions, and old-style instances are pickled without
+        # consulting the hooks above, but are always memoized.
+        _check_memo(pickler.memo)
+    except (_Unsupported, RuntimeError):
+        # RuntimeError: maximum recursion depth exceeded
+        return None
+    return file.getvalue()
+
+
+def loads(data):
+    """ Unpickle a value pickled by `dumps`. """
+    return _unpickler(io.BytesIO(data)).load()
@@ -0,0 +1,469 @@
+"""
+Message protocols for Python 2 client/server communication.
+
+A protocol determines how messages are serialized and framed on the wire.
+Each session begins with the JSON protocol.  The client may then negotiate a
+different protocol with the server using the ``negotiate`` command; the new
+protocol takes effect for all messages following the server's response.
+
+Messages are sent in one or more chunks.  Each chunk is written as a frame:
+a 4-byte big-endian header holding the chunk's length in the low 29 bits and
+the following flags in the high bits, followed by the chunk itself:
+
+    0x80000000  The chunk is compressed with zlib
+    0x40000000  More chunks of the same message follow
+    0x20000000  The sender failed to serialize the message; the chunks sent
+                so far should be discarded.  The chunk is empty.
+
+Where the file has a file descriptor, each frame is written with a single
+system call (a vectored write in Python 3), and frames are read straight from
+the descriptor into a reusable buffer, usually a whole frame per system call.
+
+In the JSON protocol, each message is serialized as JSON before it is sent.
+The binary protocol uses the format defined in `python2.shared.binary`.  Its
+messages are streamed: each message is written as it is serialized, and read
+back incrementally as it is deserialized.
+
+Both sides accept compressed chunks once the binary protocol is in use, but a
+side only compresses the chunks it sends if compression was negotiated.
+
+If a string table size was negotiated, short strings are interned in
+connection-wide string tables (see `python2.shared.binary.StringTable`), one
+for each direction.
+
+If a blob threshold was negotiated, large strings in binary messages are sent
+as shared-memory blobs (see `python2.shared.shm`).  The receiver removes each
+blob as it reads it, and the sender calls `release_blobs` to remove the blobs
+of messages which were not read in full: the client once the server has
+responded to all of its commands, and the server when it receives a command
+which the client did not pipeline behind unread responses.
+"""
+
+import io
+import json
+import os
+import struct
+import zlib
+
+from python2.shared import binary, shm
+
+
+_FRAME_HEADER = struct.Struct('>I')
+_COMPRESSED = 0x80000000
+_MORE = 0x40000000
+_ABORTED = 0x20000000
+_SIZE_MASK = 0x1fffffff
+_FLAGS = _COMPRESSED | _MORE | _ABORTED
+
+# Default minimum size in bytes of messages to compress
+DEFAULT_COMPRESS_THRESHOLD = 16384
+
+# Default size in bytes of message chunks
+DEFAULT_CHUNK_SIZE = binary.DEFAULT_CHUNK_SIZE
+
+# Default number of strings in each string table
+DEFAULT_STRING_TABLE_SIZE = 4096
+
+# Maximum size in bytes of frames which are copied into a single buffer to be
+# written, where vectored writes are not available
+_JOIN_MAX = 65536
+
+# Initial size in bytes of the buffer frames are read into
+_READ_BUFFER_SIZE = 65536
+
+_writev = getattr(os, 'writev', None)  # Not available in Python 2
+
+
+class MessageAborted(ValueError):
+    """
+    Raised when a message fails to serialize after some of it was written.
+    The message is then marked as aborted, so the reader gets an error
+    instead of the message.
+    """
+
+
+def _fileno(f):
+    """ Return the file descriptor of a file object, or None. """
+    fileno = getattr(f, 'fileno', None)
+    if fileno is None:
+        return None
+    try:
+        return fileno()
+    except io.UnsupportedOperation:
+        return None
+
+
+def _write_all(fd, data):
+    """ Write all of a byte string to a file descriptor. """
+    written = os.write(fd, data)
+    if written < len(data):
+        view = memoryview(data)[written:]
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def _write_frame(outfile, header, payload):
+    """ Write a frame with the given header value and payload. """
+    header = _FRAME_HEADER.pack(header)
+    fd = _fileno(outfile)
+    if fd is None:
+        outfile.write(header)
+        outfile.write(payload)
+        outfile.flush()
+    elif _writev is not None:
+        written = _writev(fd, (header, payload))
+        if written < len(header):
+            _write_all(fd, header[written:])
+            written = len(header)
+        if written < len(header) + len(payload):
+            _write_all(fd, memoryview(payload)[written-len(header):])
+    elif len(payload) <= _JOIN_MAX:
+        _write_all(fd, header + payload)
+    else:
+        _write_all(fd, header)
+        _write_all(fd, payload)
+
+
+def _bytes(payload):
+    """ Return a frame payload as a byte string. """
+    return payload.tobytes() if type(payload) is memoryview else payload
+
+
+if bytes is str:  # Python 2
+    _json_text = _bytes  # json.loads() accepts ASCII byte strings
+else:
+    def _json_text(payload):
+        """ Decode a JSON frame payload. """
+        return str(payload, 'ascii')
+
+
+class _FileFrameReader(object):
+    """ Reads frames from a file object without a file descriptor. """
+
+    def __init__(self, infile):
+        self.file = infile
+        self._header = bytearray(_FRAME_HEADER.size)  # Reused for each read
+
+    def read_frame(self):
+        """
+        Read a frame, and return its header value and payload, or
+        ``(None, None)`` at end of file.
+        """
+        size = self.file.readinto(self._header)
+        if not size:
+            return None, None
+        if size < _FRAME_HEADER.size:
+            raise EOFError("Incomplete message header")
+        header, = _FRAME_HEADER.unpack_from(self._header)
+        length = header & _SIZE_MASK
+        payload = self.file.read(length)
+        if len(payload) < length:
+            raise EOFError("Incomplete message")
+        return header, payload
+
+
+class _FdFrameReader(object):
+    """
+    Reads frames from a file's descriptor into a reusable buffer.
+
+    Each system call reads as much as is available, which usually brings in a
+    frame's header and payload together.  Payloads are returned as views of
+    the buffer, which are only valid until the next read.  The buffer grows
+    to hold the largest frame read.
+    """
+
+    def __init__(self, infile, fd, size=_READ_BUFFER_SIZE):
+        self.file = infile
+        self._raw = io.FileIO(fd, 'rb', closefd=False)
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0  # Unread data in the buffer
+
+    def read_frame(self):
+        """
+        Read a frame, and return its header value and payload, or
+        ``(None, None)`` at end of file.
+        """
+        start = self._start
+        end = self._end
+        if start == end:
+            # Nothing is buffered, so read from the start of the buffer
+            start = self._start = 0
+            end = self._end = self._raw.readinto(self._view)
+            if not end:
+                return None, None
+        if end - start >= _FRAME_HEADER.size:
+            header, = _FRAME_HEADER.unpack_from(self._buf, start)
+            stop = start + _FRAME_HEADER.size + (header & _SIZE_MASK)
+            if stop <= end:
+                # The whole frame is buffered
+                self._start = stop
+                return header, self._view[start+_FRAME_HEADER.size:stop]
+        return self._read_partial_frame()
+
+    def _read_partial_frame(self):
+        """ Read a frame which is not entirely buffered. """
+        available = self._fill(_FRAME_HEADER.size)
+        if not available:
+            return None, None
+        if available < _FRAME_HEADER.size:
+            raise EOFError("Incomplete message header")
+        header, = _FRAME_HEADER.unpack_from(self._buf, self._start)
+        size = _FRAME_HEADER.size + (header & _SIZE_MASK)
+        if available < size and self._fill(size) < size:
+            raise EOFError("Incomplete message")
+        start = self._start
+        self._start += size
+        return header, self._view[start+_FRAME_HEADER.size:self._start]
+
+    def _fill(self, size):
+        """
+        Read until at least `size` bytes are buffered, and return the number
+        of bytes buffered, which is less than `size` at end of file.
+        """
+        available = self._end - self._start
+        if self._start + size > len(self._buf):
+            # Move the unread data to the front, growing the buffer if needed
+            data = self._view[self._start:self._end].tobytes()
+            if size > len(self._buf):
+                self._buf = bytearray(max(size, 2 * len(self._buf)))
+                self._view = memoryview(self._buf)
+            self._buf[:available] = data
+            self._start, self._end = 0, available
+        while available < size:
+            count = self._raw.readinto(self._view[self._end:])
+            if not count:
+                break
+            self._end += count
+            available += count
+        return available
+
+
+class _FramedProtocol(object):
+    """
+    Base class for protocols which send messages as frames.
+
+    The protocol keeps a frame reader for the last file it read from, with
+    any data read ahead from it.  Protocols are only switched between a
+    response and the next command, when no data can have been read ahead.
+    """
+
+    def __init__(self, chunk_size):
+        if not 0 < chunk_size <= _SIZE_MASK:
+            raise ValueError("Invalid chunk size: {}".format(chunk_size))
+        self.chunk_size = chunk_size
+        self._reader = None
+
+    def _frame_reader(self, infile):
+        """ Return the frame reader for a file. """
+        reader = self._reader
+        if reader is None or reader.file is not infile:
+            fd = _fileno(infile)
+            if fd is None:
+                reader = _FileFrameReader(infile)
+            else:
+                reader = _FdFrameReader(infile, fd)
+            self._reader = reader
+        return reader
+
+    def release_blobs(self):
+        """ Remove the blobs of the messages written so far, if unread. """
+
+    def _payload(self, header, payload):
+        """ Check and decompress the payload of a frame. """
+        if header & _ABORTED:
+            raise ValueError("Message aborted by sender")
+        if header & _COMPRESSED:
+            size = len(payload)
+            payload = zlib.decompress(_bytes(payload))
+            self.bytes_saved += len(payload) - size
+        return payload
+
+    def _read_chunks(self, reader, header, payload):
+        """
+        Generate the chunks of a message as byte strings, starting with its
+        first frame.
+        """
+        while True:
+            yield _bytes(self._payload(header, payload))
+            if not header & _MORE:
+                return
+            header, payload = reader.read_frame()
+            if header is None:
+                raise EOFError("Incomplete message header")
+
+
+class JsonProtocol(_FramedProtocol):
+    """
+    JSON protocol.  Messages are serialized as JSON, and written in chunks of
+    `chunk_size` bytes.
+    """
+
+    name = 'json'
+    binary = False
+    bytes_saved = 0
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        super(JsonProtocol, self).__init__(chunk_size)
+
+    def write(self, outfile, data):
+        """ Write a message to a file. """
+        payload = json.dumps(data).encode('ascii')
+        chunk_size = self.chunk_size
+        if len(payload) <= chunk_size:
+            _write_frame(outfile, len(payload), payload)
+            return
+        for start in range(0, len(payload) - chunk_size, chunk_size):
+            _write_frame(outfile, chunk_size | _MORE,
+                         payload[start:start+chunk_size])
+        start = len(payload) - (len(payload) - 1) % chunk_size - 1
+        _write_frame(outfile, len(payload) - start, payload[start:])
+
+    def read(self, infile):
+        """ Read a message from a file, or return None at end of file. """
+        reader = self._reader
+        if reader is None or reader.file is not infile:
+            reader = self._frame_reader(infile)
+        header, payload = reader.read_frame()
+        if header is None:
+            return None
+        if header & _FLAGS:
+            payload = b''.join(self._read_chunks(reader, header, payload))
+        return json.loads(_json_text(payload))
+
+
+class BinaryProtocol(_FramedProtocol):
+    """
+    Chunked binary protocol.
+
+    Messages are written in chunks of `chunk_size` bytes as they are
+    serialized.  If `compress_level` is not None, chunks of at least
+    `compress_threshold` bytes are compressed with zlib at the given level,
+    unless compression would not make them smaller.  The number of bytes
+    saved by compression, for messages both written and read, is counted in
+    `bytes_saved`.
+
+    If `string_table_size` is nonzero, strings are interned in string tables
+    of that size.
+
+    If `blob_threshold` is nonzero, strings of at least that many bytes are
+    written as shared-memory blobs.
+    """
+
+    name = 'binary'
+    binary = True
+
+    def __init__(self, compress_level=None,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 string_table_size=0, chunk_size=DEFAULT_CHUNK_SIZE,
+                 blob_threshold=0):
+        super(BinaryProtocol, self).__init__(chunk_size)
+        self.compress_level = compress_level
+        self.compress_threshold = compress_threshold
+        self.bytes_saved = 0
+        if string_table_size:
+            self.write_strings = binary.StringTable(string_table_size)
+            self.read_strings = binary.StringTable(string_table_size)
+        else:
+            self.write_strings = self.read_strings = None
+        if blob_threshold:
+            self.write_blobs = shm.BlobWriter(blob_threshold)
+            self.read_blobs = shm.BlobReader()
+        else:
+            self.write_blobs = self.read_blobs = None
+
+    def write(self, outfile, data):
+        """ Write a message to a file. """
+        started = [False]  # Whether any chunks have been written
+
+        def write_chunk(payload, more):
+            self._write_chunk(outfile, payload, _MORE if more else 0)
+            started[0] = True
+
+        try:
+            binary.dump(data, write_chunk, self.write_strings,
+                        self.chunk_size, self.write_blobs)
+        except (TypeError, ValueError) as e:
+            if not started[0]:
+                raise
+            _write_frame(outfile, _ABORTED, b'')
+            raise MessageAborted(
+                "Failed to serialize message: {}".format(e))
+
+    def _write_chunk(self, outfile, payload, flags):
+        size = len(payload)
+        if (self.compress_level is not None
+                and size >= self.compress_threshold):
+            compressed = zlib.compress(payload, self.compress_level)
+            if len(compressed) < size:
+                self.bytes_saved += size - len(compressed)
+                payload = compressed
+                size = len(compressed)
+                flags |= _COMPRESSED
+        _write_frame(outfile, size | flags, payload)
+
+    def read(self, infile):
+        """ Read a message from a file, or return None at end of file. """
+        reader = self._reader
+        if reader is None or reader.file is not infile:
+            reader = self._frame_reader(infile)
+        header, payload = reader.read_frame()
+        if header is None:
+            return None
+        if not header & _MORE:
+            # Single-chunk message
+            if header & _FLAGS:
+                payload = self._payload(header, payload)
+            return binary.loads(_bytes(payload), self.read_strings,
+                                blobs=self.read_blobs)
+        chunks = self._read_chunks(reader, header, payload)
+        return binary.loads(next(chunks), self.read_strings,
+                            lambda: next(chunks, None), self.read_blobs)
+
+    def release_blobs(self):
+        """ Remove the blobs of the messages written so far, if unread. """
+        if self.write_blobs is not None:
+            self.write_blobs.release()
+
+
+# Supported protocols, in order of preference
+PROTOCOLS = (BinaryProtocol, JsonProtocol)
+
+_protocols_by_name = {p.name: p for p in PROTOCOLS}
+
+
+def get_protocol(name, compression=None, string_table=None,
+                 blob_threshold=None):
+    """
+    Return a protocol instance by name.
+
+    The remaining arguments are negotiated options for the binary protocol.
+    If given, `compression` is a dict of compression settings with keys
+    ``level`` and ``threshold``, `string_table` is the size of the string
+    tables, and `blob_threshold` is the minimum size of blobs.
+    """
+    try:
+        protocol_type = _protocols_by_name[name]
+    except KeyError:
+        raise ValueError("Unsupported protocol: {!r}".format(name))
+    options = {}
+    if compression is not None:
+        options.update(compress_level=compression['level'],
+                       compress_threshold=compression['threshold'])
+    if string_table:
+        options.update(string_table_size=string_table)
+    if blob_threshold:
+        options.update(blob_threshold=blob_threshold)
+    return protocol_type(**options)
+
+
+def select_protocol(names):
+    """
+    Choose a protocol from a list of names in order of preference.
+
+    Returns the name of the first supported protocol, or None.
+    """
+    for name in names:
+        if name in _protocols_by_name:
+            return name
+    return None
@@ -0,0 +1,472 @@
+"""
+Shared-memory transport for Python 2 client/server communication.
+
+Instead of pipes, the client and server may exchange messages through a pair
+of ring buffers, one for each direction, in a shared memory-mapped file (under
+``/dev/shm`` where available).  The pipes are then used only for wakeups: a
+process whose ring is empty (or, when writing, full) first spins for a short
+time waiting for the other process, and then blocks reading a byte from its
+pipe, which the other process writes only while it is blocked.  Closing a
+pipe still marks the end of the session.
+
+`RingReader` and `RingWriter` are file-like objects which take the place of
+the pipe files.
+
+Each ring starts with a header of four 32-bit counters, each in its own cache
+line, followed by the ring's data:
+
+    head            Number of bytes written, stored by the writer
+    tail            Number of bytes read, stored by the reader
+    reader waiting  Nonzero while the reader is blocked
+    writer waiting  Nonzero while the writer is blocked
+
+Head and tail wrap around modulo 2**32.  Python has no memory barriers, so
+loads and stores of the counters are ordered with respect to each other and
+to the data by acquiring and releasing a lock, which is a full memory barrier.
+
+Independently of the transport, large strings in binary protocol messages may
+be sent out of band as blobs: the sender writes each one to a new file in the
+shared-memory directory, and the message carries only the file's name and
+size (see `BlobWriter` and `BlobReader`).  The receiver maps the file and
+removes it, so that data for a memoryview or array need not be copied at all.
+The sender removes the files of any message which was not read in full.
+"""
+
+import errno
+import fcntl
+import itertools
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+_PY2 = sys.version_info[0] == 2
+
+# Default size in bytes of the data in each ring
+DEFAULT_RING_SIZE = 1 << 20
+
+# Default minimum size in bytes of strings sent as blobs
+DEFAULT_BLOB_THRESHOLD = 1 << 20
+
+_BLOB_PREFIX = 'python2-blob-'
+
+_blob_ids = itertools.count()
+
+# Native byte order and alignment, so that each counter is loaded and stored
+# with a single instruction
+_COUNTER = struct.Struct('I')
+_COUNTER_MASK = 0xffffffff
+
+# Offsets of the counters in a ring's header
+_HEAD = 0
+_TAIL = 64
+_READER_WAITING = 128
+_WRITER_WAITING = 192
+_HEADER_SIZE = 256
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+# Time in seconds to spin before blocking.  Spinning only delays the other
+# process if there is a single CPU.
+SPIN_TIME = 50e-6 if _cpu_count() > 1 else 0
+
+_barrier_lock = threading.Lock()
+
+
+def _barrier():
+    """ Execute a full memory barrier. """
+    _barrier_lock.acquire()
+    _barrier_lock.release()
+
+
+def _shm_dir():
+    """ Return the directory for shared-memory files. """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def create_file(ring_size=DEFAULT_RING_SIZE):
+    """
+    Create an anonymous shared-memory file for a pair of rings with
+    `ring_size` bytes of data each, and return its file descriptor.  The ring
+    size must be a power of 2 no greater than 2**31.
+    """
+    if not 0 < ring_size <= 1 << 31 or ring_size & (ring_size - 1):
+        raise ValueError("Invalid ring size: {}".format(ring_size))
+    fd, path = tempfile.mkstemp(prefix='python2-', dir=_shm_dir())
+    try:
+        os.unlink(path)
+        os.ftruncate(fd, 2 * (_HEADER_SIZE + ring_size))
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+def open_files(fd, infile, outfile, server=False):
+    """
+    Return a ``(reader, writer)`` pair of files for one side of a
+    shared-memory transport, given the file descriptor of a file created with
+    `create_file`.  `infile` and `outfile` are the pipes from and to the other
+    side, which the returned files use for wakeups and close when both are
+    closed.  The client writes to the first ring and reads from the second,
+    and the server does the opposite.
+    """
+    mm = mmap.mmap(fd, 0)
+    try:
+        ring_size = len(mm) // 2
+        rings = [_Ring(mm, 0, ring_size), _Ring(mm, ring_size, ring_size)]
+        if server:
+            rings.reverse()
+        flags = fcntl.fcntl(outfile.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(outfile.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    except Exception:
+        mm.close()
+        raise
+    channel = _Channel(mm, infile, outfile)
+    return RingReader(rings[1], channel), RingWriter(rings[0], channel)
+
+
+class _Ring(object):
+    """ A ring buffer at an offset in a shared memory map. """
+
+    def __init__(self, mm, offset, size):
+        self.mm = mm
+        self.offset = offset
+        self.start = offset + _HEADER_SIZE
+        self.capacity = size - _HEADER_SIZE
+        self.mask = self.capacity - 1
+
+    def load(self, counter):
+        return _COUNTER.unpack_from(self.mm, self.offset + counter)[0]
+
+    def store(self, counter, value):
+        _COUNTER.pack_into(self.mm, self.offset + counter, value)
+
+
+class _Channel(object):
+    """ Shared memory and wakeup pipes of one side of a transport. """
+
+    def __init__(self, mm, infile, outfile):
+        self.mm = mm
+        self.infile = infile
+        self.outfile = outfile
+        self.refs = 2
+
+    def wait(self, ring, counter, ready):
+        """
+        Wait until `ready()` returns true, setting the given counter while
+        blocked.  Returns false if the other side closed its pipe first.
+        """
+        if SPIN_TIME:
+            deadline = time.time() + SPIN_TIME
+            while time.time() < deadline:
+                if ready():
+                    return True
+        ring.store(counter, 1)
+        try:
+            # Order the store of the counter before the loads in ready()
+            _barrier()
+            while not ready():
+                try:
+                    if not os.read(self.infile.fileno(), 4096):
+                        return ready()
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            ring.store(counter, 0)
+        return True
+
+    def wake(self, ring, counter):
+        """ Wake the other side if the given counter shows it is blocked. """
+        # Order the caller's stores before the load of the counter
+        _barrier()
+        if ring.load(counter):
+            try:
+                os.write(self.outfile.fileno(), b'\0')
+            except OSError as e:
+                # If the pipe is full, the other side will wake anyway.  If it
+                # is closed, the other side has exited, and reads will see
+                # the end of file.
+                if e.errno not in (errno.EAGAIN, errno.EPIPE):
+                    raise
+
+    def release(self):
+        self.refs -= 1
+        if not self.refs:
+            try:
+                self.infile.close()
+                self.outfile.close()
+            finally:
+                self.mm.close()
+
+
+class RingReader(object):
+    """ File-like object for reading from a ring. """
+
+    def __init__(self, ring, channel):
+        self._ring = ring
+        self._channel = channel
+        self._mm = ring.mm
+        self._start = ring.start
+        self._capacity = ring.capacity
+        self._mask = ring.mask
+        self._tail = ring.load(_TAIL)
+        self._head = self._tail  # Last head loaded
+        self._released = self._tail  # Last tail stored
+        # Tail is stored once half the ring has been read, or before blocking
+        self._half = ring.capacity // 2
+        self.closed = False
+
+    def _has_data(self):
+        return self._ring.load(_HEAD) != self._tail
+
+    def read(self, size):
+        """ Read `size` bytes, or fewer at end of file. """
+        tail = self._tail
+        pos = tail & self._mask
+        if ((self._head - tail) & _COUNTER_MASK < size
+                or pos + size > self._capacity):
+            return self._read_slow(size)
+        start = self._start + pos
+        data = self._mm[start:start+size]
+        self._tail = (tail + size) & _COUNTER_MASK
+        if ((self._tail - self._released) & _COUNTER_MASK
+                >= self._half):
+            self._release()
+        return data
+
+    def _read_slow(self, size):
+        """ Read data which wraps around the ring or has not been loaded. """
+        chunks = []
+        while size:
+            data = self._read_some(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        if ((self._tail - self._released) & _COUNTER_MASK
+                >= self._half):
+            self._release()
+        return b''.join(chunks)
+
+    def _read_some(self, size):
+        """ Read up to `size` bytes, or return b'' at end of file. """
+        ring = self._ring
+        tail = self._tail
+        if self._head == tail:
+            if ring.load(_HEAD) == tail:
+                # Let the writer reuse the space read so far
+                self._release()
+                if not self._channel.wait(ring, _READER_WAITING,
+                                          self._has_data):
+                    return b''
+            self._head = ring.load(_HEAD)
+            # Order the loads of the data after the load of head
+            _barrier()
+        pos = tail & self._mask
+        size = min(size, (self._head - tail) & _COUNTER_MASK,
+                   self._capacity - pos)
+        start = self._start + pos
+        self._tail = (tail + size) & _COUNTER_MASK
+        return self._mm[start:start+size]
+
+    def _release(self):
+        """ Let the writer reuse the space read. """
+        if self._tail != self._released:
+            # Order the loads of the data before the store of tail
+            _barrier()
+            self._ring.store(_TAIL, self._tail)
+            self._released = self._tail
+            self._channel.wake(self._ring, _WRITER_WAITING)
+
+    def readinto(self, b):
+        """ Read into a writable buffer, and return the number of bytes. """
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._channel.release()
+
+
+class RingWriter(object):
+    """ File-like object for writing to a ring. """
+
+    def __init__(self, ring, channel):
+        self._ring = ring
+        self._channel = channel
+        self._mm = ring.mm
+        self._start = ring.start
+        self._capacity = ring.capacity
+        self._mask = ring.mask
+        self._head = ring.load(_HEAD)
+        self._flushed = self._head  # Last head stored
+        self._tail = ring.load(_TAIL)  # Last tail loaded
+        self.closed = False
+
+    def _has_space(self):
+        return self._ring.load(_TAIL) != self._tail
+
+    def write(self, data):
+        """
+        Write a byte string.  The data is not visible to the reader until the
+        writer is flushed, or the ring is full.
+        """
+        if _PY2 and not isinstance(data, bytes):
+            data = bytes(bytearray(data))  # mmap only accepts str
+        head = self._head
+        pos = head & self._mask
+        size = len(data)
+        if (size > self._capacity - ((head - self._tail) & _COUNTER_MASK)
+                or pos + size > self._capacity):
+            self._write_slow(data)
+            return size
+        start = self._start + pos
+        self._mm[start:start+size] = data
+        self._head = (head + size) & _COUNTER_MASK
+        return size
+
+    def _write_slow(self, data):
+        """ Write data which wraps around the ring or does not fit in it. """
+        ring = self._ring
+        offset = 0
+        while offset < len(data):
+            head = self._head
+            free = self._capacity - ((head - self._tail) & _COUNTER_MASK)
+            if not free:
+                self._wait_for_space()
+                continue
+            pos = head & self._mask
+            size = min(len(data) - offset, free, self._capacity - pos)
+            start = self._start + pos
+            ring.mm[start:start+size] = data[offset:offset+size]
+            self._head = (head + size) & _COUNTER_MASK
+            offset += size
+
+    def _wait_for_space(self):
+        ring = self._ring
+        if ring.load(_TAIL) == self._tail:
+            # Let the reader read the data written so far
+            self.flush()
+            if not self._channel.wait(ring, _WRITER_WAITING,
+                                      self._has_space):
+                raise IOError(errno.EPIPE, os.strerror(errno.EPIPE))
+        self._tail = ring.load(_TAIL)
+        # Order the load of tail before the stores of data
+        _barrier()
+
+    def flush(self):
+        """ Make the data written visible to the reader. """
+        if self._head != self._flushed:
+            # Order the stores of data before the store of head
+            _barrier()
+            self._ring.store(_HEAD, self._head)
+            self._flushed = self._head
+            self._channel.wake(self._ring, _READER_WAITING)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.flush()
+            finally:
+                self._channel.release()
+
+
+class BlobWriter(object):
+    """
+    Writes strings of at least `threshold` bytes to blobs, for the messages
+    sent in one direction of a connection.
+
+    Blob names contain the process ID and a counter, so that a name is never
+    reused while the process is running.  `release` removes any blobs
+    written so far which the reader has not removed.
+    """
+
+    def __init__(self, threshold=DEFAULT_BLOB_THRESHOLD):
+        if threshold < 1:
+            raise ValueError("Invalid blob threshold: {}".format(threshold))
+        self.threshold = threshold
+        self.directory = _shm_dir()
+        self.paths = []
+
+    def put(self, data):
+        """
+        Write a byte string to a new blob and return the blob's name, or
+        return None if the blob could not be written (e.g. if shared memory
+        is full).
+        """
+        name = '{}{}-{}'.format(_BLOB_PREFIX, os.getpid(), next(_blob_ids))
+        path = os.path.join(self.directory, name)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError:
+            return None
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        except (IOError, OSError):
+            os.unlink(path)
+            return None
+        finally:
+            os.close(fd)
+        self.paths.append(path)
+        return name
+
+    def release(self):
+        """ Remove the blobs written so far, if they still exist. """
+        paths, self.paths = self.paths, []
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class BlobReader(object):
+    """
+    Reads the blobs written by another process's `BlobWriter`.  Each blob is
+    removed once it is mapped, and can only be read once.
+    """
+
+    def __init__(self):
+        self.directory = _shm_dir()
+
+    def get(self, name, size, view=False):
+        """
+        Return the data of a blob of `size` bytes.  If `view` is true, return
+        a read-only buffer of the mapped blob instead of a byte string.
+        """
+        if not name.startswith(_BLOB_PREFIX) or os.sep in name:
+            raise ValueError("Invalid blob name: {!r}".format(name))
+        path = os.path.join(self.directory, name)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.unlink(path)
+            if os.fstat(fd).st_size != size:
+                raise ValueError("Blob {!r} is not {} bytes long".format(
+                    name, size))
+            mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if view:
+            # The map is closed when the buffer is garbage collected
+            return buffer(mm) if _PY2 else memoryview(mm)  # noqa
+        try:
+            return mm[:]
+        finally:
+            mm.close()
@@ -0,0 +1,64 @@
+from python2.client.codec import ClientArgumentCache, ClientEncodingSession
+
+
+def large_tuple():
+    return tuple(u'item {}'.format(i) for i in range(1000))
+
+
+def encode(obj, arg_cache):
+    return ClientEncodingSession(None, binary=True,
+                                 arg_cache=arg_cache).encode(obj)
+
+
+def test_fingerprint():
+    arg_cache = ClientArgumentCache(1 << 20, None, binary=True)
+    t = large_tuple()
+    digest, size = arg_cache.fingerprint(t)
+    assert size > arg_cache.min_size
+    assert arg_cache.fingerprint(t) == (digest, size)
+    assert arg_cache.fingerprint(large_tuple()) == (digest, size)
+    assert arg_cache.fingerprint(frozenset(t))[0] != digest
+
+
+def test_fingerprint_ineligible():
+    arg_cache = ClientArgumentCache(1 << 20, None, binary=True)
+    assert arg_cache.fingerprint((1, 2, 3)) is None  # Too short
+    assert arg_cache.fingerprint(tuple(range(20))) is None  # Too small
+    assert arg_cache.fingerprint(large_tuple() + ([],)) is None  # Mutable
+    assert arg_cache.fingerprint(large_tuple() + ((1, []),)) is None
+    assert ClientArgumentCache(100, None).fingerprint(large_tuple()) is None
+
+
+def test_encode():
+    arg_cache = ClientArgumentCache(1 << 20, None, binary=True)
+    t = large_tuple()
+    digest, size = arg_cache.fingerprint(t)
+
+    encoded = encode((t, t), arg_cache)
+    assert encoded['items'][0] == {
+        'type': 'content', 'digest': digest, 'size': size,
+        'value': {'type': 'tuple', 'items': list(t)},
+    }
+    assert encoded['items'][1] == {'type': 'cached', 'index': 1}
+    assert digest in arg_cache
+
+    encoded = encode({u'table': t}, arg_cache)
+    assert encoded['items'][0]['value'] == {
+        'type': 'digest', 'digest': digest}
+    assert encode(t, arg_cache) == {'type': 'digest', 'digest': digest}
+
+
+def test_encode_nested():
+    # Only arguments are fingerprinted, not the values nested in them
+    arg_cache = ClientArgumentCache(1 << 20, None, binary=True)
+    t = large_tuple()
+    encoded = encode(([t],), arg_cache)
+    assert encoded['items'][0]['items'][0] == {
+        'type': 'tuple', 'items': list(t)}
+    assert len(arg_cache) == 0
+
+
+def test_encode_small():
+    arg_cache = ClientArgumentCache(1 << 20, None, binary=True)
+    assert encode((1, 2), arg_cache) == {'type': 'tuple', 'items': [1, 2]}
+    assert len(arg_cache) == 0
@@ -0,0 +1,130 @@
+import pytest
+
+from python2.client.codec import ClientDecodingSession, LazyDecodingSession
+from python2.client.lazy import LazyDict, LazyList
+from python2.shared.codec import BaseEncodingSession
+
+
+class EncodingSession(BaseEncodingSession):
+    def _enc_ref(self, obj):
+        raise TypeError("Unsupported type: {}".format(type(obj).__name__))
+
+
+def encode(obj, **options):
+    return EncodingSession(**options).encode(obj)
+
+
+def lazy_decode(data, **options):
+    return LazyDecodingSession(None, **options).decode(data)
+
+
+def lazy_cases():
+    yield []
+    yield [1, u'a', b'b', None, 2.5]
+    yield {u'a': [1, {u'b': (2, 3)}], (1, 2): {3}}
+    yield [[i, {u'x': i}] for i in range(20)]
+    yield (slice(1, [2]), frozenset([(1, 2)]))
+    yield list(range(100))  # Packed array
+
+
+@pytest.mark.parametrize('binary', (False, True))
+@pytest.mark.parametrize('cycles', (False, True))
+@pytest.mark.parametrize('obj', lazy_cases())
+def test_lazy_decode(obj, binary, cycles):
+    data = encode(obj, binary=binary, cycles=cycles)
+    decoded = lazy_decode(data, binary=binary, cycles=cycles)
+    assert decoded == obj
+    if isinstance(decoded, (LazyList, LazyDict)):
+        materialized = decoded.materialize()
+        assert type(materialized) is type(obj)
+        assert materialized == obj
+
+
+def test_lazy_types():
+    decoded = lazy_decode(encode([[1], {2: 3}, ([4],)]))
+    assert type(decoded) is LazyList
+    assert type(decoded[0]) is LazyList
+    assert type(decoded[1]) is LazyDict
+    assert type(decoded[2]) is tuple
+    assert type(decoded[2][0]) is LazyList
+    assert decoded[-1] is decoded[2]
+    assert decoded[1:] == [{2: 3}, ([4],)]
+    with pytest.raises(IndexError):
+        decoded[3]
+    with pytest.raises(KeyError):
+        decoded[1][4]
+    with pytest.raises(TypeError):
+        hash(decoded)
+
+
+def test_lazy_items_decoded_on_access():
+    data = encode([[i] for i in range(10)])
+    session = LazyDecodingSession(None)
+    decoded = session.decode(data)
+    assert len(session.session) == 1
+    item = decoded[5]
+    assert len(session.session) == 2
+    assert decoded[5] is item
+    assert len(session.session) == 2
+    assert item == [5]
+
+
+def test_lazy_cached_out_of_order():
+    shared = [u'x']
+    data = encode([[shared], shared, {u'k': shared}])
+    decoded = lazy_decode(data)
+    # Access the cache pointer before the object it refers to
+    assert decoded[1] is decoded[0][0]
+    assert decoded[2][u'k'] is decoded[1]
+
+    decoded = lazy_decode(data)
+    assert decoded[2][u'k'] is decoded[0][0] is decoded[1]
+
+
+def test_lazy_cyclic():
+    t = ([],)
+    t[0].append(t)
+    decoded = lazy_decode(encode(t))
+    assert type(decoded) is tuple
+    assert decoded[0][0] is decoded
+
+    d = {}
+    d[u'self'] = [d]
+    decoded = lazy_decode(encode(d))
+    assert decoded[u'self'][0] is decoded
+    assert repr(decoded) == "LazyDict({'self': LazyList([...])})"
+
+
+def test_lazy_materialize():
+    shared = [1]
+    t = ([], shared)
+    t[0].append(t)
+    obj = [t, shared, {u'a': shared}]
+    decoded = lazy_decode(encode(obj))
+    materialized = decoded.materialize()
+    assert type(materialized) is list
+    assert type(materialized[0][0]) is list
+    assert materialized[0][0][0] is materialized[0]
+    assert materialized[1] is materialized[0][1] is materialized[2][u'a']
+    # Views of the same session materialize consistently
+    assert decoded[1].materialize() is materialized[1]
+    assert decoded[2].materialize() is materialized[2]
+    assert decoded.materialize() is materialized
+
+
+def test_lazy_materialize_acyclic():
+    obj = [[1], {u'a': [2]}]
+    decoded = lazy_decode(encode(obj, cycles=False), cycles=False)
+    materialized = decoded[1].materialize()
+    assert type(materialized) is dict
+    assert type(materialized[u'a']) is list
+    assert materialized == {u'a': [2]}
+
+
+def test_lazy_matches_eager():
+    shared = u'shared'
+    obj = [{u'a': shared, u'b': (shared, [shared])} for _ in range(5)]
+    data = encode(obj, binary=True)
+    eager = ClientDecodingSession(None, binary=True).decode(data)
+    lazy = lazy_decode(data, binary=True).materialize()
+    assert lazy == eager
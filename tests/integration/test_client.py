@@ -1,8 +1,10 @@
+import gc
 import weakref
 
 import pytest
 
 from python2.client import Py2Error, Py2Object
+from python2.client import client as client_module
 
 
 def test_exception(py2, helpers):
@@ -71,3 +73,124 @@ def test_object_lifespan(py2):
     # Verify that object is no longer alive in Python 2 or 3
     assert wr2() is py2.None_
     assert wr3() is None
+
+
+def test_release_batched(py2):
+    """
+    Test that objects whose proxies are deleted are released with the next
+    command, rather than one command per object.
+    """
+    py2_weakref = py2.__import__('weakref')
+    O = py2.type(b'O', (py2.object,), {})
+    objs = [O() for _ in range(5)]
+    wrs = [py2_weakref.ref(o) for o in objs]
+    alive = py2.eval("lambda wrs: sum(wr() is not None for wr in wrs)")
+    assert alive(wrs) == 5
+
+    client = py2._client
+    py2.ping()  # Send releases of temporary objects
+    del objs
+    released = set(client.released)
+    assert len(released) == 5
+    assert alive(wrs) == 0
+    assert not released & client.released
+
+
+def test_release_recreated(py2):
+    """
+    Test that an object is kept alive if it is lifted again before its
+    release is sent.
+    """
+    holder = py2.eval("[object()]")
+    get = py2.eval("lambda holder: holder[0]")
+    o = get(holder)
+    with py2.pipeline() as pipe:
+        future = pipe.call(get, holder)
+        del o  # Not sent while pipelined commands are pending
+        assert len(py2._client.released) == 1
+    assert not py2._client.released
+    o = future.result()
+    assert py2.id(o) == py2.id(holder[0])
+    assert py2.isinstance(o, py2.object)
+
+
+def test_release_batch_size(py2, monkeypatch):
+    """ Test that an idle client sends a full batch of releases. """
+    monkeypatch.setattr(client_module, 'RELEASE_BATCH_SIZE', 10)
+    py2_objs = py2.eval("[object() for _ in range(10)]")
+    objs = py2.lift(py2_objs)
+    py2.ping()
+    del objs[:9]
+    assert len(py2._client.released) == 9
+    del objs[:]
+    assert not py2._client.released
+
+
+def test_release_lazy(py2):
+    """
+    Test that objects referenced by a lazy view are released with the view,
+    whether or not they were accessed.
+    """
+    py2_weakref = py2.__import__('weakref')
+    O = py2.type(b'O', (py2.object,), {})
+    holder = py2.eval("lambda O: [O() for _ in range(500)]")(O)
+    wrs = py2.eval("lambda w, l: [w.ref(o) for o in l]")(py2_weakref, holder)
+    alive = py2.eval("lambda wrs: sum(wr() is not None for wr in wrs)")
+    view = py2.deeplift(holder, lazy=True)
+    py2.eval("lambda l: l.__delslice__(0, len(l))")(holder)
+    assert alive(wrs) == 500
+    assert py2.isinstance(view[0], O)
+    del view
+    gc.collect()  # The views and their session form reference cycles
+    assert alive(wrs) == 0
+
+
+def test_lazy_ref_after_release(py2):
+    """
+    Test that an object referenced by a lazy view stays alive after its
+    other proxy is released.
+    """
+    holder = py2.eval("[object()]")
+    o = py2.lift(holder)[0]
+    view = py2.deeplift(holder, lazy=True)
+    del o
+    py2.ping()
+    assert py2.isinstance(view[0], py2.object)
+    py2.ping()
+
+
+def test_release_delay_after_pipeline(py2, monkeypatch):
+    """
+    Test that objects released while pipelined commands are pending are sent
+    once their responses are read, if the delay has passed.
+    """
+    monkeypatch.setattr(client_module, 'RELEASE_DELAY', 0)
+    o = py2.object()
+    length = py2.len
+    with py2.pipeline() as pipe:
+        future = pipe.call(length, [])
+        del o
+        assert len(py2._client.released) == 1
+    assert not py2._client.released
+    assert py2.lift(future.result()) == 0
+
+
+def test_release_delay_after_command(py2, monkeypatch):
+    """
+    Test that objects released while a command is running are sent after
+    it, if the delay has passed.
+    """
+    monkeypatch.setattr(client_module, 'RELEASE_DELAY', 0)
+    client = py2._client
+    holder = [py2.object()]
+    decode_result = client.decode_result
+
+    def decode_and_release(*args, **kwargs):
+        if holder:
+            holder.clear()
+            assert len(client.released) == 1
+        return decode_result(*args, **kwargs)
+
+    monkeypatch.setattr(client, 'decode_result', decode_and_release)
+    py2.ping()
+    assert not client.released
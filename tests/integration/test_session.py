@@ -1,10 +1,18 @@
+import array
+import glob
+import io
+import mmap
 import os
 import signal
+import socket
+import subprocess
 import textwrap
+import threading
+import time
 
 import pytest
 
-from python2.client import Py2Error, Py2Object
+from python2.client import LazyDict, LazyList, Py2Error, Py2Object, Python2
 
 
 def test_ping(py2):
@@ -37,6 +45,168 @@ def test_deeplift(py2, helpers):
     assert l == [1, (None, 2), 3]
 
 
+def test_deeplift_packed(py2):
+    o = py2.eval("([i * 0.5 for i in range(1000)], tuple(range(1000)),"
+                 " [True, False] * 500)")
+    floats, ints, bools = py2.deeplift(o)
+    assert floats == [i * 0.5 for i in range(1000)]
+    assert ints == tuple(range(1000))
+    assert bools == [True, False] * 500
+    assert type(bools[0]) is bool
+
+
+def test_deeplift_arrays(py2):
+    o = py2.eval("[[i * 0.5 for i in range(1000)], range(10), range(3)]")
+    floats, ints, short = py2.deeplift(o, arrays=True)
+    assert floats == array.array('d', [i * 0.5 for i in range(1000)])
+    assert ints == array.array('q', range(10))
+    assert short == [0, 1, 2]
+
+
+def test_deeplift_deep(py2command):
+    with Python2(py2command, protocol='binary') as py2:
+        o = py2.eval("reduce(lambda x, _: [(x,)], range(5000), None)")
+        l = py2.deeplift(o)
+    for _ in range(5000):
+        l = l[0][0]
+    assert l is None
+
+
+def test_deep_binary(py2command):
+    # Too deep for the JSON protocol
+    with Python2(py2command, protocol='binary') as py2:
+        o = py2.eval("reduce(lambda x, _: [x], range(3000), None)")
+        value = None
+        for _ in range(3000):
+            value = [value]
+        results = [py2.deeplift(o), py2.deeplift(py2.project(value))]
+    for l in results:
+        for _ in range(3000):
+            l, = l
+        assert l is None
+
+
+def test_deeplift_deep_json(py2command):
+    # Too deep for the JSON encoder, but the session survives
+    with Python2(py2command, protocol='json') as py2:
+        o = py2.eval("reduce(lambda x, _: [x], range(50000), None)")
+        with pytest.raises(Py2Error):
+            py2.deeplift(o)
+        assert py2.len(o) == 1
+
+
+def test_deeplift_lazy(py2):
+    o = py2.eval("[{'k': [i]} for i in range(100)] + [u'x'] * 2")
+    l = py2.deeplift(o, lazy=True)
+    assert type(l) is LazyList
+    assert type(l[50]) is LazyDict
+    assert l[50][b'k'] == [50]
+    assert l[100] is l[101]
+    m = l.materialize()
+    assert type(m) is list
+    assert m == [{b'k': [i]} for i in range(100)] + ['x'] * 2
+
+
+def test_deeplift_columnar(py2):
+    o = py2.eval("[{'id': i, 'name': u'item %d' % i} for i in range(100)]")
+    rows = py2.deeplift(o, columnar=True)
+    assert rows == [{b'id': i, b'name': 'item {}'.format(i)}
+                    for i in range(100)]
+    columns = py2.deeplift(o, columnar='columns')
+    assert columns == {b'id': list(range(100)),
+                       b'name': ['item {}'.format(i) for i in range(100)]}
+
+
+def test_deeplift_columnar_invalid(py2):
+    with pytest.raises(ValueError):
+        py2.deeplift(py2.eval("[]"), columnar='rows')
+
+
+@pytest.mark.parametrize('protocol', ('json', 'binary'))
+def test_deeplift_pickle(py2command, protocol):
+    with Python2(py2command, protocol=protocol) as py2:
+        o = py2.eval("[{'id': i, u'tags': set(['a'])} for i in range(10)]")
+        assert py2.deeplift(o, pickle=True) == [
+            {b'id': i, 'tags': {b'a'}} for i in range(10)]
+        # Unsupported objects are lifted as usual
+        o = py2.eval("[1, len]")
+        lifted = py2.deeplift(o, pickle=True)
+        assert lifted[0] == 1
+        assert isinstance(lifted[1], Py2Object)
+
+
+def test_deeplift_pickle_invalid(py2):
+    with pytest.raises(ValueError):
+        py2.deeplift(py2.eval("[]"), pickle=True, columnar=True)
+
+
+def test_project_pickle(py2):
+    obj = [1, 2**100, b'a', 'b', (1.5, None), {1j: bytearray(b'c')}]
+    p = py2.project(obj, pickle=True)
+    assert py2.repr(p) == (
+        "[1, 1267650600228229401496703205376L, 'a', u'b', (1.5, None),"
+        " {1j: bytearray(b'c')}]")
+    assert py2.deeplift(p) == obj
+    # Unsupported objects are projected as usual
+    p = py2.project([p], pickle=True)
+    assert py2.deeplift(p) == [obj]
+
+
+def test_buffer_types(py2):
+    x = py2.exec(textwrap.dedent("""
+        import array
+        x = [array.array('c', 'ab'), array.array('l', [-1, 2**40]),
+             buffer('hello', 1, 3), memoryview('xyz')]
+    """))['x']
+    arr_c, arr_l, buf, view = py2.deeplift(x)
+    assert arr_c == array.array('B', b'ab')
+    assert arr_l == array.array('l', [-1, 2**40])
+    assert type(buf) is memoryview and buf.tobytes() == b'ell'
+    assert type(view) is memoryview and view.tobytes() == b'xyz'
+
+    p = py2.project([array.array('q', [-2**62]), array.array('d', [0.5]),
+                     memoryview(b'abc')[::2]])
+    assert py2.repr(p[0]) == "array('l', [-4611686018427387904])"
+    assert py2.repr(p[1]) == "array('d', [0.5])"
+    assert py2.type(p[2]) == py2.memoryview
+    assert py2.lift(p[2].tobytes()) == b'ac'
+    # Python 2 memoryviews can only hold bytes
+    with pytest.raises(TypeError):
+        py2.project(memoryview(array.array('i', [1, 2])))
+
+
+@pytest.fixture
+def py2numpy(py2):
+    numpy = pytest.importorskip('numpy')
+    try:
+        py2numpy = py2.exec("import numpy")['numpy']
+    except Py2Error:
+        pytest.skip("NumPy is not installed in Python 2")
+    return numpy, py2numpy
+
+
+def test_ndarray(py2, py2numpy):
+    numpy, py2numpy = py2numpy
+    lifted = py2.lift(py2numpy.arange(6).reshape(2, 3))
+    assert type(lifted) is numpy.ndarray
+    assert lifted.tolist() == [[0, 1, 2], [3, 4, 5]]
+    assert not lifted.flags.writeable
+    arr = numpy.asfortranarray(numpy.arange(6, dtype='f4').reshape(3, 2))
+    projected = py2.project(arr)
+    assert py2.type(projected) == py2numpy.ndarray
+    assert py2.repr(projected.dtype) == "dtype('float32')"
+    assert (py2.lift(projected) == arr).all()
+
+
+def test_ndarray_disabled(py2command, py2numpy):
+    numpy, _ = py2numpy
+    with Python2(py2command, ndarrays=False) as py2:
+        py2numpy = py2.exec("import numpy")['numpy']
+        assert isinstance(py2.lift(py2numpy.arange(3)), Py2Object)
+        with pytest.raises(TypeError):
+            py2.project(numpy.arange(3))
+
+
 def test_exec(py2):
     d = py2.exec(textwrap.dedent("""
         class C(object):
@@ -89,3 +259,483 @@ def test_signal_handling(py2):
         os.kill(os.getpid(), signal.SIGINT)
 
     py2.ping()  # Client should not receive signal
+
+
+def test_default_protocol(py2):
+    assert py2._client.protocol.name == 'json'
+
+
+@pytest.mark.parametrize('protocol', ('binary', 'json'))
+def test_protocol(py2command, protocol):
+    with Python2(py2command, protocol=protocol) as py2:
+        assert py2._client.protocol.name == protocol
+        obj = [1, 2.5, u'abc€', b'\x00\xff', bytearray(b'x'), None]
+        assert py2.deeplift(py2.project(obj)) == obj
+
+
+@pytest.mark.parametrize('protocol', ('binary', 'json'))
+def test_bigint(py2command, protocol):
+    with Python2(py2command, protocol=protocol) as py2:
+        n = 7**50000
+        assert py2.deeplift(py2.project([n, -n])) == [n, -n]
+        assert py2.lift(py2.eval("7**50000 + 1")) == n + 1
+
+
+def test_lift_depth(py2):
+    obj = py2.eval("{'a': [[1], 2]}")
+    lifted = py2.lift(obj, depth=2)
+    assert isinstance(lifted[b'a'][0], Py2Object)
+    assert py2.lift(lifted[b'a'][0]) == [1]
+    assert lifted[b'a'][1] == 2
+    assert isinstance(py2.lift(obj, depth=0), Py2Object)
+
+
+def test_lift_depth_invalid(py2):
+    obj = py2.eval("{}")
+    with pytest.raises(ValueError):
+        py2.lift(obj, depth=-1)
+    with pytest.raises(ValueError):
+        py2.lift(obj, depth=1, spec=True)
+
+
+def test_lift_spec(py2):
+    py2.exec(
+        "class Row(object):\n"
+        "    def __init__(self, id):\n"
+        "        self.id = id\n"
+        "        self.name = u'row %d' % id\n"
+        "        self.blob = [0] * 1000\n"
+        "table = {'rows': [Row(i) for i in range(3)], 'meta': [1, 2]}\n",
+        scope=py2.eval("globals()"))
+    table = py2.eval("table")
+    lifted = py2.lift(table, spec={'rows': [{'id': True, 'name': True}],
+                                   'meta': False})
+    assert lifted[b'rows'] == [{'id': i, 'name': 'row {}'.format(i)}
+                               for i in range(3)]
+    assert py2.deeplift(lifted[b'meta']) == [1, 2]
+
+
+def test_lift_spec_keys(py2):
+    obj = py2.eval("{'rows': [{'id': i, 'name': u'row'} for i in range(3)]}")
+    lifted = py2.lift(obj, spec={'rows': [{'id': True, 'name': True}]})
+    assert lifted == py2.lift(obj, depth=4) == py2.deeplift(obj)
+    assert list(lifted) == [b'rows']
+    assert set(lifted[b'rows'][0]) == {b'id', b'name'}
+
+
+def test_lift_spec_invalid(py2):
+    with pytest.raises(Py2Error):
+        py2.lift(py2.eval("[]"), spec='a')
+
+
+def test_lift_pages(py2):
+    obj = py2.project(list(range(25)))
+    pages = list(py2.lift_pages(obj, page_size=10))
+    assert pages == [list(range(10)), list(range(10, 20)),
+                     list(range(20, 25))]
+    assert list(py2.lift_pages(py2.project((1, 2)), page_size=2)) == [[1, 2]]
+    assert list(py2.lift_pages(py2.project([]))) == []
+
+
+def test_lift_pages_mapping(py2):
+    obj = py2.project({i: [i] for i in range(25)})
+    pages = list(py2.lift_pages(obj, page_size=10))
+    assert [len(page) for page in pages] == [10, 10, 5]
+    merged = {}
+    for page in pages:
+        merged.update(page)
+    assert merged == {i: [i] for i in range(25)}
+
+
+def test_lift_pages_invalid(py2):
+    with pytest.raises(ValueError):
+        py2.lift_pages(py2.project([]), page_size=0)
+    with pytest.raises(Py2Error):
+        py2.lift_pages(py2.project(1))
+
+
+def test_open_reader(py2):
+    data = bytes(range(256)) * 100
+    obj = py2.project(data)
+    with py2.open_reader(obj, chunk_size=1000) as f:
+        assert f.read(10) == data[:10]
+        buf = bytearray(5000)
+        assert f.readinto(buf) == 5000
+        assert buf == data[10:5010]
+        assert f.read() == data[5010:]
+        assert f.read() == b''
+        f.seek(-3, io.SEEK_END)
+        assert f.read() == data[-3:]
+        f.seek(100)
+        assert f.tell() == 100
+        assert f.read(1) == data[100:101]
+
+
+@pytest.mark.parametrize('expr', ("bytearray(b'abcdef')", "buffer('abcdef')",
+                                  "memoryview(b'abcdef')"))
+def test_open_reader_types(py2, expr):
+    with py2.open_reader(py2.eval(expr), chunk_size=4) as f:
+        assert f.read() == b'abcdef'
+
+
+def test_open_reader_invalid(py2):
+    with pytest.raises(ValueError):
+        py2.open_reader(py2.project(b''), chunk_size=0)
+    with py2.open_reader(py2.project(u'abc')) as f:
+        with pytest.raises(Py2Error):
+            f.read()
+
+
+def test_compression(py2command):
+    with Python2(py2command, protocol='binary', compress_level=6,
+                 compress_threshold=1000) as py2:
+        assert py2._client.protocol.compress_level == 6
+        assert py2.deeplift(py2.eval("[u'abc'] * 1000")) == ['abc'] * 1000
+        saved = py2.bytes_saved
+        assert saved > 0
+        assert py2.deeplift(py2.project(['abc'] * 1000)) == ['abc'] * 1000
+        assert py2.bytes_saved > saved
+
+
+@pytest.mark.parametrize('option', ('compress_level', 'string_table_size',
+                                    'blob_threshold'))
+def test_binary_options_json(py2command, tmpdir, option):
+    with pytest.raises(ValueError):
+        Python2(py2command, **{option: 6})
+    with pytest.raises(ValueError):
+        # Checked before connecting
+        Python2.connect(str(tmpdir.join('python2.sock')), protocol='json',
+                        **{option: 6})
+
+
+def test_compression_invalid_level(py2command):
+    with pytest.raises(ValueError):
+        Python2(py2command, compress_level=10)
+
+
+def test_large_messages(py2command):
+    with Python2(py2command) as py2:
+        data = bytes(range(256)) * 4096
+        obj = py2.project([data, list(range(100000))])
+        assert py2.deeplift(obj) == [data, list(range(100000))]
+
+
+@pytest.mark.parametrize('protocol', ('binary', 'json'))
+def test_shm_transport(py2command, protocol):
+    with Python2(py2command, protocol=protocol, transport='shm') as py2:
+        assert py2._client.protocol.name == protocol
+        py2.ping()
+        # Larger than the rings, in both directions
+        data = u'x' * (3 << 20)
+        obj = py2.project([data, list(range(100000))])
+        assert py2.deeplift(obj) == [data, list(range(100000))]
+        with pytest.raises(Py2Error):
+            py2.eval("1/0")
+    assert py2._proc.returncode == 0
+
+
+@pytest.mark.parametrize('transport', ('pipe', 'shm'))
+def test_blobs(py2command, transport):
+    with Python2(py2command, protocol='binary', transport=transport,
+                 blob_threshold=1000) as py2:
+        blobs = py2._client.protocol.write_blobs
+        written = []
+
+        def put(data, put=blobs.put):
+            name = put(data)
+            written.append(name)
+            return name
+
+        blobs.put = put
+        data = [b'x' * 5000, u'\xe9' * 5000, bytearray(b'y' * 5000)]
+        obj = py2.project(data)
+        assert len(written) == 3
+        assert py2.deeplift(obj) == data
+        view = py2.lift(py2.memoryview(data[0]))
+        assert view == data[0]
+        assert type(view.obj) is mmap.mmap  # The data was not copied
+        with pytest.raises(Py2Error):
+            py2.eval("1/0")
+    assert py2._proc.returncode == 0
+
+
+def test_blobs_unread(py2command):
+    # Blobs of a response which the client failed to read are removed once
+    # the next command arrives
+    with Python2(py2command, protocol='binary', blob_threshold=1000) as py2:
+        blobs = py2._client.protocol.read_blobs
+        pattern = os.path.join(blobs.directory, 'python2-blob-{}-*'.format(
+            py2._proc.pid))
+        s = py2.eval("b'x' * 5000")
+
+        def get(name, size, view=False):
+            raise ValueError("Failed to read blob")
+
+        blobs.get = get
+        with pytest.raises(ValueError):
+            py2.lift(s)
+        del blobs.get
+        assert len(glob.glob(pattern)) == 1
+        py2.ping()
+        assert not glob.glob(pattern)
+
+
+def test_blobs_pipelined(py2command):
+    # Blobs of pipelined responses are kept until they are read
+    with Python2(py2command, protocol='binary', blob_threshold=1000) as py2:
+        strings = [py2.eval("b'{}' * 5000".format(c)) for c in 'abc']
+        with py2.pipeline() as pipe:
+            futures = [pipe.lift(s) for s in strings]
+            time.sleep(0.1)  # Let the server run all the commands first
+        assert [f.result() for f in futures] == [
+            c.encode() * 5000 for c in 'abc']
+
+
+def test_blobs_ndarray(py2command, py2numpy):
+    numpy, _ = py2numpy
+    with Python2(py2command, protocol='binary',
+                 blob_threshold=1000) as py2:
+        arr = numpy.arange(10000.0).reshape(100, 100)
+        projected = py2.project(arr)
+        assert py2.repr(projected.shape) == '(100, 100)'
+        lifted = py2.lift(projected)
+        assert (lifted == arr).all()
+        assert not lifted.flags.writeable
+
+
+def test_transport_invalid(py2command):
+    with pytest.raises(ValueError):
+        Python2(py2command, transport='asdf')
+
+
+@pytest.fixture
+def py2daemon_args():
+    """ Extra command line arguments for the Python 2 daemon. """
+    return []
+
+
+@pytest.fixture
+def py2daemon(py2command, py2daemon_args, tmpdir):
+    """ Path of the socket of a Python 2 daemon, and the daemon process. """
+    path = str(tmpdir.join('python2.sock'))
+    proc = subprocess.Popen([py2command, '-m', 'python2.server',
+                             '--listen', path, '--preload', 'json']
+                            + py2daemon_args)
+    try:
+        for _ in range(100):
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(path)
+                break
+            except OSError:  # Not listening yet
+                time.sleep(0.05)
+        yield path, proc
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+
+
+def test_daemon(py2daemon):
+    path, proc = py2daemon
+    with Python2.connect(path) as py2a, Python2.connect(path) as py2b:
+        scope = py2a.exec("import os, sys; sys.flag = 1; pid = os.getpid()")
+        pid = py2a.lift(scope['pid'])
+        scope = py2b.exec("import os, sys\n"
+                          "flag = hasattr(sys, 'flag')\n"
+                          "preloaded = 'json' in sys.modules\n"
+                          "pid = os.getpid()")
+        # Each connection is served by its own process
+        assert py2b.lift(scope['pid']) != pid
+        assert not py2b.lift(scope['flag'])
+        assert py2b.lift(scope['preloaded'])
+        obj = py2a.project([b'x' * (2 << 20), list(range(1000))])
+        assert py2a.deeplift(obj) == [b'x' * (2 << 20), list(range(1000))]
+        with pytest.raises(Py2Error):
+            py2b.exec("1/0")
+    # The daemon keeps serving new connections
+    with Python2.connect(path, protocol='json') as py2:
+        py2.ping()
+    assert proc.poll() is None
+
+
+def test_daemon_many_sessions(py2daemon):
+    path, proc = py2daemon
+    sessions = []
+    try:
+        # More than SocketServer.ForkingMixIn's default limit of 40
+        for _ in range(50):
+            sessions.append(Python2.connect(path))
+        for py2 in sessions:
+            py2.ping()
+    finally:
+        for py2 in sessions:
+            py2.shutdown()
+
+
+@pytest.mark.parametrize('py2daemon_args', [['--max-sessions', '1']])
+def test_daemon_max_sessions(py2daemon):
+    path, proc = py2daemon
+    result = []
+
+    def connect():
+        with Python2.connect(path) as py2:
+            py2.ping()
+            result.append(True)
+
+    with Python2.connect(path) as py2:
+        py2.ping()
+        thread = threading.Thread(target=connect)
+        thread.start()
+        # The second session waits for the first to end
+        thread.join(0.5)
+        assert thread.is_alive()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert result == [True]
+
+
+def test_daemon_terminate(py2daemon):
+    path, proc = py2daemon
+    with Python2.connect(path) as py2:
+        py2.ping()
+    proc.terminate()
+    assert proc.wait() == 0
+    assert not os.path.exists(path)
+
+
+def test_pipeline(py2):
+    divide = py2.eval('lambda x: 12 // x')
+    obj = py2.project([1, 2])
+    with py2.pipeline() as p:
+        futures = [p.call(divide, x) for x in range(4)]
+        lifted = p.lift(obj)
+        assert not lifted.done()
+    assert all(future.done() for future in futures)
+    with pytest.raises(Py2Error):
+        futures[0].result()
+    assert isinstance(futures[0].exception(), Py2Error)
+    assert [py2.lift(f.result()) for f in futures[1:]] == [12, 6, 4]
+    assert futures[1].exception() is None
+    assert lifted.result() == [1, 2]
+
+
+def test_pipeline_flow_control(py2command):
+    # Commands and results larger than the pipes must not deadlock
+    data = list(range(10000))
+    with Python2(py2command) as py2:
+        obj = py2.project(data)
+        length = py2.len
+        with py2.pipeline(max_in_flight=3) as p:
+            futures = [p.deeplift(obj) if i % 2 else p.call(length, data)
+                       for i in range(10)]
+            # Other commands wait for the pipelined ones
+            assert py2.lift(length(obj)) == 10000
+            assert all(future.done() for future in futures)
+            later = p.lift(obj)
+        assert later.result()[:3] == [0, 1, 2]
+        for i, future in enumerate(futures):
+            if i % 2:
+                assert future.result() == data
+            else:
+                assert py2.lift(future.result()) == 10000
+
+
+def test_pipeline_flow_control_error(py2command, monkeypatch):
+    # A response which fails to read while making room for a command does not
+    # stop the command from being sent, which keeps the string tables in sync
+    with Python2(py2command, protocol='binary', blob_threshold=1000) as py2:
+        obj = py2.project(b'x' * 2000)
+        identity = py2.eval('lambda x: x')
+        # New interned strings, in a command too large to fit after the
+        # lift command
+        strings = (['key {}'.format(i) for i in range(1000)]
+                   + [bytes([i]) * 900 for i in range(100)])
+
+        def get(*args):
+            raise OSError("Blob not found")
+
+        with py2.pipeline() as p:
+            future = p.lift(obj)
+            monkeypatch.setattr(py2._client.protocol.read_blobs, 'get', get)
+            sent = p.call(identity, strings)
+            assert future.done()
+            monkeypatch.undo()
+        assert isinstance(future.exception(), OSError)
+        assert py2.lift(sent.result()) == strings
+        assert py2.lift(identity(strings)) == strings
+
+
+def test_pipeline_result_before_exit(py2):
+    with py2.pipeline() as p:
+        future = p.lift(py2.project(u'abc'))
+        assert future.result() == u'abc'
+
+
+def test_pipeline_invalid(py2):
+    with pytest.raises(ValueError):
+        py2.pipeline(max_in_flight=0)
+
+
+def test_arg_cache(py2command):
+    with Python2(py2command, arg_cache_size=1 << 20) as py2:
+        table = tuple(u'item {}'.format(i) for i in range(1000))
+        length = py2.eval('len')
+        identity = py2.eval('lambda x: id(x)')
+        assert py2.lift(length(table)) == 1000
+        assert len(py2._client.codec.arg_cache) == 1
+        oid = py2.lift(identity(table))
+        # An equal value is sent by digest and is the same object in Python 2
+        assert py2.lift(identity(tuple(table))) == oid
+        assert py2.lift(identity(list(table))) != oid
+
+
+def test_arg_cache_miss(py2command):
+    with Python2(py2command, arg_cache_size=1 << 20) as py2:
+        table = frozenset(range(1000))
+        arg_cache = py2._client.codec.arg_cache
+        # Make the client believe the value is already cached
+        arg_cache.put(*arg_cache.fingerprint(table))
+        assert py2.lift(py2.eval('sum')(table)) == sum(table)
+        assert py2.lift(py2.eval('len')(table)) == 1000
+
+
+def test_arg_cache_disabled(py2command):
+    with Python2(py2command) as py2:
+        assert py2._client.codec.arg_cache is None
+
+
+def test_string_table(py2command):
+    with Python2(py2command, protocol='binary') as py2:
+        s = py2.eval("u'status'")
+        assert py2.lift(s) is py2.lift(s)
+
+
+def test_string_table_disabled(py2command):
+    with Python2(py2command, protocol='binary',
+                 string_table_size=0) as py2:
+        assert py2._client.protocol.read_strings is None
+        s = py2.eval("u'status'")
+        assert py2.lift(s) is not py2.lift(s)
+
+
+def test_acyclic(py2command):
+    with Python2(py2command, cycles=False) as py2:
+        l = [1]
+        obj = {'a': [l, l], 'b': (u'x', b'y')}
+        assert py2.deeplift(py2.project(obj)) == obj
+
+        shared = py2.deeplift(py2.eval("[[1]] * 2"))
+        assert shared == [[1], [1]]
+        assert shared[0] is not shared[1]
+
+        cyclic = py2.exec("l = []; l.append(l)")['l']
+        with pytest.raises(Py2Error):
+            py2.deeplift(cyclic)
+
+        cyclic = []
+        cyclic.append(cyclic)
+        with pytest.raises(ValueError):
+            py2.project(cyclic)
+
+        py2.ping()  # Make sure session is still ok
@@ -1,6 +1,7 @@
 import pytest
 
-from python2.server.codec import ServerCodec
+from python2.server.codec import ServerCodec, project
+from python2.shared.argcache import ArgumentCache, ArgumentCacheMiss
 from python2.shared.codec import EncodingDepth
 
 
@@ -8,6 +9,7 @@ class MockServer(object):
     def __init__(self):
         self.codec = ServerCodec(self)
         self.objects = {}
+        self.arg_cache = None
 
     def cache_add(self, obj):
         self.objects[id(obj)] = obj
@@ -200,3 +202,96 @@ def test_decoding_separate_sessions(server):
 
     assert l2 is not l1
     assert l2[0] is l2
+
+
+def test_decode_argument_cache(server):
+    server.arg_cache = ArgumentCache(100)
+    t = server.codec.decode({'type': 'tuple', 'items': [
+        {'type': 'content', 'digest': u'abc', 'size': 10, 'value': {
+            'type': 'tuple', 'items': [{'type': 'int', 'value': 1}]}},
+        {'type': 'digest', 'digest': u'abc'},
+    ]})
+    assert t == ((1,), (1,))
+    assert t[0] is t[1]
+    assert server.codec.decode({'type': 'digest', 'digest': u'abc'}) is t[0]
+
+
+def test_decode_argument_cache_miss(server):
+    with pytest.raises(ArgumentCacheMiss) as excinfo:
+        server.codec.decode({'type': 'digest', 'digest': u'abc'})
+    assert excinfo.value.digest == u'abc'
+    server.arg_cache = ArgumentCache(100)
+    with pytest.raises(ArgumentCacheMiss):
+        server.codec.decode({'type': 'digest', 'digest': u'abc'})
+
+
+class Record(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+def encode_projection(server, obj, spec):
+    return server.codec.encode(project(obj, spec), EncodingDepth.DEEP,
+                               projection=True)
+
+
+def test_projection_dict(server):
+    inner = [1, 2]
+    obj = {u'a': inner, u'b': [3], u'c': 4}
+    encoded = encode_projection(server, obj, {u'a': False, u'c': True,
+                                              u'd': True})
+    assert server.objects == {id(inner): inner}
+    decoded = server.codec.decode(encoded)
+    assert decoded == {u'a': inner, u'c': 4}
+    assert decoded[u'a'] is inner
+
+
+def test_projection_dict_keys(server):
+    obj = {'rows': [{'id': 1, 2: u'x'}]}
+    encoded = encode_projection(server, obj, {u'rows': [{u'id': True,
+                                                         2.0: True}]})
+    decoded = server.codec.decode(encoded)
+    assert decoded == obj
+    key, = decoded
+    assert type(key) is str
+    assert sorted(map(type, decoded['rows'][0])) == [int, str]
+    assert encoded == server.codec.encode(obj, EncodingDepth.DEEP)
+
+
+def test_projection_attributes(server):
+    rows = [Record(1, u'x'), Record(2, u'y')]
+    encoded = encode_projection(server, {u'rows': rows},
+                                {u'rows': [{u'id': True, u'missing': True}]})
+    decoded = server.codec.decode(encoded)
+    assert decoded == {u'rows': [{u'id': 1}, {u'id': 2}]}
+    assert server.objects == {}
+
+
+def test_projection_depth(server):
+    inner = [1]
+    obj = ([inner], 2)
+    encoded = encode_projection(server, obj, 2)
+    assert encoded == {'type': 'tuple', 'items': [
+        {'type': 'list', 'items': [{'type': 'ref', 'id': id(inner)}]},
+        {'type': 'int', 'value': 2},
+    ]}
+
+
+def test_projection_list(server):
+    obj = ([1, 2], [3])
+    encoded = encode_projection(server, obj, [1])
+    assert server.codec.decode(encoded) == (
+        [server.objects[id(1)], server.objects[id(2)]],
+        [server.objects[id(3)]],
+    )
+    assert encode_projection(server, obj, [True]) == server.codec.encode(
+        obj, EncodingDepth.DEEP)
+    encoded = encode_projection(server, 5, [True])
+    assert encoded == {'type': 'ref', 'id': id(5)}
+
+
+@pytest.mark.parametrize('spec', ([], [1, 2], -1, u'a', None))
+def test_projection_invalid(spec):
+    with pytest.raises(TypeError):
+        project([1], spec)
@@ -0,0 +1,49 @@
+from python2.shared.argcache import ArgumentCache
+
+
+def test_put_get():
+    cache = ArgumentCache(100)
+    cache.put(u'a', 10, 1)
+    cache.put(u'b', 20, 2)
+    assert len(cache) == 2
+    assert cache.nbytes == 30
+    assert u'a' in cache
+    assert cache.get(u'a') == 1
+    assert u'c' not in cache
+
+
+def test_eviction():
+    cache = ArgumentCache(100)
+    cache.put(u'a', 40, 1)
+    cache.put(u'b', 40, 2)
+    cache.get(u'a')  # Now b is the least recently used
+    cache.put(u'c', 40, 3)
+    assert u'a' in cache
+    assert u'b' not in cache
+    assert u'c' in cache
+    assert cache.nbytes == 80
+
+
+def test_put_existing():
+    cache = ArgumentCache(100)
+    cache.put(u'a', 40, 1)
+    cache.put(u'a', 50, 2)
+    assert cache.nbytes == 50
+    assert cache.get(u'a') == 2
+
+
+def test_too_large():
+    cache = ArgumentCache(100)
+    cache.put(u'a', 40, 1)
+    cache.put(u'b', 101, 2)
+    assert u'b' not in cache
+    assert u'a' in cache
+
+
+def test_discard():
+    cache = ArgumentCache(100)
+    cache.put(u'a', 40, 1)
+    cache.discard(u'a')
+    cache.discard(u'b')
+    assert len(cache) == 0
+    assert cache.nbytes == 0
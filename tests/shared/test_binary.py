@@ -0,0 +1,502 @@
+import io
+import os
+import struct
+import sys
+import threading
+
+import pytest
+
+from python2.shared import binary
+from python2.shared.codec import (BaseDecodingSession,
+                                  BaseEncodingSession,
+                                  EncodingDepth)
+from python2.shared.protocol import (BinaryProtocol,
+                                     JsonProtocol,
+                                     MessageAborted,
+                                     get_protocol,
+                                     select_protocol)
+
+
+if sys.version_info[0] == 2:
+    _long = long  # noqa
+    _unicode = unicode  # noqa
+else:
+    _long = int
+    _unicode = str
+
+
+class PassthroughEncodingSession(BaseEncodingSession):
+    def _enc_ref(self, obj):
+        return dict(type='ref', id=id(obj))
+
+
+class PassthroughDecodingSession(BaseDecodingSession):
+    def _dec_ref(self, data):
+        return data['id']
+
+
+def value_cases():
+    """ Values supported by the binary format. """
+    yield None
+    yield True
+    yield False
+    yield 0
+    yield -1
+    yield 2**63 - 1
+    yield -2**63
+    yield 2**63
+    yield -2**100
+    yield [7**20000]  # Too long for str() on newer Python versions
+    yield 0.0
+    yield -1.5e100
+    yield b''
+    yield b'abc\x00\x80\xff'
+    yield u''
+    yield u'abc\u0000\u0080\u00ff\uffff'
+    yield []
+    yield [1, [u'a', b'b'], None]
+    yield {}
+    yield {u'a': 1, u'b': [{u'a': 2}, {u'b': 3}]}
+
+
+@pytest.mark.parametrize('obj', value_cases())
+def test_roundtrip(obj):
+    data = binary.dumps(obj)
+    assert type(data) is bytes
+    obj_ = binary.loads(data)
+    assert obj_ == obj
+    if type(obj) is _long:
+        assert type(obj_) in (int, _long)
+    else:
+        assert type(obj_) is type(obj)
+
+
+@pytest.mark.parametrize('n', (0, 1, -1, 127, 128, -128, -129, 255, 256,
+                               2**64, -2**64, 2**100 - 1))
+def test_int_bytes(n):
+    data = binary.int_to_bytes(n)
+    assert type(data) is bytes
+    assert binary.int_from_bytes(data) == n
+    assert binary.int_from_bytes(b'\x00' + data if n >= 0 else
+                                 b'\xff' + data) == n
+
+
+def test_bigint():
+    assert binary.dumps(2**64) == b'I\x00\x00\x00\x09\x01' + b'\x00' * 8
+    assert binary.dumps(-2**64) == b'I\x00\x00\x00\x09\xff' + b'\x00' * 8
+
+
+def test_tuple_as_list():
+    assert binary.loads(binary.dumps((1, 2))) == [1, 2]
+
+
+def test_bytearray_as_bytes():
+    assert binary.loads(binary.dumps(bytearray(b'ab'))) == b'ab'
+
+
+def test_raw_bytes():
+    assert binary.dumps(b'\xff') == b'b\x00\x00\x00\x01\xff'
+
+
+def test_node():
+    node = {'type': 'list', 'items': [{'type': 'cached', 'index': 0}]}
+    data = binary.dumps(node)
+    # Node type and field names should not appear in the serialized data
+    assert b'list' not in data
+    assert b'items' not in data
+    assert binary.loads(data) == node
+
+
+def test_repeated_keys():
+    data = binary.dumps([{u'key': 1}, {u'key': 2}])
+    assert data.count(b'key') == 1
+    assert binary.loads(data) == [{u'key': 1}, {u'key': 2}]
+
+
+def test_deep_nesting():
+    depth = sys.getrecursionlimit() * 2
+    obj = None
+    for _ in range(depth):
+        obj = {u'a': [obj]}
+    obj = binary.loads(binary.dumps(obj))
+    for _ in range(depth):
+        obj = obj[u'a'][0]
+    assert obj is None
+
+
+def test_string_table():
+    writer = binary.StringTable(10)
+    reader = binary.StringTable(10)
+    messages = [[u'abc', b'abc', u'abc'], [b'abc', u'x' * 100, u'abc']]
+    data = [binary.dumps(message, writer) for message in messages]
+    assert data[0].count(b'abc') == 2
+    assert b'abc' not in data[1]
+    decoded = [binary.loads(d, reader) for d in data]
+    assert decoded == messages
+    assert [type(s) for s in decoded[1]] == [bytes, _unicode, _unicode]
+    # Interned strings are deduplicated
+    assert decoded[0][0] is decoded[0][2] is decoded[1][2]
+    assert decoded[0][1] is decoded[1][0]
+    assert writer.strings == reader.strings == [u'abc', b'abc']
+
+
+def test_string_table_eviction():
+    writer = binary.StringTable(2)
+    reader = binary.StringTable(2)
+    for message in ([u'a', u'b', u'c'], [u'b', u'a', u'c']):
+        assert binary.loads(binary.dumps(message, writer), reader) == message
+    # Oldest strings are replaced first
+    assert writer.strings == reader.strings == [u'c', u'a']
+
+
+def test_string_table_rollback():
+    writer = binary.StringTable(2)
+    reader = binary.StringTable(2)
+    binary.dumps([u'a', u'b'], writer)
+    binary.loads(binary.dumps([u'a', u'b'], binary.StringTable(2)), reader)
+    with pytest.raises(TypeError):
+        binary.dumps([u'c', u'd', u'e', object()], writer)
+    assert writer.strings == [u'a', u'b']
+    message = [u'd', u'a', u'c']
+    assert binary.loads(binary.dumps(message, writer), reader) == message
+
+
+def test_string_table_missing():
+    data = binary.dumps(u'a', binary.StringTable(1))
+    with pytest.raises(ValueError):
+        binary.loads(data)
+    with pytest.raises(ValueError):
+        binary.loads(b'S\x00\x00\x00\x00', binary.StringTable(1))
+
+
+def test_unsupported_type():
+    with pytest.raises(TypeError):
+        binary.dumps(object())
+
+
+@pytest.mark.parametrize('data', (b'', b'x', b'l\x00\x00\x00\x01', b'NN',
+                                  b'l\xff\xff\xff\xffN'))
+def test_invalid_data(data):
+    with pytest.raises(Exception):
+        binary.loads(data)
+
+
+def test_invalid_node_type():
+    with pytest.raises(ValueError):
+        binary.loads(b'n' + struct.pack('B', len(binary.NODE_TYPES)))
+
+
+def test_invalid_key_index():
+    data = binary.dumps([{u'a': 1}, {u'a': 2}])
+    assert data.count(b'K\x00\x00\x00\x00') == 1
+    with pytest.raises(ValueError):
+        binary.loads(data.replace(b'K\x00\x00\x00\x00',
+                                  b'K\x00\x00\x00\x01'))
+
+
+class DictBlobs(object):
+    """ Blob writer and reader which keeps blobs in a dict. """
+
+    threshold = 10
+
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, data):
+        name = u'blob{}'.format(len(self.blobs))
+        self.blobs[name] = bytes(data)
+        return name
+
+    def get(self, name, size, view):
+        data = self.blobs[name]
+        assert len(data) == size
+        return memoryview(data) if view else data
+
+
+def test_blobs():
+    blobs = DictBlobs()
+    node = dict(type='memoryview', format='B', shape=[20], data=b'z' * 20)
+    obj = [b'x' * 10, u'\xe9' * 5, bytearray(b'y' * 20), b'short', node]
+    chunks = []
+    binary.dump(obj, lambda chunk, more: chunks.append(chunk), blobs=blobs)
+    data = b''.join(chunks)
+    assert len(blobs.blobs) == 4
+    assert b'x' * 10 not in data
+    result = binary.loads(data, blobs=blobs)
+    assert result[:4] == [b'x' * 10, u'\xe9' * 5, b'y' * 20, b'short']
+    # Blobs in the data of buffer nodes are read as buffers
+    assert type(result[4]['data']) is memoryview
+    assert result[4]['data'].tobytes() == b'z' * 20
+    with pytest.raises(ValueError):
+        binary.loads(data)
+
+
+def test_blobs_not_written():
+    blobs = DictBlobs()
+    blobs.put = lambda data: None
+    obj = [b'x' * 10, 2**100]
+    chunks = []
+    binary.dump(obj, lambda chunk, more: chunks.append(chunk), blobs=blobs)
+    assert b''.join(chunks) == binary.dumps(obj)
+
+
+def test_dump_chunks():
+    obj = [u'x' * 10, list(range(100)), {u'a': b'y' * 25}]
+    chunks = []
+    binary.dump(obj, lambda chunk, more: chunks.append((chunk, more)), None,
+                chunk_size=16)
+    assert all(len(chunk) == 16 and more for chunk, more in chunks[:-1])
+    assert len(chunks[-1][0]) < 16 and not chunks[-1][1]
+    assert b''.join(chunk for chunk, _ in chunks) == binary.dumps(obj)
+
+
+def test_loads_more():
+    obj = [u'x' * 10, list(range(100)), {u'a': b'y' * 25}]
+    data = binary.dumps(obj)
+    chunks = iter([data[i:i+7] for i in range(7, len(data), 7)])
+    assert binary.loads(data[:7], more=lambda: next(chunks, None)) == obj
+    chunks = iter([data[7:-1], data[-1:], b'N'])
+    with pytest.raises(ValueError):
+        binary.loads(data[:7], more=lambda: next(chunks, None))
+    chunks = iter([data[7:-1]])
+    with pytest.raises(ValueError):
+        binary.loads(data[:7], more=lambda: next(chunks, None))
+
+
+def test_loads_more_string_table():
+    writer = binary.StringTable(10)
+    reader = binary.StringTable(10)
+    data = binary.dumps([u'a', u'b'], writer)
+
+    def more():
+        raise ValueError("Aborted")
+
+    with pytest.raises(ValueError):
+        binary.loads(data[:-1], reader, more)
+    assert len(reader) == 0
+    assert binary.loads(data, reader) == [u'a', u'b']
+
+
+def codec_cases():
+    """ Objects to encode with the codec in binary mode. """
+    yield None
+    yield 1
+    yield u'abc'
+    yield b'abc'
+    yield bytearray(b'abc')
+    yield 1+2j
+    yield [1, u'a', (b'b', None), {u'c': [2.5]}]
+    l = []
+    l.append((l, l))
+    yield l
+
+
+@pytest.mark.parametrize('obj', codec_cases())
+def test_codec_roundtrip(obj):
+    encoded = PassthroughEncodingSession(binary=True).encode(obj)
+    decoded = PassthroughDecodingSession(binary=True).decode(
+        binary.loads(binary.dumps(encoded)))
+    assert repr(decoded) == repr(obj)
+
+
+def test_codec_native_values():
+    encoded = PassthroughEncodingSession(binary=True).encode(
+        [None, True, 1, 2.0, b'a', u'b'])
+    assert encoded == {'type': 'list',
+                       'items': [None, True, 1, 2.0, b'a', u'b']}
+
+
+def test_codec_raw_data():
+    encoded = PassthroughEncodingSession(binary=True).encode(bytearray(b'a'))
+    assert encoded == {'type': 'bytearray', 'data': bytearray(b'a')}
+
+
+def test_codec_cached_native_values():
+    s = u'abc'
+    encoded = PassthroughEncodingSession(binary=True).encode(
+        [s, s], depth=EncodingDepth.DEEP)
+    assert encoded == {'type': 'list', 'items': [
+        u'abc', {'type': 'cached', 'index': 1},
+    ]}
+    decoded = PassthroughDecodingSession(binary=True).decode(encoded)
+    assert decoded[0] is decoded[1]
+
+
+@pytest.mark.parametrize('protocol', (JsonProtocol(), BinaryProtocol()))
+def test_protocol(protocol):
+    f = io.BytesIO()
+    messages = [{u'command': u'foo', u'args': []},
+                {u'result': u'return', u'value': {u'type': u'None'}}]
+    for message in messages:
+        protocol.write(f, message)
+    f.seek(0)
+    for message in messages:
+        assert protocol.read(f) == message
+    assert protocol.read(f) is None
+
+
+@pytest.mark.parametrize('protocol', (JsonProtocol(), BinaryProtocol()))
+def test_protocol_pipe(protocol):
+    # Messages larger than the pipe buffer are written while being read
+    messages = [[u'x' * 200000, list(range(20000))], None]
+    r, w = os.pipe()
+    outfile = os.fdopen(w, 'wb')
+
+    def write():
+        with outfile:
+            for message in messages:
+                protocol.write(outfile, message)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    with os.fdopen(r, 'rb') as infile:
+        for message in messages:
+            assert protocol.read(infile) == message
+        thread.join()
+        assert protocol.read(infile) is None
+
+
+@pytest.mark.parametrize('protocol', (JsonProtocol(), BinaryProtocol()))
+def test_protocol_incomplete_header(protocol):
+    with pytest.raises(EOFError):
+        protocol.read(io.BytesIO(b'\x00\x00'))
+
+
+@pytest.mark.parametrize('protocol_type', (JsonProtocol, BinaryProtocol))
+@pytest.mark.parametrize('size', (2, 10))
+def test_protocol_incomplete_pipe(protocol_type, size):
+    # Frames read from a file descriptor are buffered, and may arrive in
+    # pieces, or not at all
+    data = io.BytesIO()
+    protocol_type().write(data, [u'abc', 1])
+    r, w = os.pipe()
+    os.write(w, data.getvalue() * 2 + data.getvalue()[:size])
+    os.close(w)
+    protocol = protocol_type()
+    with os.fdopen(r, 'rb') as infile:
+        assert protocol.read(infile) == [u'abc', 1]
+        assert protocol.read(infile) == [u'abc', 1]
+        with pytest.raises(EOFError):
+            protocol.read(infile)
+
+
+def test_protocol_incomplete_message():
+    f = io.BytesIO()
+    BinaryProtocol().write(f, [1, 2, 3])
+    f = io.BytesIO(f.getvalue()[:-1])
+    with pytest.raises(EOFError):
+        BinaryProtocol().read(f)
+
+
+def test_protocol_chunks():
+    protocol = BinaryProtocol(chunk_size=16)
+    f = io.BytesIO()
+    message = [u'x' * 40, list(range(20)), b'y' * 100]
+    protocol.write(f, message)
+    protocol.write(f, None)
+    assert len(f.getvalue()) > len(binary.dumps(message)) + 4 * 5
+    f.seek(0)
+    assert protocol.read(f) == message
+    assert protocol.read(f) is None
+    assert protocol.read(f) is None
+
+
+def test_protocol_json_chunks():
+    protocol = JsonProtocol(chunk_size=16)
+    f = io.BytesIO()
+    message = [u'x' * 40, list(range(20))]
+    protocol.write(f, message)
+    protocol.write(f, u'x' * 14)
+    f.seek(0)
+    assert protocol.read(f) == message
+    assert protocol.read(f) == u'x' * 14
+    assert f.tell() == len(f.getvalue())
+    assert protocol.read(f) is None
+
+
+def test_protocol_aborted_message():
+    protocol = BinaryProtocol(chunk_size=4, string_table_size=10)
+    f = io.BytesIO()
+    with pytest.raises(MessageAborted):
+        protocol.write(f, [u'abc', u'def', object()])
+    protocol.write(f, [u'abc'])
+    f.seek(0)
+    with pytest.raises(ValueError):
+        protocol.read(f)
+    assert len(protocol.read_strings) == 0
+    assert protocol.read(f) == [u'abc']
+
+
+@pytest.mark.parametrize('protocol_type', (JsonProtocol, BinaryProtocol))
+def test_protocol_invalid_chunk_size(protocol_type):
+    with pytest.raises(ValueError):
+        protocol_type(chunk_size=0)
+
+
+def test_protocol_compression():
+    writer = BinaryProtocol(compress_level=6, compress_threshold=100)
+    reader = BinaryProtocol()
+    f = io.BytesIO()
+    small = [u'x' * 10]
+    large = [u'x' * 1000]
+    writer.write(f, small)
+    small_size = f.tell()
+    writer.write(f, large)
+    assert f.tell() - small_size < 1000
+    assert writer.bytes_saved > 900
+    f.seek(0)
+    assert reader.read(f) == small
+    assert reader.read(f) == large
+    assert reader.bytes_saved == writer.bytes_saved
+
+
+def test_protocol_compression_incompressible():
+    protocol = BinaryProtocol(compress_level=6, compress_threshold=0)
+    f = io.BytesIO()
+    protocol.write(f, None)
+    assert f.getvalue() == b'\x00\x00\x00\x01N'
+    assert protocol.bytes_saved == 0
+
+
+def test_protocol_string_table():
+    writer = BinaryProtocol(string_table_size=10)
+    reader = BinaryProtocol(string_table_size=10)
+    f = io.BytesIO()
+    writer.write(f, [u'status'])
+    size = f.tell()
+    writer.write(f, [u'status'])
+    assert f.tell() - size < size
+    f.seek(0)
+    assert reader.read(f)[0] is reader.read(f)[0]
+
+
+def test_protocol_blobs():
+    writer = BinaryProtocol(blob_threshold=100)
+    reader = BinaryProtocol(blob_threshold=100)
+    message = [b'x' * 1000, u'\xe9' * 1000, b'y' * 10]
+    f = io.BytesIO()
+    writer.write(f, message)
+    assert f.tell() < 100
+    f.seek(0)
+    assert reader.read(f) == message
+    # The reader removes each blob as it reads it
+    assert not any(os.path.exists(path) for path in writer.write_blobs.paths)
+    writer.release_blobs()
+    assert not writer.write_blobs.paths
+
+
+def test_get_protocol_compression():
+    protocol = get_protocol(u'binary', {u'level': 1, u'threshold': 10})
+    assert protocol.compress_level == 1
+    assert protocol.compress_threshold == 10
+    assert get_protocol(u'binary').compress_level is None
+    assert get_protocol(u'binary', string_table=5).write_strings.size == 5
+    assert get_protocol(u'binary').write_strings is None
+    with pytest.raises(ValueError):
+        get_protocol(u'asdf')
+
+
+def test_select_protocol():
+    assert select_protocol([u'asdf', u'binary', u'json']) == u'binary'
+    assert select_protocol([u'json', u'binary']) == u'json'
+    assert select_protocol([u'asdf']) is None
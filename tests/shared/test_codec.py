@@ -1,9 +1,12 @@
+import array
+import base64
 import sys
 
 import pytest
 
 from python2.shared.codec import (BaseDecodingSession,
                                   BaseEncodingSession,
+                                  CacheIndexer,
                                   EncodingDepth)
 
 
@@ -67,7 +70,9 @@ def basic_cases():
     yield True, {'type': 'bool', 'value': True}
     yield False, {'type': 'bool', 'value': False}
     yield 0, {'type': 'int', 'value': 0}
-    yield 2**100, {'type': 'int', 'value': 2**100}
+    yield 2**63 - 1, {'type': 'int', 'value': 2**63 - 1}
+    yield 2**100, {'type': 'bigint', 'data': 'EAAAAAAAAAAAAAAAAA=='}
+    yield -2**63 - 1, {'type': 'bigint', 'data': '/3//////////'}
     yield 0.0, {'type': 'float', 'value': 0.0}
     yield -0.123, {'type': 'float', 'value': -0.123}
     yield 1e100, {'type': 'float', 'value': 1e100}
@@ -283,6 +288,9 @@ def roundtrip_cases():
     for obj, encoded in basic_cases():
         yield obj
 
+    # Test ints too long for decimal conversion on newer Python versions
+    yield [7**20000, -7**20000]
+
     # Test multi-element sets, frozensets, and dicts
     yield {1, 2}
     yield frozenset({1, 2})
@@ -444,6 +452,616 @@ def test_decode_refs(decoding_session, encoded, obj, depth):
         assert_isomorphic(decoding_session.decode(encoded), obj)
 
 
+class DummyEncodingSession(PassthroughEncodingSession):
+    """ Encoding session extended with an encoder for DummyObject. """
+    def _enc_dummy(self, obj, depth):
+        return dict(type='dummy')
+
+    encoders = dict(PassthroughEncodingSession.encoders)
+    encoders[DummyObject] = _enc_dummy
+
+
+class DummyDecodingSession(PassthroughDecodingSession):
+    """ Decoding session extended with a decoder for DummyObject. """
+    def _dec_dummy(self, data):
+        return DummyObject()
+
+    decoders = dict(PassthroughDecodingSession.decoders,
+                    dummy=_dec_dummy)
+
+
+def test_extended_encoders():
+    o = DummyObject()
+    encoded = DummyEncodingSession().encode([o, o])
+    assert encoded == {'type': 'list', 'items': [
+        {'type': 'dummy'},
+        {'type': 'cached', 'index': 1},
+    ]}
+    # Depth limit still applies
+    encoded = DummyEncodingSession().encode(o, depth=EncodingDepth.REF)
+    assert encoded == {'type': 'ref', 'object': o}
+
+
+def test_extended_decoders():
+    decoded = DummyDecodingSession().decode({'type': 'list', 'items': [
+        {'type': 'dummy'},
+        {'type': 'cached', 'index': 1},
+    ]})
+    assert type(decoded[0]) is DummyObject
+    assert decoded[0] is decoded[1]
+
+
+def test_decode_invalid_type(decoding_session):
+    with pytest.raises(TypeError):
+        decoding_session.decode({'type': 'dummy'})
+
+
+def array_cases():
+    """ Sequences which should be encoded as packed arrays. """
+    yield list(range(8))
+    yield list(range(-sys.maxsize - 1, -sys.maxsize + 99))
+    yield [sys.maxsize] * 10
+    yield tuple(range(100))
+    yield [0.5 * i for i in range(10)]
+    yield [float('inf'), -0.0] * 4
+    yield [True, False] * 5
+    yield tuple([False] * 8)
+
+
+@pytest.mark.parametrize('binary', (False, True))
+@pytest.mark.parametrize('seq', array_cases())
+def test_array_roundtrip(seq, binary):
+    encoded = PassthroughEncodingSession(binary=binary).encode(seq)
+    assert encoded['type'] == 'array'
+    assert encoded['tuple'] == (type(seq) is tuple)
+    decoded = PassthroughDecodingSession(binary=binary).decode(encoded)
+    # Element identity is not preserved
+    assert type(decoded) is type(seq)
+    assert decoded == seq
+    assert [type(x) for x in decoded] == [type(x) for x in seq]
+
+
+def test_array_encoding():
+    encoded = PassthroughEncodingSession().encode([1, -1, 1, -1])
+    assert encoded['type'] == 'list'
+    encoded = PassthroughEncodingSession().encode([1, -1] * 4)
+    assert encoded == {
+        'type': 'array',
+        'tuple': False,
+        'typecode': 'q',
+        # Little-endian 64-bit integers
+        'data': ('AQAAAAAAAAD//////////wEAAAAAAAAA//////////8B'
+                 'AAAAAAAAAP//////////AQAAAAAAAAD//////////w=='),
+    }
+
+
+@pytest.mark.parametrize('seq', array_cases())
+def test_array_decode_as_array(seq):
+    encoded = PassthroughEncodingSession().encode(seq)
+    decoded = PassthroughDecodingSession(arrays=True).decode(encoded)
+    assert type(decoded) is array.array
+    assert list(decoded) == list(seq)
+
+
+def unpacked_cases():
+    """ Sequences which should not be encoded as packed arrays. """
+    yield list(range(7))  # Too short
+    yield [1] * 7 + [1.0]  # Mixed types
+    yield [1] * 7 + [True]
+    yield [2**63] * 8  # Overflow
+    yield [-2**63 - 1] * 8
+    yield [None] * 8
+    yield [u'a'] * 8
+    yield [[1]] * 8
+
+
+@pytest.mark.parametrize('seq', unpacked_cases())
+def test_array_unpacked(seq):
+    encoded = PassthroughEncodingSession().encode(seq)
+    assert encoded['type'] == 'list'
+
+
+def test_array_shallow():
+    seq = list(range(10))
+    encoded = PassthroughEncodingSession().encode(
+        seq, depth=EncodingDepth.SHALLOW)
+    assert encoded['type'] == 'list'
+
+
+def test_array_cached():
+    # A packed array may be referenced from the session cache, but its
+    # elements do not participate.
+    seq = list(range(10))
+    obj = [seq, 0, seq]
+    encoded = PassthroughEncodingSession().encode(obj)
+    assert encoded['items'][1:] == [
+        {'type': 'int', 'value': 0},
+        {'type': 'cached', 'index': 1},
+    ]
+    decoded = PassthroughDecodingSession().decode(encoded)
+    assert_isomorphic(decoded, obj)
+
+
+def records_cases():
+    """ Sequences which should be encoded as record batches. """
+    yield [{u'id': i, u'name': u'item {}'.format(i), u'score': i * 0.5,
+            u'ok': i % 2 == 0, b'tag': None} for i in range(10)]
+    yield tuple({u'a': i, u'b': b'x'} for i in range(8))
+    yield [(i, u'a', 2.5) for i in range(20)]
+    yield [{}] * 8
+    yield [()] * 8
+    # Key order may vary between records
+    yield [{u'a': 1, u'b': 2}, {u'b': 3, u'a': 4}] * 4
+    # Columns are not packed if they have mixed types
+    yield [(i, 1.0 if i % 2 else 1) for i in range(8)]
+
+
+@pytest.mark.parametrize('binary', (False, True))
+@pytest.mark.parametrize('cycles', (False, True))
+@pytest.mark.parametrize('seq', records_cases())
+def test_records_roundtrip(seq, binary, cycles):
+    encoded = PassthroughEncodingSession(
+        binary=binary, cycles=cycles, records=True).encode(seq)
+    assert encoded['type'] == 'records'
+    decoded = PassthroughDecodingSession(
+        binary=binary, cycles=cycles).decode(encoded)
+    assert type(decoded) is type(seq)
+    assert decoded == seq
+    for row, row_ in zip(seq, decoded):
+        assert type(row_) is type(row)
+        if type(row) is dict:
+            assert ({k: type(v) for k, v in row_.items()}
+                    == {k: type(v) for k, v in row.items()})
+        else:
+            assert [type(x) for x in row_] == [type(x) for x in row]
+
+
+def test_records_encoding():
+    seq = [{u'a': i, u'b': u'x'} for i in range(8)]
+    encoded = PassthroughEncodingSession(binary=True, records=True).encode(seq)
+    assert encoded == {
+        'type': 'records',
+        'tuple': False,
+        'length': 8,
+        'keys': [u'a', u'b'],
+        'columns': [
+            {'type': 'array', 'tuple': False, 'typecode': u'q',
+             'data': PassthroughEncodingSession(binary=True).encode(
+                 list(range(8)))['data']},
+            {'type': 'list', 'items': [u'x'] * 8},
+        ],
+    }
+
+
+def test_records_disabled():
+    seq = [{u'a': i} for i in range(8)]
+    encoded = PassthroughEncodingSession().encode(seq)
+    assert encoded['type'] == 'list'
+
+
+def unbatched_cases():
+    """ Sequences which should not be encoded as record batches. """
+    yield [{u'a': 1}] * 7  # Too short
+    yield [{u'a': 1}] * 7 + [{u'b': 1}]  # Different keys
+    yield [{u'a': 1}] * 7 + [{u'a': 1, u'b': 2}]
+    yield [(1,)] * 7 + [(1, 2)]  # Different lengths
+    yield [(1,)] * 7 + [[1]]  # Mixed record types
+    yield [{u'a': 1}] * 7 + [(1,)]
+    yield [{(1, 2): 1}] * 8  # Non-native key
+    yield [{u'a': [1]}] * 8  # Non-native value
+    yield [(1, 2j)] * 8
+    yield [[1, 2]] * 8  # Lists are not records
+    yield list(range(8))
+
+
+@pytest.mark.parametrize('seq', unbatched_cases())
+def test_records_unbatched(seq):
+    encoded = PassthroughEncodingSession(records=True).encode(seq)
+    assert encoded['type'] in ('list', 'array')
+
+
+@pytest.mark.parametrize('depth', (1, 2))
+def test_records_depth(depth):
+    seq = [{u'a': i} for i in range(8)]
+    encoded = PassthroughEncodingSession(records=True).encode(
+        seq, depth=depth)
+    assert encoded['type'] == 'list'
+
+
+def test_records_copied():
+    # Records do not participate in the session cache
+    row = {u'a': 1}
+    obj = [[row] * 8, row]
+    encoded = PassthroughEncodingSession(records=True).encode(obj)
+    assert encoded['items'][0]['type'] == 'records'
+    assert encoded['items'][1]['type'] == 'dict'
+    decoded = PassthroughDecodingSession().decode(encoded)
+    assert decoded == obj
+    assert decoded[0][0] is not decoded[0][1]
+    assert decoded[0][0] is not decoded[1]
+
+
+def test_records_cached():
+    # A record batch may be referenced from the session cache
+    seq = [(i,) for i in range(8)]
+    obj = [seq, u'a', seq]
+    encoded = PassthroughEncodingSession(records=True).encode(obj)
+    decoded = PassthroughDecodingSession().decode(encoded)
+    assert decoded == obj
+    assert decoded[0] is decoded[2]
+
+
+def test_records_decode_columns():
+    seq = [{u'id': i, u'name': u'item {}'.format(i)} for i in range(10)]
+    encoded = PassthroughEncodingSession(records=True).encode(seq)
+    decoded = PassthroughDecodingSession(columns=True).decode(encoded)
+    assert decoded == {u'id': list(range(10)),
+                       u'name': [u'item {}'.format(i) for i in range(10)]}
+
+    decoded = PassthroughDecodingSession(columns=True, arrays=True).decode(
+        encoded)
+    assert type(decoded[u'id']) is array.array
+    assert list(decoded[u'id']) == list(range(10))
+    assert decoded[u'name'] == [u'item {}'.format(i) for i in range(10)]
+
+
+def test_records_decode_tuple_columns():
+    seq = [(i, i * 0.5) for i in range(10)]
+    encoded = PassthroughEncodingSession(records=True).encode(seq)
+    decoded = PassthroughDecodingSession(columns=True).decode(encoded)
+    assert decoded == {0: list(range(10)), 1: [i * 0.5 for i in range(10)]}
+
+
+@pytest.mark.parametrize('binary', (False, True))
+@pytest.mark.parametrize('cycles', (False, True))
+def test_pickle(binary, cycles):
+    obj = [{u'id': i, u'tags': {b'a', b'b'}} for i in range(10)]
+    encoded = PassthroughEncodingSession(
+        binary=binary, cycles=cycles, pickle=True).encode(obj)
+    assert encoded['type'] == 'pickle'
+    decoded = PassthroughDecodingSession(
+        binary=binary, cycles=cycles).decode(encoded)
+    assert decoded == obj
+
+
+def test_pickle_fallback():
+    obj = [1, DummyObject()]
+    encoded = PassthroughEncodingSession(pickle=True).encode(obj)
+    assert encoded['type'] == 'list'
+    assert PassthroughDecodingSession().decode(encoded) == obj
+
+
+def test_pickle_shallow():
+    encoded = PassthroughEncodingSession(pickle=True).encode(
+        [1], EncodingDepth.SHALLOW)
+    assert encoded['type'] == 'list'
+
+
+def test_pickle_cached():
+    # Pickled values keep the session caches in step
+    l = [1]
+    t = (2,)
+    encoder = PassthroughEncodingSession(pickle=True)
+    decoder = PassthroughDecodingSession()
+    encoded = [encoder.encode(l),
+               encoder.encode(t, EncodingDepth.SHALLOW),
+               encoder.encode(t, EncodingDepth.SHALLOW)]
+    assert encoded[0]['type'] == 'pickle'
+    assert encoded[2]['type'] == 'cached'
+    decoded = [decoder.decode(data) for data in encoded]
+    assert decoded == [l, t, t]
+    assert decoded[1] is decoded[2]
+
+
+def pyarray_cases():
+    yield array.array('b', [-1, 2])
+    yield array.array('L', [0, 2**32])
+    yield array.array('d', [1.5, -2.0])
+    yield array.array('u', u'ab\u20ac')
+    yield array.array('i')
+
+
+@pytest.mark.parametrize('binary', (False, True))
+@pytest.mark.parametrize('arr', pyarray_cases())
+def test_pyarray(arr, binary):
+    encoded = PassthroughEncodingSession(binary=binary).encode(arr)
+    assert encoded['type'] == 'array.array'
+    assert encoded['itemsize'] == arr.itemsize
+    decoded = PassthroughDecodingSession(binary=binary).decode(encoded)
+    assert type(decoded) is array.array
+    assert decoded.typecode == arr.typecode
+    assert decoded == arr
+
+
+def test_pyarray_itemsize():
+    # Arrays are decoded with a typecode of the same kind and size
+    encoded = PassthroughEncodingSession().encode(array.array('l', [-1, 2]))
+    encoded['typecode'] = 'q'
+    decoded = PassthroughDecodingSession().decode(encoded)
+    assert decoded.itemsize == array.array('l').itemsize
+    assert decoded.tolist() == [-1, 2]
+    encoded['itemsize'] = 3
+    with pytest.raises(ValueError):
+        PassthroughDecodingSession().decode(encoded)
+
+
+@pytest.mark.parametrize('binary', (False, True))
+def test_memoryview(binary):
+    view = memoryview(b'abcde')[1:4]
+    encoded = PassthroughEncodingSession(binary=binary).encode([view, view])
+    assert encoded['items'][0]['format'] == 'B'
+    assert encoded['items'][0]['shape'] == [3]
+    decoded = PassthroughDecodingSession(binary=binary).decode(encoded)
+    assert type(decoded[0]) is memoryview
+    assert decoded[0].tobytes() == b'bcd'
+    assert decoded[0].readonly
+    assert decoded[1] is decoded[0]
+
+
+if PYTHON_VERSION == 2:
+    def test_buffer():
+        buf = buffer(b'abcde', 1, 3)  # noqa
+        encoded = PassthroughEncodingSession().encode(buf)
+        assert encoded['format'] == 'B'
+        decoded = PassthroughDecodingSession().decode(encoded)
+        assert type(decoded) is memoryview
+        assert decoded.tobytes() == b'bcd'
+
+    def test_memoryview_format():
+        # Python 2 sends memoryviews of any simple format
+        encoded = PassthroughEncodingSession().encode(
+            memoryview(b'abcd'))
+        encoded['format'] = 'H'
+        encoded['shape'] = [2]
+        decoded = PassthroughDecodingSession().decode(encoded)
+        assert decoded.tobytes() == b'abcd'
+else:
+    def test_memoryview_format():
+        view = memoryview(array.array('i', range(6))).cast('B').cast(
+            'i', [2, 3])
+        t = (1,)
+        encoded = PassthroughEncodingSession().encode([view, t, t])
+        # Python 2 memoryviews are always 1-D views of bytes
+        assert encoded['items'][0] == {'type': 'ref', 'object': view}
+        decoded = PassthroughDecodingSession().decode(encoded)
+        assert decoded[1] is decoded[2]
+
+    def test_memoryview_decode_format():
+        encoded = {'type': 'memoryview', 'format': 'i', 'shape': [2, 3],
+                   'data': base64.b64encode(
+                       array.array('i', range(6)).tobytes()).decode('ascii')}
+        decoded = PassthroughDecodingSession().decode(encoded)
+        assert decoded.format == 'i'
+        assert decoded.tolist() == [[0, 1, 2], [3, 4, 5]]
+        encoded['shape'] = [0, 3]
+        encoded['data'] = ''
+        assert PassthroughDecodingSession().decode(encoded).tolist() == []
+
+
+@pytest.fixture
+def numpy():
+    return pytest.importorskip('numpy')
+
+
+def ndarray_cases(numpy):
+    yield numpy.arange(12, dtype='<f8').reshape(3, 4)
+    yield numpy.asfortranarray(numpy.arange(6, dtype='>i2').reshape(2, 3))
+    yield numpy.arange(10)[::3]
+    yield numpy.array([True, False])
+    yield numpy.array([b'ab', b'c'])
+    yield numpy.array([u'ab', u'c'])
+    yield numpy.array(['2000-01-01'], dtype='M8[D]')
+    yield numpy.zeros((0, 3))
+    yield numpy.array(1.5)
+
+
+@pytest.mark.parametrize('binary', (False, True))
+def test_ndarray(numpy, binary):
+    for arr in ndarray_cases(numpy):
+        encoded = PassthroughEncodingSession(
+            binary=binary, ndarrays=True).encode(arr)
+        assert encoded['type'] == 'ndarray'
+        decoded = PassthroughDecodingSession(binary=binary).decode(encoded)
+        assert type(decoded) is numpy.ndarray
+        assert decoded.dtype == arr.dtype
+        assert decoded.shape == arr.shape
+        assert (decoded == arr).all()
+
+
+def test_ndarray_order(numpy):
+    arr = numpy.asfortranarray(numpy.arange(6).reshape(2, 3))
+    encoded = PassthroughEncodingSession(ndarrays=True).encode(arr)
+    assert encoded['order'] == 'F'
+    decoded = PassthroughDecodingSession().decode(encoded)
+    assert decoded.flags.f_contiguous
+
+
+def test_ndarray_unsupported(numpy):
+    # Unsupported arrays are encoded by reference, keeping the session caches
+    # in step
+    arr = numpy.array([1, None])
+    t = (1,)
+    encoded = PassthroughEncodingSession(ndarrays=True).encode([arr, t, t])
+    assert encoded['items'][0] == {'type': 'ref', 'object': arr}
+    decoded = PassthroughDecodingSession().decode(encoded)
+    assert decoded[0] is arr
+    assert decoded[1] is decoded[2]
+
+
+def test_ndarray_disabled(numpy):
+    arr = numpy.arange(3)
+    encoded = PassthroughEncodingSession().encode(arr)
+    assert encoded == {'type': 'ref', 'object': arr}
+
+
+def acyclic_cases():
+    """ Test cases for encoding with cycles disabled. """
+    yield None, {'type': 'None'}
+    yield [None, None], {'type': 'list', 'items': [
+        {'type': 'None'},
+        {'type': 'None'},
+    ]}
+    yield slice(None), {'type': 'slice',
+                        'start': {'type': 'None'},
+                        'stop': {'type': 'None'},
+                        'step': {'type': 'None'}}
+
+    # Shared objects are encoded separately
+    l = []
+    yield (l, l), {'type': 'tuple', 'items': [
+        {'type': 'list', 'items': []},
+        {'type': 'list', 'items': []},
+    ]}
+    yield {1: [l], 2: l}, {'type': 'dict', 'items': [
+        {'key': {'type': 'int', 'value': 1},
+         'value': {'type': 'list', 'items': [{'type': 'list', 'items': []}]}},
+        {'key': {'type': 'int', 'value': 2},
+         'value': {'type': 'list', 'items': []}},
+    ]}
+
+
+@pytest.mark.parametrize(('obj', 'encoded'), acyclic_cases())
+def test_encode_acyclic(obj, encoded):
+    session = PassthroughEncodingSession(cycles=False)
+    assert session.encode(obj) == encoded
+    assert session.session == {}
+
+
+@pytest.mark.parametrize(('obj', 'encoded'), acyclic_cases())
+def test_decode_acyclic(encoded, obj):
+    session = PassthroughDecodingSession(cycles=False)
+    assert session.decode(encoded) == obj
+    assert session.session == []
+
+
+def test_decode_acyclic_copies():
+    l = []
+    session = PassthroughEncodingSession(cycles=False)
+    t = PassthroughDecodingSession(cycles=False).decode(session.encode((l, l)))
+    assert t == ([], [])
+    assert t[0] is not t[1]
+
+
+def cyclic_cases():
+    l = []
+    l.append(l)
+    yield l
+
+    d = {}
+    d[0] = [d]
+    yield d
+
+    t = ([],)
+    t[0].append(t)
+    yield t
+
+
+@pytest.mark.parametrize('obj', cyclic_cases())
+def test_encode_acyclic_circular_reference(obj):
+    session = PassthroughEncodingSession(cycles=False)
+    with pytest.raises(ValueError):
+        session.encode(obj)
+
+
+@pytest.mark.parametrize('depth', (EncodingDepth.REF, EncodingDepth.SHALLOW))
+def test_encode_acyclic_circular_reference_depth(depth):
+    # Circular references are allowed if not reached due to depth limit
+    l = []
+    l.append(l)
+    session = PassthroughEncodingSession(cycles=False)
+    encoded = session.encode(l, depth=depth)
+    assert PassthroughDecodingSession(cycles=False).decode(encoded) is not None
+
+
+class IndexingDecodingSession(PassthroughDecodingSession):
+    """ Decoding session which records the node for each cache index. """
+    def __init__(self, **kwargs):
+        super(IndexingDecodingSession, self).__init__(**kwargs)
+        self.nodes = []
+
+    def _dec(self, data):
+        size = len(self.session)
+        obj = super(IndexingDecodingSession, self)._dec(data)
+        if len(self.session) > size:
+            self.nodes.append(data)
+        return obj
+
+
+@pytest.mark.parametrize('binary', (False, True))
+@pytest.mark.parametrize('obj', roundtrip_cases())
+def test_cache_indexer(obj, binary):
+    # The indexer visits nodes in the same order as the decoder
+    encoded = PassthroughEncodingSession(binary=binary).encode(obj)
+    session = IndexingDecodingSession(binary=binary)
+    session.decode(encoded)
+    indexer = CacheIndexer(encoded, binary=binary)
+    for index, node in enumerate(session.nodes):
+        assert indexer.node(index) is node
+        if type(node) is dict:
+            assert indexer.index(node) == index
+    with pytest.raises(ValueError):
+        indexer.node(len(session.nodes))
+
+
+def test_decode_acyclic_cached():
+    session = PassthroughDecodingSession(cycles=False)
+    with pytest.raises(ValueError):
+        session.decode({'type': 'list', 'items': [
+            {'type': 'cached', 'index': 0},
+        ]})
+
+
+def nest(wrap, depth):
+    """ Build an object nested to the given depth. """
+    obj = None
+    for _ in range(depth):
+        obj = wrap(obj)
+    return obj
+
+
+def unnest(unwrap, obj, depth, wrapped_type):
+    """ Check the structure of an object built with `nest`. """
+    for _ in range(depth):
+        assert type(obj) is wrapped_type
+        obj = unwrap(obj)
+    assert obj is None
+
+
+def nesting_cases():
+    yield lambda x: [x], lambda x: x[0], list
+    yield lambda x: (x,), lambda x: x[0], tuple
+    yield lambda x: {0: x}, lambda x: x[0], dict
+    yield lambda x: frozenset((x,)), lambda x: next(iter(x)), frozenset
+    yield lambda x: slice(x), lambda x: x.stop, slice
+
+
+@pytest.mark.parametrize('cycles', (False, True))
+@pytest.mark.parametrize(('wrap', 'unwrap', 'wrapped_type'), nesting_cases())
+def test_deep_nesting(wrap, unwrap, wrapped_type, cycles):
+    # Encoding and decoding do not use recursion
+    depth = sys.getrecursionlimit() * 2
+    obj = nest(wrap, depth)
+    encoded = PassthroughEncodingSession(cycles=cycles).encode(obj)
+    decoded = PassthroughDecodingSession(cycles=cycles).decode(encoded)
+    unnest(unwrap, decoded, depth, wrapped_type)
+
+
+def test_deep_nesting_cached():
+    # Nested tuples containing a cached reference to the outermost tuple
+    depth = sys.getrecursionlimit() * 2
+    lst = []
+    obj = nest(lambda x: (x, lst), depth)
+    lst.append(obj)
+    encoded = PassthroughEncodingSession().encode(obj)
+    decoded = PassthroughDecodingSession().decode(encoded)
+    inner = decoded
+    for _ in range(depth):
+        assert type(inner) is tuple
+        assert inner[1] is decoded[1]
+        inner = inner[0]
+    assert decoded[1] == [decoded]
+
+
 def assert_isomorphic(x, y, iso=None):
     """
     Assert that two objects are isomorphic.
@@ -0,0 +1,86 @@
+import sys
+
+import pytest
+
+from python2.shared import pickling
+
+if sys.version_info[0] == 2:
+    import cPickle as pickle
+    _long = long  # noqa
+    _unicode = unicode  # noqa
+    _range = xrange  # noqa
+else:
+    import pickle
+    _long = int
+    _unicode = str
+    _range = range
+
+
+class DummyObject(object):
+    pass
+
+
+class DummyList(list):
+    pass
+
+
+def plain_cases():
+    yield None
+    yield True
+    yield 0
+    yield _long(2)**100
+    yield -1.5
+    yield 1+2j
+    yield b''
+    yield b'abc'
+    yield _unicode('abc')
+    yield bytearray(b'abc')
+    yield [1, [2, 3]]
+    yield (1, (2, 3))
+    yield {b'a': [1], _unicode('b'): (2,)}
+    yield {1, 2, 3}
+    yield frozenset([b'a', (1, 2)])
+
+
+@pytest.mark.parametrize('obj', plain_cases())
+def test_roundtrip(obj):
+    result = pickling.loads(pickling.dumps(obj))
+    assert type(result) is type(obj)
+    assert result == obj
+
+
+def test_shared_references():
+    x = [1]
+    obj = [x, x]
+    obj.append(obj)
+    result = pickling.loads(pickling.dumps(obj))
+    assert result[0] is result[1]
+    assert result[2] is result
+
+
+def unsupported_cases():
+    yield DummyObject()
+    yield DummyList()
+    yield DummyObject
+    yield len
+    yield _range(3)
+    yield [1, {2: (DummyObject(),)}]
+    yield {1: len}
+
+
+@pytest.mark.parametrize('obj', unsupported_cases())
+def test_dumps_unsupported(obj):
+    assert pickling.dumps(obj) is None
+
+
+def test_dumps_deep_nesting():
+    obj = []
+    for _ in range(100000):
+        obj = [obj]
+    assert pickling.dumps(obj) is None
+
+
+@pytest.mark.parametrize('obj', (DummyObject(), DummyList([1]), len))
+def test_loads_forbidden_global(obj):
+    with pytest.raises(pickle.UnpicklingError):
+        pickling.loads(pickle.dumps(obj, 2))
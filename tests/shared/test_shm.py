@@ -0,0 +1,115 @@
+import os
+import threading
+
+import pytest
+
+from python2.shared import shm
+from python2.shared.protocol import BinaryProtocol, JsonProtocol
+
+
+@pytest.fixture
+def files():
+    """ Client and server files for a transport with small rings. """
+    fd = shm.create_file(ring_size=4096)
+    try:
+        cread, swrite = os.pipe()
+        sread, cwrite = os.pipe()
+        client = shm.open_files(fd, os.fdopen(cread, 'rb'),
+                                os.fdopen(cwrite, 'wb'))
+        server = shm.open_files(fd, os.fdopen(sread, 'rb'),
+                                os.fdopen(swrite, 'wb'), server=True)
+    finally:
+        os.close(fd)
+    yield client, server
+    for f in client + server:
+        f.close()
+
+
+def test_read_write(files):
+    (creader, cwriter), (sreader, swriter) = files
+    cwriter.write(b'abc')
+    cwriter.write(bytearray(b'def'))
+    cwriter.flush()
+    assert sreader.read(2) == b'ab'
+    b = bytearray(4)
+    assert sreader.readinto(b) == 4
+    assert b == b'cdef'
+    assert sreader.read(0) == b''
+    swriter.write(b'xyz')
+    swriter.flush()
+    assert creader.read(3) == b'xyz'
+
+
+def test_end_of_file(files):
+    (creader, cwriter), (sreader, swriter) = files
+    cwriter.write(b'abc')
+    cwriter.close()
+    creader.close()
+    assert sreader.read(5) == b'abc'
+    assert sreader.read(5) == b''
+    assert sreader.readinto(bytearray(4)) == 0
+
+
+@pytest.mark.parametrize('protocol', (JsonProtocol(), BinaryProtocol()))
+def test_protocol(files, protocol):
+    # Messages larger than the rings wrap around, and the writer waits for
+    # the reader to make space
+    (creader, cwriter), (sreader, swriter) = files
+    messages = [[u'x' * 20000, list(range(3000))], None, u'abc']
+
+    def echo():
+        for _ in messages:
+            protocol.write(swriter, protocol.read(sreader))
+
+    thread = threading.Thread(target=echo)
+    thread.start()
+    try:
+        for message in messages:
+            protocol.write(cwriter, message)
+            assert protocol.read(creader) == message
+    finally:
+        thread.join()
+
+
+@pytest.mark.parametrize('size', (0, 1000, 1 << 32))
+def test_create_file_invalid_size(size):
+    with pytest.raises(ValueError):
+        shm.create_file(ring_size=size)
+
+
+def test_blobs():
+    writer = shm.BlobWriter(threshold=10)
+    reader = shm.BlobReader()
+    name = writer.put(b'x' * 100)
+    assert reader.get(name, 100) == b'x' * 100
+    view = reader.get(writer.put(bytearray(b'abc')), 3, view=True)
+    assert bytes(view) == b'abc'
+    # Blobs are removed as they are read
+    with pytest.raises(OSError):
+        reader.get(name, 100)
+    unread = writer.put(b'y')
+    path = os.path.join(writer.directory, unread)
+    assert os.path.exists(path)
+    writer.release()
+    assert not os.path.exists(path)
+    assert not writer.paths
+
+
+@pytest.mark.parametrize('name', ('python2-blob-../x', 'other', '../x'))
+def test_blob_invalid_name(name):
+    with pytest.raises(ValueError):
+        shm.BlobReader().get(name, 1)
+
+
+def test_blob_wrong_size():
+    writer = shm.BlobWriter()
+    try:
+        with pytest.raises(ValueError):
+            shm.BlobReader().get(writer.put(b'abc'), 4)
+    finally:
+        writer.release()
+
+
+def test_blob_invalid_threshold():
+    with pytest.raises(ValueError):
+        shm.BlobWriter(threshold=0)